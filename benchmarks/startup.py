@@ -0,0 +1,77 @@
+"""
+Benchmark the startup time of the command line interface.
+
+This guards against regressions in startup time by checking that printing
+help, and importing what is needed to submit jobs to AWS, do not load the
+heavy dependencies used for scraping.
+
+Usage: python benchmarks/startup.py [--repeat N]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that should only be loaded when scraping locally
+HEAVY_MODULES = ["pandas", "numpy", "pyarrow", "s3fs", "phl_courts_scraper", "selenium"]
+
+# Code to run for each case
+CASES = {
+    "--help": "from phl_courts_scraper_batch.__main__ import cli; cli(['--help'])",
+    "scrape --help": (
+        "from phl_courts_scraper_batch.__main__ import cli; cli(['scrape', '--help'])"
+    ),
+    "submit imports": "from phl_courts_scraper_batch.aws import AWS",
+}
+
+# Report any heavy modules that were loaded
+CHECK = """
+import atexit, sys
+atexit.register(
+    lambda: print("LOADED:" + ",".join(m for m in {modules} if m in sys.modules), file=sys.stderr)
+)
+"""
+
+
+def run(code):
+    """Run code in a new interpreter, returning the time and heavy modules loaded."""
+
+    start = time.perf_counter()
+    p = subprocess.run(
+        [sys.executable, "-c", CHECK.format(modules=HEAVY_MODULES) + code],
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    loaded = p.stderr.rsplit("LOADED:", 1)[-1].strip()
+    return elapsed, [m for m in loaded.split(",") if m]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs per case")
+    args = parser.parse_args()
+
+    failed = False
+    for name, code in CASES.items():
+        times, loaded = [], []
+        for _ in range(args.repeat):
+            elapsed, loaded = run(code)
+            times.append(elapsed)
+
+        print(
+            f"{name:<16} median {statistics.median(times):.3f}s "
+            f"min {min(times):.3f}s"
+        )
+        if loaded:
+            print(f"  ERROR: loaded heavy modules: {', '.join(loaded)}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+"""
+Benchmark end-to-end scraping throughput against a local stand-in for the portal.
+
+This runs `scrape()` end to end without touching the real UJS portal. A
+small HTTP server mimics the portal's search responses and serves court
+summary PDFs with a configurable latency and error rate, and a local S3
+server (moto) can stand in for the input and output buckets. For each
+input size and number of tasks, it reports the items scraped per second,
+the peak memory (RSS) of the tasks, and the time to combine their results.
+
+Usage: python benchmarks/throughput.py [--flavor portal] [--rows 1000 10000]
+           [--ntasks 1 4] [--sleep 0] [--latency 0.05] [--error-rate 0.01] [--s3]
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import simplejson as json
+
+# The bucket used with the local S3 stand-in
+BUCKET = "benchmark"
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    """
+    Responds like the portal: searches return JSON and court summaries are PDFs.
+
+    Every response is delayed by `latency` seconds, and fails with a 503
+    with probability `error_rate`.
+    """
+
+    latency = 0.0
+    error_rate = 0.0
+    pdf_size = 50_000
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.send_error(503, "Service Unavailable")
+            return
+
+        url = urlparse(self.path)
+        if url.path == "/search":
+            value = parse_qs(url.query).get("value", [""])[0]
+            body = json.dumps(
+                {
+                    "docket_number": value,
+                    "court_type": "Criminal",
+                    "caption": f"Comm. v. Defendant {value}",
+                    "status": "Closed",
+                    "court_summary_url": f"/summary/{value}",
+                }
+            ).encode("utf-8")
+            content_type = "application/json"
+        elif url.path.startswith("/summary/"):
+            header = f"%PDF-1.4\n% {url.path}\n".encode("utf-8")
+            body = header + b"0" * max(self.pdf_size - len(header), 0)
+            content_type = "application/pdf"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_portal(latency=0.0, error_rate=0.0, pdf_size=50_000):
+    """Start the fake portal in a background thread, returning its base URL."""
+
+    handler = type(
+        "Handler",
+        (PortalHandler,),
+        {"latency": latency, "error_rate": error_rate, "pdf_size": pdf_size},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_s3():
+    """Start a local S3 server (moto) and point the AWS clients at it."""
+
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise ImportError(
+            "The local S3 stand-in requires moto: pip install 'moto[server]'"
+        )
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+
+    os.environ["AWS_ENDPOINT_URL"] = f"http://{host}:{port}"
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+
+    import boto3
+
+    boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=BUCKET)
+    return server
+
+
+class FakePortalScraper:
+    """Searches the fake portal, with the interface of UJSPortalScraper."""
+
+    base_url = None
+
+    def __init__(
+        self, search_by=None, sleep=7, log_freq=50, errors="raise", browser=None
+    ):
+        self.search_by = search_by
+        self.sleep = sleep
+
+    def scrape_portal_data(self, values):
+        results = []
+        for value in values:
+            url = f"{self.base_url}/search?value={value}"
+            with urllib.request.urlopen(url) as r:
+                results.append(json.loads(r.read()))
+            time.sleep(self.sleep)
+        return results
+
+
+class FakeDriver:
+    """Stands in for the browser, downloading court summaries in the background."""
+
+    def __init__(self, download_dir):
+        self.download_dir = Path(download_dir)
+
+    def get(self, url):
+        def download():
+            # Like a browser, failed downloads just never show up
+            try:
+                with urllib.request.urlopen(url) as r:
+                    content = r.read()
+            except urllib.error.URLError:
+                return
+            path = self.download_dir / f"{time.monotonic_ns()}.pdf"
+            tmp = path.with_suffix(".crdownload")
+            tmp.write_bytes(content)
+            tmp.rename(path)
+
+        threading.Thread(target=download, daemon=True).start()
+
+    def quit(self):
+        pass
+
+
+class FakeReport:
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class FakeCourtSummaryParser:
+    """Parses downloaded PDFs, with the interface of CourtSummaryParser."""
+
+    def __init__(self, sleep=7, log_freq=50, errors="ignore", browser=None):
+        self.sleep = sleep
+
+    def _init(self, dirname):
+        self.driver = FakeDriver(dirname)
+
+    def __call__(self, pdf_path):
+        content = Path(pdf_path).read_bytes()
+        header = content.split(b"\n")[1].decode("utf-8")
+        return FakeReport({"source": header[2:], "size": len(content)})
+
+
+def install(base_url):
+    """Point the scraper at the fake portal."""
+
+    from phl_courts_scraper_batch import scrape
+
+    FakePortalScraper.base_url = base_url
+    scrape.UJSPortalScraper = FakePortalScraper
+    scrape.CourtSummaryParser = FakeCourtSummaryParser
+    scrape.PORTAL_URL = base_url
+
+
+def make_input(flavor, rows, folder):
+    """Write a synthetic input file, returning its path."""
+
+    import pandas as pd
+
+    from phl_courts_scraper_batch import io
+    from phl_courts_scraper_batch.aws import AWS
+
+    dockets = pd.Series([f"CP-51-CR-{i:07d}-2020" for i in range(rows)])
+    if flavor == "portal":
+        path = f"{folder}/input_{rows}.csv"
+        data = dockets
+    else:
+        path = f"{folder}/input_{rows}.json"
+        data = [
+            {"docket_number": d, "court_summary_url": f"/summary/{d}"} for d in dockets
+        ]
+
+    io.save_output_data(path, data, aws=AWS())
+    return path
+
+
+def peak_rss_mb():
+    """The peak RSS of this process, in MB."""
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def _worker(queue, base_url, func, kwargs):
+    """Run a function in a child process, reporting its peak RSS."""
+
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    install(base_url)
+    func(**kwargs)
+    queue.put(peak_rss_mb())
+
+
+def run_processes(base_url, func, kwargs_list):
+    """Run a function in parallel processes, returning the time and peak RSS."""
+
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    processes = [
+        ctx.Process(target=_worker, args=(queue, base_url, func, kwargs))
+        for kwargs in kwargs_list
+    ]
+
+    start = time.perf_counter()
+    for p in processes:
+        p.start()
+    rss = [queue.get() for _ in processes]
+    for p in processes:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    if any(p.exitcode != 0 for p in processes):
+        raise RuntimeError("A benchmark process failed")
+    return elapsed, max(rss)
+
+
+def _combine(flavor, output_folder, fmt):
+    from phl_courts_scraper_batch.aws import AWS
+
+    AWS().combine_parallel_results(flavor, f"{output_folder}/chunks", fmt=fmt)
+
+
+def bench(args, base_url, root, rows, ntasks):
+    """Run one benchmark case, returning a dict of results."""
+
+    from phl_courts_scraper_batch import io
+    from phl_courts_scraper_batch.aws import AWS
+    from phl_courts_scraper_batch.metrics import summarize_metrics
+    from phl_courts_scraper_batch.scrape import scrape
+
+    input_filename = make_input(args.flavor, rows, f"{root}/inputs")
+    output_folder = f"{root}/output_{rows}_{ntasks}"
+
+    # Split the input into one shard per task, like submit_jobs()
+    shards_folder = None
+    if args.shard and ntasks > 1:
+        submission_id = time.strftime("%Y%m%dT%H%M%S")
+        shards_folder = io.get_shards_folder(args.flavor, output_folder, submission_id)
+        io.save_input_shards(args.flavor, input_filename, shards_folder, ntasks, AWS())
+
+    # Scrape
+    kwargs = {
+        "flavor": args.flavor,
+        "input_filename": input_filename,
+        "output_folder": output_folder,
+        "search_by": "Docket Number",
+        "nprocs": ntasks,
+        "log_freq": max(rows, 1),
+        "sleep": args.sleep,
+        "interval": args.interval,
+        "time_limit": args.time_limit,
+        "flush_freq": args.flush_freq,
+        "retries": 0,
+        "parse_workers": args.parse_workers,
+        "sessions": args.sessions,
+        "shards_folder": shards_folder,
+    }
+    elapsed, rss = run_processes(
+        base_url, scrape, [{**kwargs, "pid": pid} for pid in range(ntasks)]
+    )
+
+    # Combine
+    combine_time = None
+    if ntasks > 1:
+        combine_time, _ = run_processes(
+            base_url,
+            _combine,
+            [
+                {
+                    "flavor": args.flavor,
+                    "output_folder": output_folder,
+                    "fmt": args.format,
+                }
+            ],
+        )
+
+    # Count the errors
+    summary = summarize_metrics(io.load_metrics(output_folder, AWS()))
+    return {
+        "rows": rows,
+        "ntasks": ntasks,
+        "seconds": elapsed,
+        "items_per_second": rows / elapsed,
+        "peak_rss_mb": rss,
+        "combine_seconds": combine_time,
+        "errors": summary["counters"].get("errors", 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--flavor", choices=["portal", "court_summary"], default="portal"
+    )
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[1_000, 10_000], help="Input sizes"
+    )
+    parser.add_argument(
+        "--ntasks", type=int, nargs="+", default=[1, 4], help="Numbers of tasks"
+    )
+    parser.add_argument("--sleep", type=float, default=0, help="Passed to scrape()")
+    parser.add_argument(
+        "--interval", type=float, default=0.05, help="Passed to scrape()"
+    )
+    parser.add_argument(
+        "--time-limit", type=float, default=20, help="Passed to scrape()"
+    )
+    parser.add_argument("--flush-freq", type=int, default=50, help="Passed to scrape()")
+    parser.add_argument(
+        "--parse-workers", type=int, default=0, help="Passed to scrape()"
+    )
+    parser.add_argument("--sessions", type=int, default=1, help="Passed to scrape()")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Portal response time (seconds)"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of failed responses"
+    )
+    parser.add_argument(
+        "--pdf-size", type=int, default=50_000, help="Court summary size (bytes)"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "jsonl", "parquet"],
+        default="json",
+        help="Format of the combined results",
+    )
+    parser.add_argument(
+        "--s3", action="store_true", help="Use a local S3 stand-in for input and output"
+    )
+    parser.add_argument(
+        "--shard", action="store_true", help="Split the input into per-task shards"
+    )
+    parser.add_argument("--output", help="Also save the results to this JSON file")
+    args = parser.parse_args()
+
+    base_url = start_portal(args.latency, args.error_rate, args.pdf_size)
+
+    tmpdir = tempfile.mkdtemp()
+    if args.s3:
+        server = start_s3()
+        root = f"s3://{BUCKET}/{int(time.time())}"
+    else:
+        root = tmpdir
+
+    # Run each case
+    results = []
+    try:
+        print(
+            f"{'rows':>9}{'ntasks':>8}{'seconds':>10}{'items/s':>10}"
+            f"{'RSS (MB)':>10}{'combine':>10}{'errors':>8}"
+        )
+        for rows in args.rows:
+            for ntasks in args.ntasks:
+                r = bench(args, base_url, root, rows, ntasks)
+                results.append(r)
+
+                combine = (
+                    f"{r['combine_seconds']:.2f}"
+                    if r["combine_seconds"] is not None
+                    else "-"
+                )
+                print(
+                    f"{r['rows']:>9}{r['ntasks']:>8}{r['seconds']:>10.2f}"
+                    f"{r['items_per_second']:>10.1f}{r['peak_rss_mb']:>10.1f}"
+                    f"{combine:>10}{r['errors']:>8}",
+                    flush=True,
+                )
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if args.s3:
+            server.stop()
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
+import time
 from pathlib import Path
 
 import click
+from loguru import logger
 
-from .aws import AWS
-from .scrape import scrape as _scrape
+# NOTE: imports of the AWS connection and the scraper are deferred to the
+# commands that use them, since they pull in heavy dependencies (boto3,
+# pandas, selenium, etc.) that slow down startup
 
 
 @click.group()
@@ -38,8 +41,9 @@ def cli():
     type=int,
     default=0,
     help=(
-        "If running in parallel, the local process id."
-        "This should be between 0 and number of processes."
+        "If running in parallel, the local process id. "
+        "This should be between 0 and number of processes, or negative "
+        "to have it assigned by the work queue when using --dynamic."
     ),
 )
 @click.option("--dry-run", is_flag=True, help="Do not save the results; dry run only.")
@@ -82,13 +86,165 @@ def cli():
 @click.option(
     "--interval",
     default=1,
-    help="How long to wait when downloading PDFs before checking for success",
+    help="The longest time to wait between checks for a finished PDF download",
     type=int,
 )
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Skip items that have already been saved to the output folder",
+)
+@click.option(
+    "--flush-freq",
+    default=50,
+    help="Save results to the output folder every N items",
+    type=int,
+)
+@click.option(
+    "--dynamic",
+    is_flag=True,
+    help="Claim batches of work from a shared queue instead of a fixed chunk",
+)
+@click.option(
+    "--batch-size",
+    default=25,
+    help="The number of items in each batch of work when using --dynamic",
+    type=int,
+)
+@click.option(
+    "--lease-timeout",
+    default=900,
+    help="How long a batch of work is leased for (in seconds)",
+    type=int,
+)
+@click.option(
+    "--queue-id",
+    type=str,
+    default=None,
+    help="The id of the shared work queue when using --dynamic",
+)
+@click.option(
+    "--cache",
+    type=str,
+    default=None,
+    help="Cache results across runs in this SQLite file or s3 folder",
+)
+@click.option(
+    "--cache-ttl",
+    default=7,
+    help="How long cached results are valid for (in days)",
+    type=float,
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Scrape every item again rather than using cached results",
+)
+@click.option(
+    "--adaptive",
+    is_flag=True,
+    help="Adapt the scraping rate to latency and errors instead of a fixed --sleep",
+)
+@click.option(
+    "--max-rate",
+    default=1.0,
+    help="The maximum scraping calls per second per process with --adaptive",
+    type=float,
+)
+@click.option(
+    "--fleet",
+    is_flag=True,
+    help="Share the --adaptive rate budget across all processes",
+)
+@click.option(
+    "--retries",
+    default=1,
+    help="How many times to retry failed items at the end of each chunk",
+    type=int,
+)
+@click.option(
+    "--retry-wait",
+    default=30,
+    help="How long to wait before the first retry (in seconds); doubles each retry",
+    type=int,
+)
+@click.option(
+    "--emf",
+    is_flag=True,
+    help="Log the run's metrics in CloudWatch embedded metric format",
+)
+@click.option(
+    "--parse-workers",
+    default=0,
+    type=int,
+    help="Parse court summaries in N processes while the next ones download",
+)
+@click.option(
+    "--sessions",
+    default=1,
+    type=int,
+    help="The number of browser sessions scraping at once in each process",
+)
+@click.option(
+    "--shards-folder",
+    default=None,
+    help="The folder with the input data split into one shard per process",
+)
+@click.option(
+    "--no-shard",
+    is_flag=True,
+    help="Do not split the input data into per-task shards before submitting to AWS",
+)
+@click.option(
+    "--deadline",
+    default=None,
+    type=float,
+    help="Choose --ntasks on AWS to finish within this many hours, based on past runs",
+)
+@click.option("--history", default=None, help="The history of past runs to plan from")
+@click.option(
+    "--spot",
+    is_flag=True,
+    help="Run AWS tasks on Fargate Spot, falling back to on-demand",
+)
+@click.option(
+    "--max-resubmits",
+    default=3,
+    type=int,
+    help="How many times to resubmit AWS tasks interrupted on Spot",
+)
+@click.option(
+    "--refresh-cluster",
+    is_flag=True,
+    help="Look up the AWS subnets and task definition rather than using the cache",
+)
+@click.option(
+    "--supervise",
+    is_flag=True,
+    help="Split the chunks of AWS tasks holding up the run with extra tasks",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Save CPU and memory profiles of each task (and the combine step)",
+)
+@click.option(
+    "--split-of",
+    default=None,
+    type=int,
+    hidden=True,
+    help="Scrape the items handed off by this process (launched by --supervise)",
+)
 @click.option("--aws", is_flag=True, help="Run scraping job on AWS")
 @click.option(
     "--ntasks", default=20, type=int, help="The number of tasks to use on AWS."
 )
+@click.option(
+    "--submit-concurrency",
+    default=10,
+    type=int,
+    help="The maximum number of concurrent task submissions on AWS.",
+)
 @click.option("--no-wait", is_flag=True, help="Whether to wait for AWS jobs to finish")
 @click.option("--debug", is_flag=True)
 def scrape(
@@ -107,8 +263,36 @@ def scrape(
     sleep=2,
     interval=1,
     time_limit=20,
+    resume=False,
+    flush_freq=50,
+    dynamic=False,
+    batch_size=25,
+    lease_timeout=900,
+    queue_id=None,
+    cache=None,
+    cache_ttl=7,
+    refresh=False,
+    adaptive=False,
+    max_rate=1.0,
+    fleet=False,
+    retries=1,
+    retry_wait=30,
+    emf=False,
+    parse_workers=0,
+    sessions=1,
+    shards_folder=None,
+    no_shard=False,
+    deadline=None,
+    history=None,
+    spot=False,
+    max_resubmits=3,
+    refresh_cluster=False,
+    supervise=False,
+    split_of=None,
+    profile=False,
     aws=False,
     ntasks=20,
+    submit_concurrency=10,
     no_wait=False,
     debug=False,
 ):
@@ -122,6 +306,8 @@ def scrape(
             raise ValueError("Input filename must be an s3 bucket when running on AWS")
         if not output_folder.startswith("s3://"):
             raise ValueError("Output folder must be an s3 bucket when running on AWS")
+        if cache is not None and not cache.startswith("s3://"):
+            raise ValueError("Cache must be an s3 folder when running on AWS")
     else:  # Running locally
 
         # Convert local paths to Path objects and resolve to absolute paths
@@ -129,6 +315,8 @@ def scrape(
             input_filename = str(Path(input_filename).resolve())
         if not output_folder.startswith("s3://"):
             output_folder = str(Path(output_folder).resolve())
+        if cache is not None and not cache.startswith("s3://"):
+            cache = str(Path(cache).resolve())
 
     # "search_by" must be specified for flavor = "portal"
     if search_by is None and flavor == "portal":
@@ -151,16 +339,507 @@ def scrape(
         "time_limit": time_limit,
         "debug": debug,
         "browser": browser,
+        "resume": resume,
+        "flush_freq": flush_freq,
+        "dynamic": dynamic,
+        "batch_size": batch_size,
+        "lease_timeout": lease_timeout,
+        "queue_id": queue_id,
+        "cache": cache,
+        "cache_ttl": cache_ttl,
+        "refresh": refresh,
+        "adaptive": adaptive,
+        "max_rate": max_rate,
+        "fleet": fleet,
+        "retries": retries,
+        "retry_wait": retry_wait,
+        "emf": emf,
+        "parse_workers": parse_workers,
+        "shards_folder": shards_folder,
+        "sessions": sessions,
+        "profile": profile,
     }
 
     # Run job on AWS
     if aws:
+        from .aws import AWS
+
         aws = AWS()
         return aws.submit_jobs(
             **kwargs,
             ntasks=ntasks,
             wait=(not no_wait),
+            shard=(not no_shard),
+            deadline=deadline,
+            history=history,
+            spot=spot,
+            max_resubmits=max_resubmits,
+            max_concurrency=submit_concurrency,
+            refresh_cluster=refresh_cluster,
+            supervise=supervise,
         )
     # Run locally
     else:
-        return _scrape(**kwargs, nprocs=nprocs)
+        from .scrape import scrape as _scrape
+
+        return _scrape(**kwargs, nprocs=nprocs, split_of=split_of)
+
+
+@cli.command(name="combine")
+@click.argument("flavor", type=click.Choice(["court_summary", "portal"]))
+@click.argument("output_folder", type=str)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["json", "jsonl", "parquet"]),
+    default="json",
+    help="Save the combined results as a JSON array, JSONL, or a Parquet dataset",
+)
+@click.option(
+    "--concurrency",
+    default=16,
+    type=int,
+    help="The maximum number of chunk files to download at once",
+)
+@click.option(
+    "--index",
+    default=None,
+    help="Also merge the results into the result store at this path",
+)
+@click.option(
+    "--flatten",
+    default=None,
+    type=click.Choice(["csv", "parquet"]),
+    help="Also flatten the results into tables saved as CSV or Parquet",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Save CPU and memory profiles of combining the results",
+)
+def combine(
+    flavor,
+    output_folder,
+    fmt="json",
+    concurrency=16,
+    index=None,
+    flatten=None,
+    profile=False,
+):
+    """
+    Combine the chunked results saved to an output folder.
+    """
+    if not output_folder.startswith("s3://"):
+        output_folder = str(Path(output_folder).resolve())
+    if index is not None and not index.startswith("s3://"):
+        index = str(Path(index).resolve())
+
+    from .aws import AWS
+
+    aws = AWS()
+    return aws.combine_parallel_results(
+        flavor,
+        f"{output_folder}/chunks",
+        fmt=fmt,
+        max_concurrency=concurrency,
+        index=index,
+        flatten=flatten,
+        profile=profile,
+    )
+
+
+@cli.command(name="flatten")
+@click.argument("flavor", type=click.Choice(["court_summary", "portal"]))
+@click.argument("output_folder", type=str)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "parquet"]),
+    default="csv",
+    help="Save the tables as CSV or Parquet files",
+)
+@click.option(
+    "--tables-folder",
+    default=None,
+    help="The folder to save the tables to (by default, 'tables' in the output folder)",
+)
+@click.option(
+    "--batch-size",
+    default=5000,
+    type=int,
+    help="The number of results to flatten at a time",
+)
+def flatten(flavor, output_folder, fmt="csv", tables_folder=None, batch_size=5000):
+    """
+    Flatten the results saved to an output folder into relational tables.
+
+    Saves tables of dockets, participants, charges, sentences, and bail,
+    which join on the docket number and participant id.
+    """
+    if not output_folder.startswith("s3://"):
+        output_folder = str(Path(output_folder).resolve())
+    if tables_folder is not None and not tables_folder.startswith("s3://"):
+        tables_folder = str(Path(tables_folder).resolve())
+
+    from .aws import AWS
+    from .flatten import flatten_results
+
+    return flatten_results(
+        flavor,
+        output_folder,
+        AWS(),
+        fmt=fmt,
+        tables_folder=tables_folder,
+        batch_size=batch_size,
+    )
+
+
+@cli.command(name="index")
+@click.argument("flavor", type=click.Choice(["court_summary", "portal"]))
+@click.argument("output_folder", type=str)
+@click.argument("store", type=str)
+def index(flavor, output_folder, store):
+    """
+    Merge the results saved to an output folder into a result store.
+
+    The store is a SQLite file (local or on s3) of dockets, indexed for
+    looking up a few at a time. Only results that were saved since the
+    store was last updated are added.
+    """
+    if not output_folder.startswith("s3://"):
+        output_folder = str(Path(output_folder).resolve())
+
+    from .aws import AWS
+    from .store import index_results
+
+    index_results(flavor, output_folder, store, AWS())
+
+
+@cli.command(name="lookup")
+@click.argument("store", type=str)
+@click.argument("values", nargs=-1, required=True)
+@click.option(
+    "--by",
+    type=click.Choice(
+        ["docket_number", "incident_number", "participant", "filing_date", "key"]
+    ),
+    default="docket_number",
+    help="The field to look up dockets by",
+)
+def lookup(store, values, by="docket_number"):
+    """
+    Look up dockets in a result store, printing one JSON record per line.
+    """
+    import simplejson as json
+
+    from .aws import AWS
+    from .store import lookup_results
+
+    for record in lookup_results(store, values, AWS(), by=by):
+        click.echo(json.dumps(record, ignore_nan=True))
+
+
+@cli.command(name="plan")
+@click.argument("flavor", type=click.Choice(["court_summary", "portal"]))
+@click.argument("input_filename", type=str)
+@click.option(
+    "--deadline",
+    required=True,
+    type=float,
+    help="The target wall-clock time for the run (in hours)",
+)
+@click.option("--sleep", default=2, help="The sleep time for the new run", type=int)
+@click.option("--sample", default=None, type=int, help="Only scrape a sample")
+@click.option("--sessions", default=1, type=int, help="The browser sessions per task")
+@click.option("--vcpus", default=1.0, type=float, help="The vCPUs per task")
+@click.option("--max-tasks", default=500, type=int, help="The most tasks to recommend")
+@click.option("--history", default=None, help="The history of past runs")
+@click.option(
+    "--record",
+    multiple=True,
+    help="Add the run saved to this output folder to the history first",
+)
+def plan(
+    flavor,
+    input_filename,
+    deadline,
+    sleep=2,
+    sample=None,
+    sessions=1,
+    vcpus=1.0,
+    max_tasks=500,
+    history=None,
+    record=(),
+):
+    """
+    Recommend the number of tasks for a new run from the throughput of past runs.
+
+    Prints the recommended --ntasks, the expected wall-clock time, and the
+    Fargate vCPU-hours for scraping the input file within the deadline.
+    """
+    from . import planner
+    from .aws import AWS
+
+    conn = AWS()
+    history = history or planner.DEFAULT_HISTORY
+
+    # Add past runs to the history
+    if record:
+        folders = [
+            f if f.startswith("s3://") else str(Path(f).resolve()) for f in record
+        ]
+        runs = planner.record_runs(folders, conn, path=history)
+    else:
+        runs = planner.load_history(history)
+
+    # Plan
+    if not input_filename.startswith("s3://"):
+        input_filename = str(Path(input_filename).resolve())
+    nitems = planner.count_items(flavor, input_filename, conn, sample=sample)
+    result = planner.plan(
+        flavor,
+        nitems,
+        deadline,
+        runs,
+        sleep=sleep,
+        sessions=sessions,
+        vcpus=vcpus,
+        max_tasks=max_tasks,
+    )
+
+    click.echo(f"items: {result['items']}")
+    click.echo(f"seconds per item: {result['seconds_per_item']:.2f}")
+    click.echo(f"ntasks: {result['ntasks']}")
+    click.echo(f"expected hours: {result['hours']:.2f}")
+    click.echo(f"vCPU-hours: {result['vcpu_hours']:.1f}")
+    if not result["meets_deadline"]:
+        click.echo(f"WARNING: not expected to finish within {deadline} hours")
+
+
+@cli.command(name="retry")
+@click.argument("output_folder", type=str)
+@click.option("--aws", is_flag=True, help="Run the retry job on AWS")
+@click.option("--no-wait", is_flag=True, help="Whether to wait for AWS jobs to finish")
+def retry(output_folder, aws=False, no_wait=False):
+    """
+    Scrape the items that failed in a previous run again.
+
+    The failed rows are saved to an input file of their own, and only those
+    are scraped, by as many tasks as the original run (or one per item, if
+    there are fewer). Their results are then filled in to the run's chunks
+    and combined JSON results. With --no-wait, run 'retry' again once the
+    tasks finish to fill them in.
+    """
+    if not output_folder.startswith("s3://"):
+        output_folder = str(Path(output_folder).resolve())
+
+    from . import io
+    from .aws import AWS
+
+    # Load the original config and input
+    conn = AWS()
+    config = io.load_run_config(output_folder, conn)
+    flavor = config["flavor"]
+    data = io.load_input_data(flavor, config["input_filename"], conn)
+    columns = None if flavor == "portal" else list(data.columns)
+
+    # Fill in the results of earlier retries (e.g., run with --no-wait)
+    filled = io.merge_retries(flavor, output_folder, conn, columns=columns)
+    if filled:
+        logger.info(f"Filled in the results of {filled} retried items")
+
+    # Load the failures
+    failures = io.load_failures(flavor, output_folder, conn)
+    if not failures:
+        logger.info("No failed items to retry")
+        return
+
+    # Save the failed rows (once for each item) to an input file
+    keys = io.get_keys(data, flavor)
+    rows = data[keys.isin({r["key"] for r in failures}).values]
+    rows = rows[~io.get_keys(rows, flavor).duplicated().values]
+    if not len(rows):
+        logger.warning("None of the failed items are in the original input")
+        return
+    logger.info(f"Retrying {len(rows)} failed items")
+
+    retry_id = time.strftime("%Y%m%dT%H%M%S")
+    input_filename, retry_folder = io.get_retry_paths(flavor, output_folder, retry_id)
+    io.save_output_data(
+        input_filename,
+        rows if flavor == "portal" else rows.to_dict(orient="records"),
+        aws=conn,
+    )
+
+    # Scrape them, saving the results to a folder of their own
+    nprocs = min(config["nprocs"] or 1, len(rows))
+    exclude = ["nprocs", "pid", "split_of", "resume", "sample", "shards_folder"]
+    exclude += ["queue_id"]
+    kwargs = {k: v for k, v in config.items() if k not in exclude}
+    kwargs["input_filename"] = input_filename
+    kwargs["output_folder"] = retry_folder
+
+    if aws:
+        jobs = conn.submit_jobs(**kwargs, ntasks=nprocs, wait=(not no_wait))
+        if no_wait:
+            logger.info("Run 'retry' again once the tasks finish to fill them in")
+            return jobs
+    else:
+        from .scrape import scrape as _scrape
+
+        for pid in range(nprocs):
+            _scrape(**kwargs, nprocs=nprocs, pid=pid)
+
+    filled = io.merge_retries(flavor, output_folder, conn, columns=columns)
+    logger.info(f"Filled in the results of {filled} retried items")
+
+
+@cli.command(name="stats")
+@click.argument("output_folder", type=str)
+def stats(output_folder):
+    """
+    Summarize the timing metrics saved by a run.
+
+    Prints latency percentiles for each phase of scraping, and the items
+    scraped per second by each task.
+    """
+    if not output_folder.startswith("s3://"):
+        output_folder = str(Path(output_folder).resolve())
+
+    from . import io
+    from .aws import AWS
+    from .metrics import summarize_metrics
+
+    records = io.load_metrics(output_folder, AWS())
+    if not records:
+        logger.info("No metrics found")
+        return
+    summary = summarize_metrics(records)
+
+    # Latency for each phase
+    columns = ["mean", "p50", "p90", "p99", "max"]
+    click.echo(f"{'phase':<16}{'count':>8}" + "".join(f"{c:>10}" for c in columns))
+    for phase, d in summary["phases"].items():
+        values = "".join(f"{d[c]:>10.3f}" for c in columns)
+        click.echo(f"{phase:<16}{d['count']:>8}{values}")
+
+    # Counters
+    click.echo("")
+    for name, n in sorted(summary["counters"].items()):
+        click.echo(f"{name}: {n}")
+
+    # Throughput for each task
+    click.echo("")
+    for chunk, rate in sorted(
+        summary["items_per_second"].items(), key=lambda item: str(item[0])
+    ):
+        click.echo(f"task {chunk}: {rate or 0:.3f} items/second")
+
+
+@cli.command(name="status")
+@click.argument("flavor", type=click.Choice(["court_summary", "portal"]))
+@click.argument("output_folder", type=str)
+def status(flavor, output_folder):
+    """
+    Show the progress of a run while its tasks are scraping.
+
+    Prints the progress each task last reported, the fleet's throughput,
+    and the expected time until the run finishes.
+    """
+    if not output_folder.startswith("s3://"):
+        output_folder = str(Path(output_folder).resolve())
+
+    from . import io, progress
+    from .aws import AWS
+
+    heartbeats = io.load_heartbeats(flavor, output_folder, AWS())
+    if not heartbeats:
+        logger.info("No progress reported yet")
+        return
+    summary = progress.summarize_heartbeats(heartbeats)
+
+    # Progress of each task
+    now = time.time()
+    columns = ["status", "done", "failed", "left", "items/s", "ETA (min)", "updated"]
+    click.echo(f"{'task':<8}" + "".join(f"{c:>11}" for c in columns))
+    for h in sorted(heartbeats, key=lambda h: str(h["chunk"])):
+        status = "stale" if progress.is_stale(h, now) else h["status"]
+        remaining = progress.get_remaining(h)
+        eta = progress.get_eta(h)
+        values = [
+            status,
+            h["done"],
+            h["failed"],
+            "?" if remaining is None else remaining,
+            f"{h['rate'] or 0:.3f}",
+            "?" if eta is None else f"{eta / 60:.1f}",
+            f"{now - h['updated_at']:.0f}s ago",
+        ]
+        click.echo(f"{h['chunk']!s:<8}" + "".join(f"{v!s:>11}" for v in values))
+
+    # The fleet
+    click.echo("")
+    click.echo(
+        "tasks: "
+        + ", ".join(f"{n} {status}" for status, n in sorted(summary["tasks"].items()))
+    )
+    click.echo(f"done: {summary['done']} ({summary['failed']} failed)")
+    if summary["remaining"] is not None:
+        click.echo(f"left: {summary['remaining']}")
+    click.echo(f"throughput: {summary['items_per_second']:.3f} items/second")
+    for name, label in [("eta", "ETA"), ("fleet_eta", "ETA at the fleet's rate")]:
+        if summary[name] is not None:
+            click.echo(f"{label}: {summary[name] / 60:.1f} minutes")
+
+
+@cli.command(name="profile")
+@click.argument("output_folder", type=str)
+@click.option(
+    "--sort",
+    default="cumulative",
+    type=click.Choice(["cumulative", "tottime", "ncalls"]),
+    help="How to sort the functions in the CPU profile",
+)
+@click.option("--limit", default=30, type=int, help="The number of functions to show")
+@click.option(
+    "--save",
+    default=None,
+    help="Also save the merged CPU profile to this path (e.g., for snakeviz)",
+)
+def profile(output_folder, sort="cumulative", limit=30, save=None):
+    """
+    Merge the profiles saved by each task of a run (with --profile).
+
+    Prints the peak memory of each task and of the io functions, and the
+    functions that took the most time across all tasks.
+    """
+    if not output_folder.startswith("s3://"):
+        output_folder = str(Path(output_folder).resolve())
+
+    from .aws import AWS
+    from .profiling import merge_profiles
+
+    stats, memory = merge_profiles(output_folder, AWS())
+    if save is not None:
+        stats.dump_stats(save)
+
+    # Peak memory
+    mb = 1024**2
+    click.echo(f"peak memory: {memory['peak_bytes'] / mb:.1f} MB")
+    for chunk, peak in sorted(memory["chunks"].items()):
+        label = f"task {chunk}" if chunk.isdigit() else chunk
+        click.echo(f"{label}: {peak / mb:.1f} MB")
+
+    # The io functions
+    click.echo("")
+    columns = ["calls", "seconds", "peak (MB)"]
+    click.echo(f"{'function':<24}" + "".join(f"{c:>11}" for c in columns))
+    for name, d in sorted(
+        memory["functions"].items(), key=lambda item: -item[1]["seconds"]
+    ):
+        values = f"{d['calls']:>11}{d['seconds']:>11.3f}{d['peak_bytes'] / mb:>11.1f}"
+        click.echo(f"{name:<24}{values}")
+
+    # CPU time
+    click.echo("")
+    stats.sort_stats(sort).print_stats(limit)
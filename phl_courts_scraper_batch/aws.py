@@ -1,16 +1,52 @@
 import os
+import random
+import re
 import sys
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
+from pathlib import Path
 
 import boto3
-import pandas as pd
 import simplejson as json
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from dotenv import find_dotenv, load_dotenv
 from fsspec.implementations.local import LocalFileSystem
 from loguru import logger
-from s3fs import S3FileSystem
 
 from . import CMD
 
+# The part size to use when streaming uploads to s3 (multipart)
+MULTIPART_BLOCK_SIZE = 32 * 2**20
+
+# The maximum number of tasks that can be launched in one run_task call
+RUN_TASK_MAX_COUNT = 10
+
+# The maximum number of tasks in one describe_tasks call
+DESCRIBE_TASKS_MAX = 100
+
+# The number of connections each AWS client keeps open
+MAX_POOL_CONNECTIONS = 32
+
+# The local cache of the cluster's subnets and task definition, and how long
+# it is valid for (in seconds)
+CLUSTER_CACHE = Path.home() / f".{CMD}" / "cluster.json"
+CLUSTER_CACHE_TTL = 3600
+
+# Run tasks on Fargate Spot capacity
+SPOT_STRATEGY = [{"capacityProvider": "FARGATE_SPOT", "weight": 1}]
+
+# Error codes returned when AWS API calls are throttled
+THROTTLING_CODES = [
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+]
+
 
 def parse_aws_path(path):
     """Split a path on AWS into bucket and key."""
@@ -21,37 +57,44 @@ def parse_aws_path(path):
     return bucket, key
 
 
+def get_chunk_id(path):
+    """Get the chunk id from a chunked output file, e.g., 'portal_results_12.json'."""
+
+    match = re.search(r"_(\d+)\.\w+$", str(path))
+    return int(match.group(1)) if match else -1
+
+
 def is_ec2_instance():
     """Check if an instance is running on ECS Fargate on AWS."""
     return os.getenv("AWS_EXECUTION_ENV") == "AWS_ECS_FARGATE"
 
 
+@lru_cache(maxsize=None)
+def _load_env():
+    """Load any environment variables from .env files (once per process)."""
+    load_dotenv(find_dotenv())
+
+
 class AWS:
-    """Connection to Amazon Web Services."""
+    """
+    Connection to Amazon Web Services.
+
+    The session, clients, and s3 file system are created on first use, so
+    tasks that only read and write s3 never set up the ECS and EC2 clients.
+    """
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, max_pool_connections=MAX_POOL_CONNECTIONS):
         """Initialize the connection to AWS."""
 
         self.debug = debug
+        self.max_pool_connections = max_pool_connections
 
         # Load any environment variables from .env files
-        load_dotenv(find_dotenv())
+        _load_env()
 
-        # Set up the AWS session
-        # This searches for AWS credentials in the environment
-        self.session = boto3.Session(
-            region_name=os.getenv("AWS_REGION", "us-east-1"),
-        )
-
-        # Set up the file systems
-        self.remote = S3FileSystem()
+        # Set up the local file system; the remote one is created on first use
         self.local = LocalFileSystem()
 
-        # Set up clients
-        self.ecs = self.session.client("ecs")
-        self.ec2 = self.session.client("ec2")
-        self.s3 = self.session.client("s3")
-
         # Set up the output s3 bucket (and create it if we need to)
         # self.bucket_name = BUCKET_NAME
         # if not self.remote.exists(self.bucket_name):
@@ -63,25 +106,127 @@ class AWS:
         # Set up cluster if we're not on AWS
         self.cluster_name = f"{CMD}-cluster"
 
-    def _init_cluster(self):
-        """Initialize the ECS cluster."""
+    @cached_property
+    def session(self):
+        """
+        The AWS session.
 
-        # Verify that the cluster exists
-        clusters = self.ecs.list_clusters()
-        cluster_names = [c.split("/")[-1] for c in clusters["clusterArns"]]
-        if self.cluster_name not in cluster_names:
-            raise ValueError(f"Missing ECS cluster: {self.cluster_name}")
+        This searches for AWS credentials in the environment.
+        """
+        return boto3.Session(region_name=os.getenv("AWS_REGION", "us-east-1"))
 
-        # Get the subnets
-        self.subnets = [d["SubnetId"] for d in self.ec2.describe_subnets()["Subnets"]]
-        if self.debug:
-            logger.info(f"Subnets: {self.subnets}")
+    def _client(self, service):
+        """Create a client with a connection pool sized for concurrent calls."""
+
+        config = Config(max_pool_connections=self.max_pool_connections)
+        return self.session.client(service, config=config)
+
+    @cached_property
+    def ecs(self):
+        """The ECS client."""
+        return self._client("ecs")
+
+    @cached_property
+    def ec2(self):
+        """The EC2 client."""
+        return self._client("ec2")
+
+    @cached_property
+    def s3(self):
+        """The s3 client."""
+        return self._client("s3")
 
-        # Get the latest task definition
-        tasks = self.ecs.list_task_definitions(familyPrefix=CMD, sort="ASC")
-        self.task_definition = tasks["taskDefinitionArns"][-1]
+    @cached_property
+    def remote(self):
+        """
+        The s3 file system.
+
+        s3fs caches instances by their arguments, so every connection in the
+        process shares one file system (and its listings cache).
+        """
+        from s3fs import S3FileSystem
+
+        return S3FileSystem(
+            config_kwargs={"max_pool_connections": self.max_pool_connections}
+        )
+
+    def _load_cluster(self, ttl=CLUSTER_CACHE_TTL):
+        """Load the cached subnets and task definition, if they are still valid."""
+
+        try:
+            cached = json.loads(CLUSTER_CACHE.read_text())
+        except (OSError, ValueError):
+            return None
+
+        if (
+            cached.get("cluster_name") != self.cluster_name
+            or cached.get("region") != self.session.region_name
+            or time.time() - cached.get("saved_at", 0) > ttl
+        ):
+            return None
+        return cached
+
+    def _init_cluster(self, ttl=CLUSTER_CACHE_TTL):
+        """
+        Initialize the ECS cluster.
+
+        The subnets and latest task definition are cached on disk for `ttl`
+        seconds, so repeat submits skip the lookups; use a `ttl` of 0 to
+        refresh them (e.g., after registering a new task definition).
+        """
+
+        cached = self._load_cluster(ttl=ttl)
+        if cached is not None:
+            self.subnets = cached["subnets"]
+            self.task_definition = cached["task_definition"]
+            if self.debug:
+                logger.info(f"Using cached cluster config from {CLUSTER_CACHE}")
+        else:
+            # Verify that the cluster exists
+            cluster_names = [
+                arn.split("/")[-1]
+                for page in self.ecs.get_paginator("list_clusters").paginate()
+                for arn in page["clusterArns"]
+            ]
+            if self.cluster_name not in cluster_names:
+                raise ValueError(f"Missing ECS cluster: {self.cluster_name}")
+
+            # Get the subnets
+            self.subnets = [
+                d["SubnetId"]
+                for page in self.ec2.get_paginator("describe_subnets").paginate()
+                for d in page["Subnets"]
+            ]
+
+            # Get the latest task definition (listed newest first)
+            paginator = self.ecs.get_paginator("list_task_definitions")
+            pages = paginator.paginate(
+                familyPrefix=CMD, sort="DESC", PaginationConfig={"MaxItems": 1}
+            )
+            task_definitions = [
+                arn for page in pages for arn in page["taskDefinitionArns"]
+            ]
+            if not task_definitions:
+                raise ValueError(f"Missing ECS task definition: {CMD}")
+            self.task_definition = task_definitions[0]
+
+            # Save for next time
+            CLUSTER_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            CLUSTER_CACHE.write_text(
+                json.dumps(
+                    {
+                        "cluster_name": self.cluster_name,
+                        "region": self.session.region_name,
+                        "subnets": self.subnets,
+                        "task_definition": self.task_definition,
+                        "saved_at": time.time(),
+                    },
+                    indent=2,
+                )
+            )
 
         if self.debug:
+            logger.info(f"Subnets: {self.subnets}")
             logger.info(f"Task definition: {self.task_definition}")
 
     def exists(self, path):
@@ -114,12 +259,67 @@ class AWS:
         ntasks=1,
         wait=False,
         browser="chrome",
+        resume=False,
+        flush_freq=50,
+        dynamic=False,
+        batch_size=25,
+        lease_timeout=900,
+        queue_id=None,
+        cache=None,
+        cache_ttl=7,
+        refresh=False,
+        adaptive=False,
+        max_rate=1.0,
+        fleet=False,
+        retries=1,
+        retry_wait=30,
+        emf=False,
+        parse_workers=0,
+        shards_folder=None,
+        sessions=1,
+        shard=True,
+        deadline=None,
+        history=None,
+        spot=False,
+        max_resubmits=3,
+        max_concurrency=10,
+        refresh_cluster=False,
+        supervise=False,
+        profile=False,
     ):
-        """Submit jobs to the ECS cluster."""
+        """
+        Submit jobs to the ECS cluster.
+
+        Tasks are submitted concurrently, with at most `max_concurrency`
+        requests in flight. If `wait` is False, this returns as soon as every
+        task is accepted, with the tasks and any provisioning failures.
+
+        Unless `shard` is False, the input data is first split into one shard
+        per task (sampled if requested), so each task only loads its own rows.
+        Tasks in dynamic mode claim work from all of the data, so they are
+        not sharded.
+
+        If a `deadline` (in hours) is given, the number of tasks is chosen
+        from the throughput of past runs in the `history`. Runs that are
+        waited on are added to the history.
+
+        If `spot` is True, tasks run on Fargate Spot, falling back to
+        on-demand Fargate when Spot capacity is unavailable; the cluster must
+        have the FARGATE_SPOT capacity provider. Tasks that are interrupted
+        are resubmitted (up to `max_resubmits` times) with --resume, so only
+        their unfinished items are scraped again.
+
+        The cluster's subnets and task definition are cached on disk; use
+        `refresh_cluster` to look them up again.
+
+        If `supervise` is True, tasks that are holding up the run once half
+        of them have finished hand off the tail of their chunk to extra
+        tasks (see `progress.find_stragglers`).
+        """
 
         # Init if we need to
-        if not hasattr(self, "subnets"):
-            self._init_cluster()
+        if refresh_cluster or not hasattr(self, "subnets"):
+            self._init_cluster(ttl=0 if refresh_cluster else CLUSTER_CACHE_TTL)
 
         # Set the network config
         NETWORK_CONFIG = {
@@ -133,6 +333,44 @@ class AWS:
         if debug:
             logger.debug(f"Output folder: {output_folder}")
 
+        # Choose the number of tasks needed to meet the deadline
+        if deadline is not None:
+            from . import planner
+
+            nitems = planner.count_items(flavor, input_filename, self, sample=sample)
+            result = planner.plan(
+                flavor,
+                nitems,
+                deadline,
+                planner.load_history(history or planner.DEFAULT_HISTORY),
+                sleep=sleep,
+                sessions=sessions,
+            )
+            ntasks = result["ntasks"]
+            logger.info(
+                f"Using {ntasks} tasks for {nitems} items; expecting "
+                f"{result['hours']:.2f} hours and {result['vcpu_hours']:.1f} vCPU-hours"
+            )
+            if not result["meets_deadline"]:
+                logger.warning(f"The run is not expected to finish in {deadline} hours")
+
+        # Split the input data into shards, unless they already exist
+        if shard and shards_folder is None and not dynamic and ntasks > 1:
+            from . import io
+
+            submission_id = time.strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+            shards_folder = io.get_shards_folder(flavor, output_folder, submission_id)
+            nshards = io.save_input_shards(
+                flavor,
+                input_filename,
+                shards_folder,
+                ntasks,
+                self,
+                sample=sample,
+                seed=seed,
+            )
+            logger.info(f"Split the input data into {nshards} shards")
+
         # Build the base command
         base_command = [
             "run",
@@ -149,6 +387,9 @@ class AWS:
             f"--interval={interval}",
             f"--time-limit={time_limit}",
             f"--browser={browser}",
+            f"--flush-freq={flush_freq}",
+            f"--retries={retries}",
+            f"--retry-wait={retry_wait}",
         ]
 
         # Add the optional arguments
@@ -158,93 +399,644 @@ class AWS:
             base_command += [f"--sample={sample}"]
         if dry_run:
             base_command += ["--dry-run"]
+        if resume:
+            base_command += ["--resume"]
+        if cache is not None:
+            base_command += [f"--cache={cache}", f"--cache-ttl={cache_ttl}"]
+        if refresh:
+            base_command += ["--refresh"]
+        if adaptive:
+            base_command += ["--adaptive", f"--max-rate={max_rate}"]
+        if fleet:
+            base_command += ["--fleet"]
+        if emf:
+            base_command += ["--emf"]
+        if parse_workers:
+            base_command += [f"--parse-workers={parse_workers}"]
+        if shards_folder is not None:
+            base_command += [f"--shards-folder={shards_folder}"]
+        if sessions > 1:
+            base_command += [f"--sessions={sessions}"]
+        if profile:
+            base_command += ["--profile"]
+        if dynamic:
+            # All tasks in this submission share a new queue by default
+            if queue_id is None:
+                queue_id = time.strftime("%Y%m%dT%H%M%S")
+            base_command += [
+                "--dynamic",
+                f"--batch-size={batch_size}",
+                f"--lease-timeout={lease_timeout}",
+                f"--queue-id={queue_id}",
+            ]
         if debug:
             base_command += ["--debug"]
 
-        # Run in parallel
-        tasks = []
-        for pid in range(0, ntasks):
-
-            # Log
-            logger.info(f"Submitting job #{pid}")
-
-            # Build the final command
-            command = base_command + [f"--pid={pid}"]
+        # Build the requests: tasks in dynamic mode are identical, so they can
+        # be launched several at a time; otherwise, each task gets its own pid
+        if dynamic:
+            requests = [
+                (base_command + ["--pid=-1"], min(RUN_TASK_MAX_COUNT, ntasks - i))
+                for i in range(0, ntasks, RUN_TASK_MAX_COUNT)
+            ]
+        else:
+            requests = [(base_command + [f"--pid={pid}"], 1) for pid in range(ntasks)]
 
-            # Submit job
-            task = self.ecs.run_task(
-                taskDefinition=self.task_definition,
-                cluster=self.cluster_name,
-                networkConfiguration=NETWORK_CONFIG,
-                launchType="FARGATE",
-                overrides={"containerOverrides": [{"name": CMD, "command": command}]},
-            )
+        # Submit concurrently
+        logger.info(f"Submitting {ntasks} tasks in {len(requests)} requests")
+        submitted_at = time.time()
+        tasks, failures = self._run_tasks(
+            requests, NETWORK_CONFIG, max_concurrency=max_concurrency, spot=spot
+        )
+        logger.info(f"...{len(tasks)} tasks accepted")
 
-            tasks.append(task)
+        # Check if provisioning failed
+        for failure in failures:
+            logger.warning(f"Task provisioning failed: {failure.get('reason')}")
 
         # Do not wait for tasks to finish
         if not wait:
-            return
-
-        # Check if provisioning failed:
-        failed = False
-        for task in tasks:
-            if not len(task["tasks"]) and len(task["tasks"]["failures"]):
-                failed = True
-                reason = task["tasks"]["failures"][0]["reason"]
-                logger.warning(f"Task provisioning failed: {reason}")
-
-        # Trim to successful tasks
-        tasks = [task for task in tasks if len(task["tasks"])]
+            return {"tasks": tasks, "failures": failures}
 
         # Stop successful
-        if failed:
+        if failures:
             for task in tasks:
-                self.ecs.stop_task(
-                    cluster=self.cluster_name, task=task["tasks"][0]["taskArn"]
-                )
+                self.ecs.stop_task(cluster=self.cluster_name, task=task["taskArn"])
             raise ValueError("Error provisioning some tasks; all tasks stopped.")
 
         # Get the task ids
-        task_ids = [task["tasks"][0]["taskArn"] for task in tasks]
-
-        # Wait for all jobs to complete
+        task_ids = [task["taskArn"] for task in tasks]
+
+        # Split the chunks of stragglers with extra tasks, which get new ids
+        supervisor = None
+        if supervise and not dynamic and ntasks > 1:
+            from . import io, progress
+
+            next_pid = ntasks
+
+            def supervisor():
+                nonlocal next_pid
+                heartbeats = [
+                    h
+                    for h in io.load_heartbeats(flavor, output_folder, self)
+                    if h["started_at"] >= submitted_at
+                ]
+
+                new_tasks = []
+                for heartbeat, nsplits in progress.find_stragglers(heartbeats):
+                    label = heartbeat["chunk"]
+                    if self.exists(io.get_split_path(flavor, output_folder, label)):
+                        continue
+
+                    helpers = list(range(next_pid, next_pid + nsplits))
+                    next_pid += nsplits
+                    progress.request_split(flavor, output_folder, label, helpers, self)
+                    logger.info(
+                        f"Process #{label} is expected to take "
+                        f"{progress.get_eta(heartbeat) / 60:.1f} more minutes; "
+                        f"splitting it with {nsplits} extra tasks"
+                    )
+
+                    requests = [
+                        (base_command + [f"--pid={pid}", f"--split-of={label}"], 1)
+                        for pid in helpers
+                    ]
+                    tasks, failures = self._run_tasks(
+                        requests,
+                        NETWORK_CONFIG,
+                        max_concurrency=max_concurrency,
+                        spot=spot,
+                    )
+                    for failure in failures:
+                        logger.warning(
+                            f"Task provisioning failed: {failure.get('reason')}"
+                        )
+                    new_tasks += [task["taskArn"] for task in tasks]
+
+                return new_tasks
+
+        # Wait for all jobs to complete, folding in results as they finish
         logger.info("Waiting for tasks to complete")
-        waiter = self.ecs.get_waiter("tasks_stopped")
-        waiter.wait(
-            cluster=self.cluster_name,
-            tasks=task_ids,
-            WaiterConfig={"Delay": 60, "MaxAttempts": 500},
+        chunks_output_folder = f"{output_folder}/chunks"
+        folded = {}
+        stopped = {}
+        exit_codes = self.monitor_jobs(
+            flavor,
+            chunks_output_folder,
+            task_ids,
+            folded,
+            stopped=stopped,
+            supervise=supervisor,
+            since=submitted_at,
         )
-        logger.info("...all tasks completed")
 
-        # Check for errors
-        task_results = self.ecs.describe_tasks(
-            cluster=self.cluster_name, tasks=task_ids
-        )
+        # Resubmit interrupted tasks to finish their remaining items
+        for attempt in range(max_resubmits):
+            interrupted = [
+                task
+                for task in stopped.values()
+                if task.get("stopCode") == "SpotInterruption"
+            ]
+            if not interrupted:
+                break
+            logger.warning(
+                f"Resubmitting {len(interrupted)} interrupted tasks "
+                f"(attempt {attempt+1} of {max_resubmits})"
+            )
+
+            # Each one picks up where it left off
+            requests = []
+            for task in interrupted:
+                exit_codes.pop(task["taskArn"])
+                command = task["overrides"]["containerOverrides"][0]["command"]
+                if "--resume" not in command:
+                    command = command + ["--resume"]
+                requests.append((command, 1))
+
+            tasks, failures = self._run_tasks(
+                requests, NETWORK_CONFIG, max_concurrency=max_concurrency, spot=spot
+            )
+            for failure in failures:
+                logger.warning(f"Task provisioning failed: {failure.get('reason')}")
+
+            stopped = {}
+            exit_codes.update(
+                self.monitor_jobs(
+                    flavor,
+                    chunks_output_folder,
+                    [task["taskArn"] for task in tasks],
+                    folded,
+                    stopped=stopped,
+                    since=submitted_at,
+                )
+            )
+        logger.info("...all tasks completed")
 
         # Check the exit codes
-        exit_codes = [
-            task["containers"][0]["exitCode"] for task in task_results["tasks"]
-        ]
-        if any([code != 0 for code in exit_codes]):
+        if any([code != 0 for code in exit_codes.values()]):
             logger.warning("One or more tasks failed!")
             sys.exit(1)
 
         # And combine
         logger.info("Combining parallel results on AWS")
+        outfile = self.combine_parallel_results(
+            flavor, chunks_output_folder, folded=folded, profile=profile
+        )
 
-        # Add "chunks" to the output folder
-        chunks_output_folder = f"{output_folder}/chunks"
-        outfile = self.combine_parallel_results(flavor, chunks_output_folder)
+        # Save the run's throughput for planning future runs
+        from . import planner
+
+        try:
+            planner.record_runs(
+                [output_folder], self, path=history or planner.DEFAULT_HISTORY
+            )
+        except (ValueError, FileNotFoundError) as e:
+            logger.warning(f"Could not add the run to the history: {e}")
 
         return outfile
 
-    def combine_parallel_results(self, flavor, output_folder):
-        """Iterate through parallel, chunked scraping results from AWS."""
+    def _run_task(self, command, count, network_config, max_attempts=8, spot=False):
+        """
+        Run ECS tasks, retrying with jittered backoff if throttled.
+
+        Tasks that cannot be placed on Fargate Spot are run on-demand instead.
+        """
+
+        if not spot:
+            return self._call_run_task(
+                command, count, network_config, max_attempts, launchType="FARGATE"
+            )
+
+        r = self._call_run_task(
+            command,
+            count,
+            network_config,
+            max_attempts,
+            capacityProviderStrategy=SPOT_STRATEGY,
+        )
+        if len(r["tasks"]) < count:
+            logger.warning(
+                f"{count - len(r['tasks'])} tasks could not be placed on Fargate "
+                "Spot; running them on-demand"
+            )
+            fallback = self._call_run_task(
+                command,
+                count - len(r["tasks"]),
+                network_config,
+                max_attempts,
+                launchType="FARGATE",
+            )
+            r = {
+                "tasks": r["tasks"] + fallback["tasks"],
+                "failures": fallback["failures"],
+            }
+        return r
+
+    def _call_run_task(self, command, count, network_config, max_attempts, **capacity):
+        """Call run_task with the given capacity, retrying if throttled."""
+
+        for attempt in range(max_attempts):
+            try:
+                return self.ecs.run_task(
+                    taskDefinition=self.task_definition,
+                    cluster=self.cluster_name,
+                    networkConfiguration=network_config,
+                    count=count,
+                    overrides={
+                        "containerOverrides": [{"name": CMD, "command": command}]
+                    },
+                    **capacity,
+                )
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in THROTTLING_CODES or attempt == max_attempts - 1:
+                    raise
+                wait = random.uniform(0, min(2**attempt, 60))
+                logger.debug(f"Throttled ({code}); retrying in {wait:.1f} seconds")
+                time.sleep(wait)
+
+    def _run_tasks(self, requests, network_config, max_concurrency=10, spot=False):
+        """
+        Submit (command, count) requests to run ECS tasks concurrently.
+
+        Returns the tasks that were accepted and any provisioning failures.
+        """
+
+        tasks, failures = [], []
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [
+                executor.submit(
+                    self._run_task, command, count, network_config, spot=spot
+                )
+                for command, count in requests
+            ]
+            for future in futures:
+                r = future.result()
+                tasks += r["tasks"]
+                failures += r["failures"]
+
+        return tasks, failures
+
+    def _describe_tasks(self, task_ids):
+        """Describe ECS tasks, in pages of at most 100 tasks."""
+
+        tasks = []
+        for i in range(0, len(task_ids), DESCRIBE_TASKS_MAX):
+            tasks += self.ecs.describe_tasks(
+                cluster=self.cluster_name,
+                tasks=task_ids[i : i + DESCRIBE_TASKS_MAX],
+            )["tasks"]
+        return tasks
+
+    def monitor_jobs(
+        self,
+        flavor,
+        output_folder,
+        task_ids,
+        folded=None,
+        poll=60,
+        timeout=30000,
+        stopped=None,
+        supervise=None,
+        since=None,
+    ):
+        """
+        Wait for ECS tasks to stop, reporting progress as they run.
+
+        Each chunk is folded into the combined output as soon as it is
+        saved, so the final combine step only needs to concatenate them.
+        Progress is taken from the heartbeats the tasks save while they run.
+
+        Parameters
+        ----------
+        flavor :
+            The kind of data being scraped
+        output_folder :
+            The folder holding the chunked results
+        task_ids :
+            The ARNs of the tasks to monitor
+        folded : optional
+            A dict to keep track of the chunks that have been folded in
+        poll : optional
+            How often to check the tasks (in seconds)
+        timeout : optional
+            How long to wait for the tasks to stop (in seconds)
+        stopped : optional
+            A dict to save the descriptions of the stopped tasks to
+        supervise : optional
+            A function called on each poll that launches any extra tasks
+            needed (e.g., to help stragglers), returning their ARNs; these
+            are monitored too
+        since : optional
+            Only report the progress of tasks started after this time (by
+            default, when monitoring starts)
+
+        Returns
+        -------
+        exit_codes :
+            The exit code of each task
+        """
+        from . import io, progress
+
+        fs = self.remote if output_folder.startswith("s3://") else self.local
+        if folded is None:
+            folded = {}
+
+        # The heartbeats are saved to the output folder the chunks folder is in
+        run_folder = os.path.dirname(output_folder)
+
+        # Skip chunk files left over from earlier runs, until they change
+        fs.invalidate_cache()
+        stale = {
+            f: fs.ukey(f) for f in fs.glob(f"{output_folder}/{flavor}_results*.json")
+        }
+
+        task_ids = list(task_ids)
+        N = len(task_ids)
+        exit_codes = {}
+        start = time.time()
+        if since is None:
+            since = start
+        while True:
+
+            # Launch any extra tasks
+            if supervise is not None and len(exit_codes) < N:
+                task_ids += supervise()
+                N = len(task_ids)
+
+            # Check the tasks that are still running
+            running = [t for t in task_ids if t not in exit_codes]
+            for task in self._describe_tasks(running):
+                if task["lastStatus"] == "STOPPED":
+                    exit_codes[task["taskArn"]] = task["containers"][0].get("exitCode")
+                    if stopped is not None:
+                        stopped[task["taskArn"]] = task
+
+            # Fold in any new chunks
+            if len(exit_codes) > N - len(running):
+                fs.invalidate_cache()
+                files = fs.glob(f"{output_folder}/{flavor}_results*.json")
+                self._fold_chunks(files, fs, folded, stale=stale)
+
+            # Report progress, as last reported by the tasks themselves; the
+            # ETA is only known once every running task has reported its rate
+            elapsed = time.time() - start
+            summary = progress.summarize_heartbeats(
+                [
+                    h
+                    for h in io.load_heartbeats(flavor, run_folder, self)
+                    if h["started_at"] >= since
+                ]
+            )
+            message = (
+                f"{len(exit_codes)} of {N} tasks done; {summary['done']} items "
+                f"scraped, {summary['failed']} failed "
+                f"({summary['items_per_second']:.2f} per second)"
+            )
+            live = len(exit_codes) < N and summary["tasks"].get("running")
+            if live and summary["eta"] is not None:
+                message += f"; ETA {summary['eta'] / 60:.0f} minutes"
+            logger.info(message)
+
+            if len(exit_codes) == N:
+                return exit_codes
+            if elapsed > timeout:
+                raise TimeoutError(f"Tasks did not finish within {timeout} seconds")
+            time.sleep(poll)
+
+    @staticmethod
+    def _get_folded_path(path):
+        """Get the path to the folded JSONL piece for a chunk file."""
+        return f"{os.path.dirname(path)}/folded/{os.path.basename(path)}l"
+
+    def _fold_chunks(self, files, fs, folded, stale=None):
+        """
+        Fold new or updated chunk files into JSONL pieces of the combined output.
+
+        The pieces are saved to the 'folded' sub-folder of the chunks folder.
+        """
+        stale = stale or {}
+
+        # Get the chunks that are new or have changed
+        updated = []
+        for f in sorted(files, key=get_chunk_id):
+            ukey = fs.ukey(f)
+            if ukey != stale.get(f) and ukey != folded.get(f, (None,))[0]:
+                updated.append((f, ukey))
+
+        # Save each one as a JSONL piece
+        chunks = self._iter_chunk_results([f for f, _ in updated], fs)
+        for (f, ukey), r in zip(updated, chunks):
+            piece = self._get_folded_path(f)
+            if fs is self.local:
+                fs.makedirs(os.path.dirname(piece), exist_ok=True)
+            with fs.open(piece, "w") as ff:
+                for result in r:
+                    ff.write(json.dumps(result) + "\n")
+            folded[f] = (ukey, len(r))
+
+    def _iter_file_contents(self, files, fs, max_concurrency=16):
+        """
+        Iterate through the contents of each file, in order.
+
+        Files are downloaded concurrently on a thread pool, with at most
+        `max_concurrency` files in flight (or held in memory) at once.
+        """
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            pending = deque()
+            for f in files:
+                pending.append(executor.submit(fs.cat, f))
+                if len(pending) >= max_concurrency:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _iter_chunk_results(self, files, fs, max_concurrency=16):
+        """
+        Iterate through the list of results in each chunk file.
+
+        Results saved as a dict are keyed by their input value; keys that
+        appear in more than one chunk are only returned once.
+        """
+
+        seen = set()
+        for content in self._iter_file_contents(files, fs, max_concurrency):
+
+            # Load this chunk
+            r = json.loads(content)
+
+            # Convert to a list if we need to
+            if isinstance(r, dict):
+                items = [(k, v) for k, v in r.items() if v and k not in seen]
+                seen.update(k for k, _ in items)
+                r = [v for _, v in items]
+
+            yield r
+
+    def _save_combined_results(
+        self, filename, files, fs, fmt, max_concurrency, folded=None
+    ):
+        """Stream the results from each chunk file to the combined output."""
+        from . import io
+
+        total = 0
+
+        # Concatenate the chunks that were already folded into JSONL pieces
+        if folded is not None and fmt in ["json", "jsonl"]:
+            self._fold_chunks(files, fs, folded)
+            pieces = [self._get_folded_path(f) for f in files]
+
+            with fs.open(filename, "w", block_size=MULTIPART_BLOCK_SIZE) as ff:
+                if fmt == "json":
+                    ff.write("[")
+                for f, content in zip(
+                    files, self._iter_file_contents(pieces, fs, max_concurrency)
+                ):
+                    if not folded[f][1]:
+                        continue
+                    content = content.decode("utf-8").rstrip("\n")
+                    if fmt == "json":
+                        ff.write(("," if total else "") + content.replace("\n", ","))
+                    else:
+                        ff.write(content + "\n")
+                    total += folded[f][1]
+                if fmt == "json":
+                    ff.write("]")
+
+            return total
+
+        # A Parquet dataset with one file per chunk
+        if fmt == "parquet":
+            if fs.exists(filename):
+                fs.rm(filename, recursive=True)
+            if fs is self.local:
+                fs.makedirs(filename, exist_ok=True)
+
+            # Spool each chunk locally, so that every part can be saved with
+            # the schema of all of them (a field that is null throughout one
+            # chunk would otherwise not match its type in the others)
+            pa, pq = io._import_pyarrow()
+            with tempfile.TemporaryDirectory() as tmpdir:
+                spools, schemas = [], []
+                chunks = self._iter_chunk_results(files, fs, max_concurrency)
+                for f, r in zip(files, chunks):
+                    if not len(r):
+                        continue
+                    table = io.to_arrow(r)
+                    spools.append((f, f"{tmpdir}/{len(spools)}.arrow"))
+                    with pa.OSFile(spools[-1][1], "wb") as sink:
+                        with pa.ipc.new_file(sink, table.schema) as writer:
+                            writer.write_table(table)
+                    schemas.append(table.schema)
+                    total += len(r)
+
+                if spools:
+                    try:
+                        schema = pa.unify_schemas(schemas, promote_options="permissive")
+                    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                        raise ValueError(
+                            f"The results of each chunk have incompatible types: {e}"
+                        )
+
+                for f, spool in spools:
+                    part = f"{filename}/part-{max(get_chunk_id(f), 0):05d}.parquet"
+                    with pa.memory_map(spool) as source:
+                        table = pa.ipc.open_file(source).read_all()
+                    with fs.open(part, "wb") as ff:
+                        io.write_parquet(ff, table, schema=schema)
+
+            return total
+
+        # A JSON array or JSONL file
+        with fs.open(filename, "w", block_size=MULTIPART_BLOCK_SIZE) as ff:
+            if fmt == "json":
+                ff.write("[")
+            for r in self._iter_chunk_results(files, fs, max_concurrency):
+                for result in r:
+                    if fmt == "json":
+                        ff.write(("," if total else "") + json.dumps(result))
+                    else:
+                        ff.write(json.dumps(result) + "\n")
+                    total += 1
+            if fmt == "json":
+                ff.write("]")
+
+        return total
+
+    def combine_parallel_results(
+        self,
+        flavor,
+        output_folder,
+        fmt="json",
+        max_concurrency=16,
+        folded=None,
+        index=None,
+        flatten=None,
+        profile=False,
+    ):
+        """
+        Iterate through parallel, chunked scraping results from AWS.
+
+        The chunks are downloaded concurrently and streamed to the combined
+        output in order, so memory use does not grow with the number of
+        chunks. On s3, the output is written with a multipart upload.
+
+        Parameters
+        ----------
+        flavor :
+            The kind of data that was scraped
+        output_folder :
+            The folder holding the chunked results
+        fmt : optional
+            Save the combined results as a JSON array ('json'), as
+            newline-delimited JSON ('jsonl'), or as a Parquet dataset with
+            one file per chunk ('parquet')
+        max_concurrency : optional
+            The maximum number of chunk files to download at once
+        folded : optional
+            The chunks that were already folded into JSONL pieces while
+            monitoring the tasks; these are concatenated rather than parsed
+        index : optional
+            The path to a result store (local or s3) to merge the results
+            into, for looking up dockets by key
+        flatten : optional
+            Also flatten the results into tables of dockets, participants,
+            charges, sentences, and bail, saved as 'csv' or 'parquet' files
+            in the 'tables' folder next to the chunks (see
+            `flatten.flatten_results`)
+        profile : optional
+            Save a CPU and memory profile of combining the results next to
+            the chunks, as 'profile_combine.prof' and 'memory_combine.json'
+        """
+        if fmt not in ["json", "jsonl", "parquet"]:
+            raise ValueError("'fmt' must be one of 'json', 'jsonl', 'parquet'")
+
+        # Profile combining the results, saving the profile with the chunks
+        if profile:
+            from .profiling import Profiler
+
+            with Profiler() as profiler:
+                data_file = self.combine_parallel_results(
+                    flavor,
+                    output_folder,
+                    fmt=fmt,
+                    max_concurrency=max_concurrency,
+                    folded=folded,
+                    index=index,
+                    flatten=flatten,
+                )
+            profiler.save(output_folder, "combine", self)
+            return data_file
+
+        # The file system
+        if output_folder.startswith("s3://"):
+            fs = self.remote
+        else:
+            fs = self.local
 
         # Invalidate the cache
-        self.remote.invalidate_cache()
+        fs.invalidate_cache()
 
         # Make sure it exists
         if not self.exists(output_folder):
@@ -252,9 +1044,6 @@ class AWS:
                 f"Output folder does not exist for parallel results: '{output_folder}'"
             )
 
-        # The file system
-        fs = self.remote
-
         # Get the files
         tags = [f"{flavor}_results", f"{flavor}_input"]
         extensions = [".json", ".csv"]
@@ -264,57 +1053,63 @@ class AWS:
 
             # Get the files
             pattern = f"{output_folder}/{tag}*{extension}"
-            files = sorted(fs.glob(pattern))
+            files = sorted(fs.glob(pattern), key=get_chunk_id)
             N = len(files)
             if N == 0:
                 raise ValueError(f"No files found in output folder '{output_folder}'")
 
-            # Combine
-            if i == 0:
-                logger.info(f"Combining {N} files from AWS")
-            results = None
-            for f in files:
-
-                with fs.open(f, "rb") as ff:
-
-                    # load this result
-                    if extension == ".json":
-                        r = json.loads(ff.read())
-
-                        # Convert to a list if we need to
-                        if isinstance(r, dict):
-                            r = [v for _, v in r.items() if v]
-
-                        # Add the results
-                        if results is None:
-                            results = r
-                        else:
-                            results += r
-                    else:
-
-                        r = pd.read_csv(ff, header=None)
-                        if results is None:
-                            results = r
-                        else:
-                            results = pd.concat([results, r])
-
             # Normalize the output file
-            filename = f"{output_folder}/../{tag}{extension}"
-            if filename.startswith("s3://"):
-                filename = filename[5:]
-            filename = f"s3://{os.path.normpath(filename)}"
+            output_extension = f".{fmt}" if i == 0 else extension
+            filename = os.path.normpath(
+                f"{output_folder.replace('s3://', '')}/../{tag}{output_extension}"
+            )
+            if output_folder.startswith("s3://"):
+                filename = f"s3://{filename}"
 
             if i == 0:
                 data_file = filename
-
-            if i == 0:
-                logger.info(f"Total number of results from AWS: {len(results)}")
+                logger.info(f"Combining {N} files from AWS")
                 logger.info(f"Saving combined results to {filename}")
 
-            with fs.open(filename, "w") as ff:
-                if extension == ".json":
-                    ff.write(json.dumps(results))
-                else:
-                    results.to_csv(ff, header=False, index=False)
+            # Results
+            if i == 0:
+                total = self._save_combined_results(
+                    filename, files, fs, fmt, max_concurrency, folded=folded
+                )
+                logger.info(f"Total number of results from AWS: {total}")
+
+                # Warn about failed items
+                failed = 0
+                for content in self._iter_file_contents(
+                    fs.glob(f"{output_folder}/{flavor}_failures*.json"),
+                    fs,
+                    max_concurrency,
+                ):
+                    failed += len(json.loads(content))
+                if failed:
+                    logger.warning(
+                        f"{failed} items failed; use the 'retry' command to scrape them again"
+                    )
+
+            # Inputs
+            else:
+                with fs.open(filename, "w", block_size=MULTIPART_BLOCK_SIZE) as ff:
+                    for content in self._iter_file_contents(files, fs, max_concurrency):
+                        content = content.decode("utf-8")
+                        if content and not content.endswith("\n"):
+                            content += "\n"
+                        ff.write(content)
+
+        # Merge the results into the result store
+        if index is not None:
+            from .store import index_results
+
+            index_results(flavor, output_folder.rsplit("/", 1)[0], index, self)
+
+        # Flatten the results into tables
+        if flatten is not None:
+            from .flatten import flatten_results
+
+            flatten_results(flavor, output_folder.rsplit("/", 1)[0], self, fmt=flatten)
 
         return data_file
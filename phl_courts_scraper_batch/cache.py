@@ -0,0 +1,129 @@
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+import simplejson as json
+
+
+class SQLiteResultCache:
+    """
+    A cache of scraping results stored in a local SQLite file.
+
+    Parameters
+    ----------
+    path :
+        The path to the SQLite file
+    flavor :
+        The kind of data being scraped
+    search_by : optional
+        How the portal is being searched
+    ttl : optional
+        How long cached results are valid for (in seconds)
+    """
+
+    def __init__(self, path, flavor, search_by=None, ttl=None):
+        self.flavor = flavor
+        self.search_by = search_by or ""
+        self.ttl = ttl
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "flavor TEXT, search_by TEXT, value TEXT, result TEXT, scraped_at REAL, "
+            "PRIMARY KEY (flavor, search_by, value))"
+        )
+        self.conn.commit()
+
+    def get(self, value):
+        """Return whether a valid result is cached, and the result."""
+
+        row = self.conn.execute(
+            "SELECT result, scraped_at FROM results "
+            "WHERE flavor = ? AND search_by = ? AND value = ?",
+            (self.flavor, self.search_by, str(value)),
+        ).fetchone()
+
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            return False, None
+        return True, json.loads(row[0])
+
+    def set(self, value, result):
+        """Cache the result for a value."""
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            (
+                self.flavor,
+                self.search_by,
+                str(value),
+                json.dumps(result, ignore_nan=True),
+                time.time(),
+            ),
+        )
+        self.conn.commit()
+
+
+class S3ResultCache:
+    """
+    A cache of scraping results stored as one object per value on s3.
+
+    This is shared by all of the tasks running on AWS.
+
+    Parameters
+    ----------
+    prefix :
+        The s3 folder holding the cached results
+    fs :
+        The s3 file system
+    flavor :
+        The kind of data being scraped
+    search_by : optional
+        How the portal is being searched
+    ttl : optional
+        How long cached results are valid for (in seconds)
+    """
+
+    def __init__(self, prefix, fs, flavor, search_by=None, ttl=None):
+        self.fs = fs
+        self.ttl = ttl
+        search_by = (search_by or "").lower().replace(" ", "_")
+        self.folder = "/".join(filter(None, [prefix.rstrip("/"), flavor, search_by]))
+
+    def _path(self, value):
+        digest = hashlib.sha1(str(value).encode("utf-8")).hexdigest()
+        return f"{self.folder}/{digest}.json"
+
+    def get(self, value):
+        """Return whether a valid result is cached, and the result."""
+
+        try:
+            record = json.loads(self.fs.cat(self._path(value)))
+        except FileNotFoundError:
+            return False, None
+
+        if self.ttl is not None and time.time() - record["scraped_at"] > self.ttl:
+            return False, None
+        return True, record["result"]
+
+    def set(self, value, result):
+        """Cache the result for a value."""
+
+        record = {"value": str(value), "result": result, "scraped_at": time.time()}
+        with self.fs.open(self._path(value), "w") as ff:
+            ff.write(json.dumps(record, ignore_nan=True))
+
+
+def get_result_cache(location, flavor, aws, search_by=None, ttl=None):
+    """
+    Get the result cache at the input location.
+
+    An s3 path is used as a prefix for cached objects; anything else is
+    used as the path to a local SQLite file.
+    """
+
+    if location.startswith("s3://"):
+        return S3ResultCache(location, aws.remote, flavor, search_by=search_by, ttl=ttl)
+    else:
+        return SQLiteResultCache(location, flavor, search_by=search_by, ttl=ttl)
@@ -0,0 +1,160 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from loguru import logger
+
+# inotify flags and the events that can mean a download finished: a file
+# was written and closed, renamed into place, or a partial file was removed
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+
+# Suffixes of downloads in progress (Chrome and Firefox)
+PARTIAL_SUFFIXES = [".crdownload", ".part"]
+
+# The initial time between checks when polling (in seconds)
+MIN_POLL = 0.05
+
+
+def _inotify_watch(folder):
+    """Watch a folder with inotify, returning the file descriptor to wait on."""
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    if libc.inotify_add_watch(fd, str(folder).encode("utf-8"), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, "inotify_add_watch failed")
+    return fd
+
+
+class DownloadWatcher:
+    """
+    Wait for PDFs to finish downloading to a folder.
+
+    On Linux, this waits on inotify events for the folder, so it returns as
+    soon as a download completes. Otherwise, it falls back to polling the
+    folder, starting with short waits and backing off to the interval.
+
+    Parameters
+    ----------
+    folder :
+        The folder the browser downloads to
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.fd = None
+        if sys.platform.startswith("linux"):
+            try:
+                self.fd = _inotify_watch(self.folder)
+            except (OSError, AttributeError) as e:
+                logger.debug(f"Polling for downloads; inotify is unavailable: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop watching the folder."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _drain(self):
+        """Discard any pending events."""
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def completed(self):
+        """Get the PDFs that have finished downloading."""
+
+        names = [p.name for p in self.folder.iterdir()]
+        if any(name.endswith(s) for name in names for s in PARTIAL_SUFFIXES):
+            return []
+        return sorted(
+            self.folder / name
+            for name in names
+            if name.endswith(".pdf") and (self.folder / name).stat().st_size > 0
+        )
+
+    def clear(self):
+        """Remove PDFs left over from earlier downloads, and any pending events."""
+
+        for p in self.folder.glob("*.pdf"):
+            p.unlink(missing_ok=True)
+        if self.fd is not None:
+            self._drain()
+
+    def wait(self, time_limit=20, interval=1):
+        """
+        Wait for a PDF to finish downloading, returning its path.
+
+        When watching events, the folder is also checked every `interval`
+        seconds in case an event is missed; when polling, this is the longest
+        time between checks.
+        """
+
+        deadline = time.monotonic() + time_limit
+        poll = min(MIN_POLL, interval)
+        while True:
+            pdfs = self.completed()
+            if pdfs:
+                return pdfs[0]
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ValueError(f"PDF download did not finish in {time_limit} seconds")
+
+            if self.fd is not None:
+                ready, _, _ = select.select([self.fd], [], [], min(remaining, interval))
+                if ready:
+                    self._drain()
+            else:
+                time.sleep(min(remaining, poll))
+                poll = min(2 * poll, interval)
+
+
+@contextmanager
+def downloaded_pdf(driver, pdf_url, watcher, interval=1, time_limit=20, metrics=None):
+    """
+    Download a PDF with the browser, yielding its path once it is complete.
+
+    The download time is recorded to `metrics`, along with a count of the
+    downloads that time out.
+    """
+
+    watcher.clear()
+    start = time.perf_counter()
+    driver.get(pdf_url)
+    try:
+        pdf_path = watcher.wait(time_limit=time_limit, interval=interval)
+    except ValueError:
+        if metrics is not None:
+            metrics.increment("download_timeouts")
+        raise
+    if metrics is not None:
+        metrics.observe("download", time.perf_counter() - start)
+
+    try:
+        yield str(pdf_path)
+    finally:
+        pdf_path.unlink(missing_ok=True)
@@ -0,0 +1,369 @@
+import tempfile
+from itertools import islice
+
+import pandas as pd
+import simplejson as json
+from loguru import logger
+
+from . import io
+from .store import LOOKUP_FIELDS
+
+# The tables that results are flattened into, and the columns that identify
+# (and join) their rows
+TABLE_IDS = {
+    "dockets": ["docket_number", "key", "participant_id"],
+    "participants": ["participant_id"],
+    "charges": ["docket_number", "charge_index"],
+    "sentences": ["docket_number", "charge_index", "sentence_index"],
+    "bail": ["docket_number", "bail_index"],
+}
+
+# The names that nested lists of records go by in the scraped dockets
+NESTED_FIELDS = {
+    "charges": ["charges"],
+    "sentences": ["sentences"],
+    "bail": ["bail", "bail_actions", "bail_info"],
+}
+
+# The fields that identify a participant
+PARTICIPANT_FIELDS = {
+    "name": LOOKUP_FIELDS["participant"],
+    "date_of_birth": ["date_of_birth", "dob", "birth_date"],
+}
+
+# The number of scraped results to flatten at a time
+FLATTEN_BATCH_SIZE = 5000
+
+
+def _as_records(value):
+    """Wrap a nested value as a list of records (dicts)."""
+
+    if isinstance(value, dict):
+        return [value]
+    if isinstance(value, list):
+        return [v if isinstance(v, dict) else {"value": v} for v in value]
+    if pd.isna(value):
+        return []
+    return [{"value": value}]
+
+
+def _get_nested(frame, table):
+    """Get the column of a frame holding a nested table, if it has one."""
+
+    for name in NESTED_FIELDS[table]:
+        if name in frame:
+            return name
+    return None
+
+
+def _first_of(frame, fields):
+    """The first non-null value of any of the fields in each row."""
+
+    columns = [f for f in fields if f in frame]
+    if not columns:
+        return pd.Series(pd.NA, index=frame.index, dtype=object)
+    return frame[columns].bfill(axis=1).iloc[:, 0]
+
+
+def _get_participant_ids(frame):
+    """
+    Stable ids for the participants in each row of a frame.
+
+    Ids hash the participant's (normalized) name and date of birth, so the
+    same person gets the same id across chunks and runs.
+    """
+
+    names = _first_of(frame, PARTICIPANT_FIELDS["name"])
+    dobs = _first_of(frame, PARTICIPANT_FIELDS["date_of_birth"])
+    values = pd.DataFrame(
+        {
+            "name": names.fillna("").astype(str).str.strip().str.upper(),
+            "date_of_birth": dobs.fillna("").astype(str).str.strip(),
+        }
+    )
+    ids = pd.util.hash_pandas_object(values, index=False).map("{:016x}".format)
+    return ids.where(names.notna().values, None).values, names, dobs
+
+
+def _explode(frame, column, ids, index=None):
+    """
+    Flatten a column of nested records into a table of its own.
+
+    Rows keep the `ids` of their parent and, if `index` is given, their
+    position in the parent's list (counting from 1).
+    """
+
+    columns = ids + ([] if index is None else [index])
+    if column is None or frame.empty:
+        return pd.DataFrame(columns=columns)
+
+    values = frame.set_index(ids)[column].map(_as_records).explode().dropna()
+    if values.empty:
+        return pd.DataFrame(columns=columns)
+
+    parents = values.index.to_frame(index=False)
+    if index is not None:
+        parents[index] = values.groupby(level=ids, sort=False).cumcount().values + 1
+    items = pd.json_normalize(values.tolist(), max_level=0)
+    items = items.drop(columns=[c for c in items if c in parents])
+    return pd.concat([parents, items], axis=1)
+
+
+def _normalize(items):
+    """A frame of scraped items (dicts), with the key they were scraped by."""
+
+    frame = pd.json_normalize(items["result"].tolist(), max_level=0)
+    frame = frame.drop(columns=["key", "participant_id"], errors="ignore")
+    frame.insert(0, "key", items["key"].values)
+    return frame
+
+
+def _with_ids(frame, table):
+    """Put the id columns of a table first, adding any that are missing."""
+
+    ids = TABLE_IDS[table]
+    return frame.reindex(columns=ids + [c for c in frame.columns if c not in ids])
+
+
+def _encode_nested(frame):
+    """Save any nested values left in a table as JSON strings."""
+
+    for column in frame.columns[frame.dtypes == object]:
+        nested = frame[column].map(lambda v: isinstance(v, (list, dict)))
+        if nested.any():
+            frame[column] = frame[column].where(
+                ~nested, frame[column][nested].map(json.dumps)
+            )
+    return frame
+
+
+def flatten_records(records, seen=None):
+    """
+    Flatten scraped {"key", "result"} records into relational tables.
+
+    Returns a dict of DataFrames: dockets (one row per docket number),
+    participants (keyed by a stable `participant_id`), and the charges,
+    sentences, and bail of each docket (keyed by the docket number and
+    their position in the docket). Court summaries hold the dockets of a
+    participant; portal results are dockets themselves.
+
+    Dockets and participants already in `seen` (a dict of sets of ids for
+    each table, updated in place) are skipped, so the tables can be built
+    one batch of records at a time.
+    """
+
+    if seen is None:
+        seen = {}
+
+    # One row per scraped item; court summaries hold a list of dockets for
+    # a participant, and other items are dockets themselves
+    frame = pd.DataFrame.from_records(records, columns=["key", "result"])
+    items = frame.assign(result=frame["result"].map(_as_records)).explode("result")
+    items = items.dropna(subset=["result"])
+    is_summary = (
+        items["result"]
+        .map(lambda r: isinstance(r.get("dockets"), list))
+        .values.astype(bool)
+    )
+    summaries = _normalize(items[is_summary])
+    parsed = _normalize(items[~is_summary])
+
+    summary_ids = _get_participant_ids(summaries)[0]
+    summaries = summaries.assign(participant_id=summary_ids)
+    parsed_ids, names, dobs = _get_participant_ids(parsed)
+    parsed = parsed.assign(participant_id=parsed_ids)
+
+    # The participants, from the summaries and from the dockets themselves
+    participants = pd.concat(
+        [
+            summaries.drop(columns=["key", "dockets"], errors="ignore"),
+            pd.DataFrame(
+                {
+                    "participant_id": parsed_ids,
+                    "name": names.values,
+                    "date_of_birth": dobs.values,
+                }
+            ),
+        ],
+        ignore_index=True,
+    )
+
+    # The dockets, newest first, without any already seen
+    dockets = pd.concat(
+        [_explode(summaries, "dockets", ["key", "participant_id"]), parsed],
+        ignore_index=True,
+    )
+    dockets = _with_ids(dockets, "dockets").dropna(subset=["docket_number"])
+    dockets = dockets.drop_duplicates(subset="docket_number")
+    dockets = dockets[~dockets["docket_number"].isin(seen.get("dockets", set()))]
+    participants = _with_ids(participants, "participants")
+    participants = participants.dropna(subset=["participant_id"])
+    participants = participants.drop_duplicates(subset="participant_id")
+    participants = participants[
+        ~participants["participant_id"].isin(seen.get("participants", set()))
+    ]
+    seen.setdefault("dockets", set()).update(dockets["docket_number"])
+    seen.setdefault("participants", set()).update(participants["participant_id"])
+
+    # The nested tables of each docket; sentences are nested in charges, or
+    # in the docket itself (with no charge index)
+    charges_field = _get_nested(dockets, "charges")
+    charges = _explode(dockets, charges_field, ["docket_number"], "charge_index")
+    sentences_field = _get_nested(charges, "sentences")
+    sentences = pd.concat(
+        [
+            _explode(
+                charges,
+                sentences_field,
+                ["docket_number", "charge_index"],
+                "sentence_index",
+            ),
+            _explode(
+                dockets,
+                _get_nested(dockets, "sentences"),
+                ["docket_number"],
+                "sentence_index",
+            ),
+        ],
+        ignore_index=True,
+    )
+    bail_field = _get_nested(dockets, "bail")
+    bail = _explode(dockets, bail_field, ["docket_number"], "bail_index")
+
+    # Drop the nested tables from their parents
+    dockets = dockets.drop(
+        columns=[c for t in ["charges", "sentences", "bail"] for c in NESTED_FIELDS[t]],
+        errors="ignore",
+    )
+    charges = charges.drop(columns=NESTED_FIELDS["sentences"], errors="ignore")
+
+    tables = {
+        "dockets": dockets,
+        "participants": participants,
+        "charges": charges,
+        "sentences": sentences,
+        "bail": bail,
+    }
+    for name, table in tables.items():
+        table = _with_ids(table, name).reset_index(drop=True)
+        for column in TABLE_IDS[name]:
+            if column.endswith("_index"):
+                table[column] = table[column].astype("Int64")
+        tables[name] = _encode_nested(table)
+
+    return tables
+
+
+def _iter_batches(records, batch_size):
+    """Split an iterable of records into lists of up to `batch_size`."""
+
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _iter_latest_records(flavor, output_folder, aws):
+    """Iterate through the newest result saved for each key of a run."""
+
+    seen = set()
+    parts_folder = io.get_parts_folder(flavor, output_folder)
+    for record in io.iter_output_records(parts_folder, aws, reverse=True):
+        key = record["key"]
+        if key not in seen:
+            seen.add(key)
+            yield record
+
+
+def _write_table(path, spools, columns, fmt, aws):
+    """Combine the spooled batches of a table into one CSV or Parquet file."""
+
+    ids = [c for c in columns if c.endswith("_index")]
+    fs = io.get_filesystem(path, aws)
+    writer = None
+    with fs.open(path, "wb") as ff:
+        for i, spool in enumerate(spools or [None]):
+            if spool is None:
+                table = pd.DataFrame(columns=columns)
+            else:
+                table = pd.read_pickle(spool).reindex(columns=columns)
+
+            # Positions are integers, and everything else is text, as scraped,
+            # so every batch has the same schema
+            for column in columns:
+                dtype = "Int64" if column in ids else "string"
+                table[column] = table[column].astype(dtype)
+
+            if fmt == "csv":
+                ff.write(table.to_csv(index=False, header=(i == 0)).encode("utf-8"))
+            else:
+                pa, pq = io._import_pyarrow()
+                arrow = pa.Table.from_pandas(table, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(
+                        ff, arrow.schema, compression="zstd", use_dictionary=True
+                    )
+                writer.write_table(arrow)
+
+        if writer is not None:
+            writer.close()
+
+
+def flatten_results(
+    flavor,
+    output_folder,
+    aws,
+    fmt="csv",
+    tables_folder=None,
+    batch_size=FLATTEN_BATCH_SIZE,
+):
+    """
+    Flatten the results saved to an output folder into relational tables.
+
+    The newest result for each key is read from the part files one batch at
+    a time (see `flatten_records`), so memory use does not grow with the
+    size of the run. Each table is saved as '{flavor}_{table}.csv' or
+    '.parquet' in `tables_folder` (by default, 'tables' in the output
+    folder). Returns the number of rows in each table.
+    """
+
+    if fmt not in ["csv", "parquet"]:
+        raise ValueError("'fmt' must be one of 'csv', 'parquet'")
+    if fmt == "parquet":
+        io._import_pyarrow()
+    if tables_folder is None:
+        tables_folder = f"{output_folder}/tables"
+
+    # Flatten each batch, spooling the tables to local files
+    seen = {}
+    total = 0
+    spools = {name: [] for name in TABLE_IDS}
+    columns = {name: list(ids) for name, ids in TABLE_IDS.items()}
+    counts = {name: 0 for name in TABLE_IDS}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        records = _iter_latest_records(flavor, output_folder, aws)
+        for n, batch in enumerate(_iter_batches(records, batch_size)):
+            total += len(batch)
+            for name, table in flatten_records(batch, seen=seen).items():
+                if table.empty:
+                    continue
+                path = f"{tmpdir}/{name}-{n:05d}.pkl"
+                table.to_pickle(path)
+                spools[name].append(path)
+                counts[name] += len(table)
+                columns[name] += [c for c in table.columns if c not in columns[name]]
+
+        if not total:
+            raise ValueError(f"No results found in output folder '{output_folder}'")
+
+        # Save each table, with the columns of all of its batches
+        if not tables_folder.startswith("s3://"):
+            aws.local.makedirs(tables_folder, exist_ok=True)
+        for name in TABLE_IDS:
+            path = f"{tables_folder}/{flavor}_{name}.{fmt}"
+            _write_table(path, spools[name], columns[name], fmt, aws)
+            logger.info(f"Saved {counts[name]} rows to {path}")
+
+    return counts
@@ -1,3 +1,4 @@
+import hashlib
 from pathlib import Path
 
 import pandas as pd
@@ -17,7 +18,167 @@ def get_output_paths(flavor, output_folder, chunk):
     return output_folder, outfile
 
 
-def load_input_data(flavor, input_filename, aws):
+def get_batch_output_paths(flavor, output_folder, batch):
+    """
+    Get the paths to the results and input of a batch of a shared work queue.
+
+    These are saved with the chunks, so they are combined the same way.
+    """
+
+    output_folder += "/chunks"
+    return (
+        f"{output_folder}/{flavor}_results_batch_{batch}.json",
+        f"{output_folder}/{flavor}_input_batch_{batch}.csv",
+    )
+
+
+def get_parts_folder(flavor, output_folder):
+    """
+    Get the folder holding the incremental results.
+
+    This is shared by all chunks so that a run can be resumed with a
+    different number of processes.
+    """
+    return f"{output_folder}/parts/{flavor}"
+
+
+def get_queue_folder(flavor, output_folder, queue_id):
+    """Get the folder holding the leases for a shared work queue."""
+    return f"{output_folder}/queue/{flavor}/{queue_id}"
+
+
+def get_rate_state_path(flavor, output_folder):
+    """Get the path to the rate budget shared by all processes."""
+    return f"{output_folder}/rate/{flavor}.json"
+
+
+def get_heartbeat_path(flavor, output_folder, label):
+    """Get the path to the progress a process reports while it runs."""
+    return f"{output_folder}/heartbeats/{flavor}_{label}.json"
+
+
+def get_split_path(flavor, output_folder, label):
+    """Get the path to the request for a process to hand off the tail of its chunk."""
+    return f"{output_folder}/splits/{flavor}_{label}.json"
+
+
+def get_retry_paths(flavor, output_folder, retry_id):
+    """
+    Get the input file and output folder for scraping the failed items of a
+    run again.
+    """
+    folder = f"{output_folder}/retry/{flavor}"
+    extension = "csv" if flavor == "portal" else "json"
+    return f"{folder}/{retry_id}.{extension}", f"{folder}/{retry_id}"
+
+
+def get_acks_folder(flavor, output_folder, label):
+    """Get the folder where helpers of a process acknowledge the items handed off."""
+    return f"{output_folder}/splits/acks/{flavor}_{label}"
+
+
+def get_shards_folder(flavor, output_folder, submission_id):
+    """
+    Get the folder holding the input data split into one shard per task.
+
+    Each submission gets its own folder, so tasks (and retries) of earlier
+    submissions keep reading the shards they were started with.
+    """
+    return f"{output_folder}/shards/{flavor}/{submission_id}"
+
+
+def get_shard_path(shards_folder, pid, input_filename):
+    """Get the path to a task's shard of the input data."""
+    return f"{shards_folder}/shard_{pid:05d}{Path(input_filename).suffix}"
+
+
+def get_keys(data, flavor):
+    """Get the keys identifying each row of the input data."""
+
+    if flavor == "portal":
+        return data.astype(str)
+    elif flavor == "court_summary":
+        return data["court_summary_url"].astype(str)
+    else:
+        raise ValueError("'flavor' must be one of 'portal', 'court_summary'")
+
+
+def get_partition(key, nprocs):
+    """Map a key to a partition in [0, nprocs) using a stable hash."""
+
+    digest = hashlib.md5(str(key).encode("utf-8")).hexdigest()
+    return int(digest, 16) % nprocs
+
+
+def get_filesystem(path, aws):
+    """Get the file system (remote or local) for the input path."""
+
+    if path.startswith("s3://"):
+        return aws.remote
+    else:
+        return aws.local
+
+
+def _import_pyarrow():
+    """Import pyarrow, which is needed for Parquet files."""
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "Parquet files require pyarrow; install it with the 'parquet' extra"
+        )
+    return pa, pq
+
+
+def to_arrow(results):
+    """
+    Convert a DataFrame or a list of (possibly nested) records to Arrow.
+
+    Records that are not dicts are saved to a single 'result' column, and
+    missing (None) records are saved as a row of nulls.
+    """
+    pa, _ = _import_pyarrow()
+
+    if isinstance(results, (pd.DataFrame, pd.Series)):
+        return pa.Table.from_pandas(pd.DataFrame(results), preserve_index=False)
+    return pa.Table.from_pylist(
+        [
+            r if isinstance(r, dict) else {} if r is None else {"result": r}
+            for r in results
+        ]
+    )
+
+
+def conform_table(table, schema):
+    """Cast an Arrow table to a schema, adding any missing columns as nulls."""
+    pa, _ = _import_pyarrow()
+
+    for field in schema:
+        if field.name not in table.column_names:
+            table = table.append_column(field, pa.nulls(len(table), field.type))
+    return table.select(schema.names).cast(schema)
+
+
+def write_parquet(ff, results, schema=None):
+    """
+    Write a DataFrame, a list of records, or an Arrow table to Parquet.
+
+    If a `schema` is given, the data is cast to it, so that the files of a
+    dataset can be read together. Columns are dictionary-encoded and
+    compressed with zstd.
+    """
+    pa, pq = _import_pyarrow()
+
+    table = results if isinstance(results, pa.Table) else to_arrow(results)
+    if schema is not None:
+        table = conform_table(table, schema)
+
+    pq.write_table(table, ff, compression="zstd", use_dictionary=True)
+
+
+def load_input_data(flavor, input_filename, aws, columns=None):
     """
     Load the input data for the scraper.
 
@@ -29,39 +190,79 @@ def load_input_data(flavor, input_filename, aws):
     flavor : str
     input_filename : str
     aws : AWS
+    columns : list, optional
+        Only load these columns from a Parquet file
     """
     # Make sure the infile exists
     if not aws.exists(input_filename):
         raise ValueError(f"Input filename '{input_filename}' does not exist.")
 
     # Determine where we are loading the data from
-    if input_filename.startswith("s3://"):
-        opener = aws.remote.open
-    else:
-        opener = aws.local.open
+    opener = get_filesystem(input_filename, aws).open
 
     # Load the data
     with opener(input_filename, "rb") as ff:
 
+        # Load a Parquet file
+        if input_filename.endswith(".parquet"):
+            _import_pyarrow()
+            data = pd.read_parquet(ff, columns=columns)
+
+            # The first column holds the values to search for
+            if flavor == "portal":
+                return data.iloc[:, 0].astype(str).rename("value")
+            return data
+
         # Load a CSV file
         if flavor == "portal":
 
             # Make sure it's a CSV file
             if not input_filename.endswith(".csv"):
-                raise ValueError("Input file should end in .csv")
+                raise ValueError("Input file should end in .csv or .parquet")
 
             # Return loaded data
-            return pd.read_csv(
-                ff, header=None, names=["value"], squeeze=True, dtype={"value": str}
-            )
+            return pd.read_csv(ff, header=None, names=["value"], dtype={"value": str})[
+                "value"
+            ]
         else:  # A JSON file
 
             # Make sure it's a JSON file
             if not input_filename.endswith(".json"):
-                raise ValueError("Input file should end in .json")
+                raise ValueError("Input file should end in .json or .parquet")
 
             # Return data
-            return json.loads(ff.read())
+            return pd.DataFrame(json.loads(ff.read()))
+
+
+def save_input_shards(
+    flavor, input_filename, shards_folder, nprocs, aws, sample=None, seed=42
+):
+    """
+    Split the input data into one shard per task, so each task only loads
+    its own rows.
+
+    Rows are assigned to tasks with the same stable hash of their keys used
+    when scraping, so all rows with the same key are in the same shard. If
+    requested, the input data is sampled first. Tasks with no rows get no
+    shard. Returns the number of shards saved.
+    """
+
+    # Load and sample the input data once
+    data = load_input_data(flavor=flavor, input_filename=input_filename, aws=aws)
+    if sample is not None:
+        data = data.sample(sample, random_state=seed)
+
+    # Save each shard in the same format as the input
+    partitions = get_keys(data, flavor).map(lambda key: get_partition(key, nprocs))
+    nshards = 0
+    for pid, shard in data.groupby(partitions.values):
+        path = get_shard_path(shards_folder, pid, input_filename)
+        if path.endswith(".json"):
+            shard = shard.to_dict(orient="records")
+        save_output_data(path, shard, aws=aws)
+        nshards += 1
+
+    return nshards
 
 
 def save_output_data(outfile, results, aws):
@@ -74,17 +275,226 @@ def save_output_data(outfile, results, aws):
             p.parent.mkdir(parents=True)
 
     # Determine where we are loading the data from
-    if outfile.startswith("s3://"):
-        opener = aws.remote.open
-    else:
-        opener = aws.local.open
+    opener = get_filesystem(outfile, aws).open
+
+    # Parquet files are binary
+    if outfile.endswith(".parquet"):
+        with opener(outfile, "wb") as ff:
+            write_parquet(ff, results)
+        return
 
     # Write the data
     with opener(outfile, "w") as ff:
 
         if outfile.endswith(".json"):
             ff.write(json.dumps(results, ignore_nan=True))
+        elif outfile.endswith(".jsonl"):
+            for record in results:
+                ff.write(json.dumps(record, ignore_nan=True) + "\n")
         elif outfile.endswith(".csv"):
             results.to_csv(ff, index=False, header=False)
         else:
-            raise ValueError("Input file should end in .json or .csv")
+            raise ValueError(
+                "Input file should end in .json, .jsonl, .csv, or .parquet"
+            )
+
+
+def iter_output_records(folder, aws, reverse=False, label=None, run_id=None):
+    """
+    Iterate through the records saved to the JSONL files in a folder.
+
+    Files are named so that they sort chronologically; use `reverse=True`
+    to iterate from the newest file to the oldest. If a `label` is given,
+    only the files saved by that process are read (and only those from one
+    run, if a `run_id` is given too).
+    """
+
+    # Get the files
+    fs = get_filesystem(folder, aws)
+    fs.invalidate_cache()
+    pattern = "*" if label is None else f"{run_id or '*'}-{label}-?????"
+    files = sorted(fs.glob(f"{folder}/{pattern}.jsonl"), reverse=reverse)
+
+    # Yield one record at a time
+    for f in files:
+        with fs.open(f, "r") as ff:
+            for line in ff:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def index_output_records(conn, folder, aws, keys, label=None, run_id=None):
+    """
+    Index the latest result of each of a set of keys in the JSONL files of a folder.
+
+    The results are added to a `results` table of a SQLite connection, so
+    they can be looked up one at a time (see `lookup_result`) rather than
+    held in memory. Files are read newest first, and keys that are already
+    in the table keep their result.
+    """
+
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT)"
+    )
+    records = iter_output_records(folder, aws, reverse=True, label=label, run_id=run_id)
+    conn.executemany(
+        "INSERT OR IGNORE INTO results VALUES (?, ?)",
+        (
+            (str(record["key"]), json.dumps(record["result"], ignore_nan=True))
+            for record in records
+            if record["key"] in keys
+        ),
+    )
+    conn.commit()
+
+
+def lookup_result(conn, key):
+    """Look up the result of a key indexed with `index_output_records`, if any."""
+
+    row = conn.execute("SELECT result FROM results WHERE key = ?", (str(key),))
+    row = row.fetchone()
+    return None if row is None else json.loads(row[0])
+
+
+def load_completed_keys(folder, aws):
+    """Load the keys that have already been scraped and saved to a folder."""
+
+    return {record["key"] for record in iter_output_records(folder, aws)}
+
+
+def load_run_config(output_folder, aws):
+    """Load the config saved by a previous run to an output folder."""
+
+    fs = get_filesystem(output_folder, aws)
+    fs.invalidate_cache()
+    files = fs.glob(f"{output_folder}/config.json") or sorted(
+        fs.glob(f"{output_folder}/chunks/config_*.json")
+    )
+    if not files:
+        raise FileNotFoundError(f"No saved config found in '{output_folder}'")
+
+    return json.loads(fs.cat(files[0]))
+
+
+def load_failures(flavor, output_folder, aws):
+    """Load the items that failed in a previous run to an output folder."""
+
+    fs = get_filesystem(output_folder, aws)
+    fs.invalidate_cache()
+    files = fs.glob(f"{output_folder}/{flavor}_failures.json") + fs.glob(
+        f"{output_folder}/chunks/{flavor}_failures_*.json"
+    )
+
+    failures = []
+    for f in files:
+        failures += json.loads(fs.cat(f))
+    return failures
+
+
+def merge_retries(flavor, output_folder, aws, columns=None):
+    """
+    Fill in the results of failed items that were scraped again.
+
+    The latest result of each item scraped by the `retry` command replaces
+    the null result of its rows, in each chunk and in the combined JSON
+    results, and the item is removed from the failures. The rows are
+    matched by the saved inputs, read with the input data's `columns`.
+    Returns the number of items filled in.
+    """
+
+    # The latest result of each retried item
+    results = {}
+    parts_folder = get_parts_folder(flavor, f"{output_folder}/retry/{flavor}/*")
+    for record in iter_output_records(parts_folder, aws, reverse=True):
+        results.setdefault(record["key"], record["result"])
+    if not results:
+        return 0
+
+    fs = get_filesystem(output_folder, aws)
+    fs.invalidate_cache()
+    prefix = "s3://" if output_folder.startswith("s3://") else ""
+
+    # Fill in the results first, so the failures are only removed once they are
+    files = fs.glob(f"{output_folder}/chunks/{flavor}_results*.json") + fs.glob(
+        f"{output_folder}/{flavor}_results.json"
+    )
+    filled = set()
+    for f in files:
+        chunk_results = json.loads(fs.cat(f))
+        if None not in chunk_results:
+            continue
+
+        folder, name = f.rsplit("/", 1)
+        input_file = f"{folder}/{name.replace('_results', '_input', 1)[:-5]}.csv"
+        with fs.open(input_file, "r") as ff:
+            rows = pd.read_csv(ff, header=None, names=columns, dtype=str)
+        keys = get_keys(rows.iloc[:, 0] if flavor == "portal" else rows, flavor)
+        if len(keys) != len(chunk_results):
+            raise ValueError(f"The results in '{f}' do not match the saved input")
+
+        merged = []
+        for key, result in zip(keys, chunk_results):
+            if result is None and key in results:
+                result = results[key]
+                filled.add(key)
+            merged.append(result)
+        save_output_data(prefix + f, merged, aws)
+
+    # Remove the items that were filled in from the failures
+    files = fs.glob(f"{output_folder}/{flavor}_failures.json") + fs.glob(
+        f"{output_folder}/chunks/{flavor}_failures_*.json"
+    )
+    for f in files:
+        failures = json.loads(fs.cat(f))
+        left = [r for r in failures if r["key"] not in filled]
+        if len(left) < len(failures):
+            save_output_data(prefix + f, left, aws)
+
+    return len(filled)
+
+
+def load_metrics(output_folder, aws):
+    """Load the timing metrics saved by each task of a run to an output folder."""
+
+    fs = get_filesystem(output_folder, aws)
+    fs.invalidate_cache()
+    files = fs.glob(f"{output_folder}/metrics.json") + fs.glob(
+        f"{output_folder}/chunks/metrics_*.json"
+    )
+    return [json.loads(fs.cat(f)) for f in files]
+
+
+def load_heartbeats(flavor, output_folder, aws):
+    """Load the latest progress reported by each process of a run."""
+
+    fs = get_filesystem(output_folder, aws)
+    fs.invalidate_cache()
+    files = fs.glob(f"{output_folder}/heartbeats/{flavor}_*.json")
+    return [json.loads(fs.cat(f)) for f in files]
+
+
+def save_output_stream(outfile, records, aws):
+    """
+    Save results to a JSON array one record at a time.
+
+    This avoids holding all of the results in memory at once.
+    """
+
+    # Make sure local output folder exists
+    if not outfile.startswith("s3://"):
+        p = Path(outfile)
+        if not p.parent.exists():
+            p.parent.mkdir(parents=True)
+
+    # Write the data
+    N = 0
+    with get_filesystem(outfile, aws).open(outfile, "w") as ff:
+        ff.write("[")
+        for result in records:
+            if N:
+                ff.write(",")
+            ff.write(json.dumps(result, ignore_nan=True))
+            N += 1
+        ff.write("]")
+
+    return N
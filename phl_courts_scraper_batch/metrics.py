@@ -0,0 +1,191 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+import simplejson as json
+
+from . import CMD
+
+# Upper bounds of the latency histogram buckets (in seconds); these are
+# log-spaced from 1 ms to ~1 hour, with 10 buckets per decade
+BUCKETS = [round(10 ** (k / 10), 6) for k in range(-30, 36)]
+
+
+class Histogram:
+    """A latency histogram with fixed, log-spaced buckets."""
+
+    def __init__(self, counts=None, total=0.0, minimum=None, maximum=None):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        """Add a value to the histogram."""
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def merge(self, other):
+        """Merge another histogram into this one."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        for attr, func in [("minimum", min), ("maximum", max)]:
+            values = [
+                v for v in [getattr(self, attr), getattr(other, attr)] if v is not None
+            ]
+            setattr(self, attr, func(values) if values else None)
+
+    def percentile(self, q):
+        """Estimate a percentile (0-100) from the bucket counts."""
+
+        count = self.count
+        if not count:
+            return None
+
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= q / 100 * count:
+                bound = BUCKETS[i] if i < len(BUCKETS) else self.maximum
+                return min(max(bound, self.minimum), self.maximum)
+
+    def to_dict(self):
+        return {
+            "counts": self.counts,
+            "total": self.total,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["counts"], d["total"], d["minimum"], d["maximum"])
+
+
+class Metrics:
+    """
+    Latency histograms and counters for the phases of a scraping run.
+
+    Parameters
+    ----------
+    dimensions : optional
+        Extra info identifying the run, e.g., the flavor and chunk
+    """
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dimensions or {}
+        self.histograms = {}
+        self.counters = {}
+        self.start = time.time()
+
+    def observe(self, phase, seconds):
+        """Record the duration of a phase."""
+        self.histograms.setdefault(phase, Histogram()).observe(seconds)
+
+    def increment(self, name, n=1):
+        """Increment a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        """Merge the histograms and counters of other metrics into these."""
+        for phase, h in other.histograms.items():
+            self.histograms.setdefault(phase, Histogram()).merge(h)
+        for name, n in other.counters.items():
+            self.increment(name, n)
+
+    @contextmanager
+    def timer(self, phase):
+        """Time a phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def to_dict(self):
+        return {
+            "dimensions": self.dimensions,
+            "elapsed": time.time() - self.start,
+            "counters": self.counters,
+            "histograms": {k: v.to_dict() for k, v in self.histograms.items()},
+        }
+
+    def to_emf(self):
+        """
+        Format the metrics as a CloudWatch embedded metric format (EMF) log line.
+        """
+
+        metrics = {}
+        for phase, h in self.histograms.items():
+            values = [
+                BUCKETS[i] if i < len(BUCKETS) else h.maximum
+                for i, n in enumerate(h.counts)
+                if n
+            ]
+            metrics[phase] = (
+                {"Values": values, "Counts": [n for n in h.counts if n]},
+                "Seconds",
+            )
+        for name, n in self.counters.items():
+            metrics[name] = (n, "Count")
+
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": CMD,
+                        "Dimensions": [sorted(self.dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, (_, unit) in metrics.items()
+                        ],
+                    }
+                ],
+            },
+            **{k: str(v) for k, v in self.dimensions.items()},
+            **{name: value for name, (value, _) in metrics.items()},
+        }
+        return json.dumps(record)
+
+
+def summarize_metrics(records):
+    """
+    Aggregate the saved metrics from each chunk.
+
+    Returns a dict of per-phase latency percentiles, the combined counters,
+    and the items per second for each chunk.
+    """
+
+    histograms = {}
+    counters = {}
+    rates = {}
+    for record in records:
+        for phase, d in record["histograms"].items():
+            histograms.setdefault(phase, Histogram()).merge(Histogram.from_dict(d))
+        for name, n in record["counters"].items():
+            counters[name] = counters.get(name, 0) + n
+
+        chunk = record["dimensions"].get("chunk")
+        items = record["counters"].get("items", 0)
+        rates[chunk] = items / record["elapsed"] if record["elapsed"] else None
+
+    phases = {
+        phase: {
+            "count": h.count,
+            "mean": h.total / h.count if h.count else None,
+            "p50": h.percentile(50),
+            "p90": h.percentile(90),
+            "p99": h.percentile(99),
+            "max": h.maximum,
+        }
+        for phase, h in sorted(histograms.items())
+    }
+
+    return {"phases": phases, "counters": counters, "items_per_second": rates}
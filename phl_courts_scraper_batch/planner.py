@@ -0,0 +1,173 @@
+import math
+import time
+from pathlib import Path
+
+import simplejson as json
+
+from . import CMD, io
+
+# The local store of past runs
+DEFAULT_HISTORY = Path.home() / f".{CMD}" / "history.json"
+
+# The most tasks the planner will recommend
+MAX_TASKS = 500
+
+
+def summarize_run(output_folder, aws):
+    """
+    Summarize the throughput of a past run from its saved configs and metrics.
+
+    The cost of each item is measured in task-seconds, and the fixed cost of
+    each task (loading the input, starting the browser, and saving the
+    output) is measured separately.
+    """
+
+    config = io.load_run_config(output_folder, aws)
+    records = io.load_metrics(output_folder, aws)
+    if not records:
+        raise ValueError(f"No saved metrics found in '{output_folder}'")
+
+    # Per-task fixed costs
+    overhead = []
+    for record in records:
+        histograms = record["histograms"]
+        overhead.append(
+            sum(
+                histograms[phase]["total"]
+                for phase in ["load_input", "browser_startup", "save_output"]
+                if phase in histograms
+            )
+        )
+
+    elapsed = sum(record["elapsed"] for record in records)
+    return {
+        "output_folder": output_folder,
+        "flavor": config["flavor"],
+        "sleep": config["sleep"],
+        "sessions": config.get("sessions", 1),
+        "ntasks": len(records),
+        "items": sum(record["counters"].get("items", 0) for record in records),
+        "scrape_seconds": elapsed - sum(overhead),
+        "overhead_seconds": sum(overhead) / len(overhead),
+        "recorded_at": time.time(),
+    }
+
+
+def load_history(path=DEFAULT_HISTORY):
+    """Load the past runs from the history, returning an empty list if missing."""
+
+    path = Path(path)
+    if not path.exists():
+        return []
+    return json.loads(path.read_text())
+
+
+def record_runs(output_folders, aws, path=DEFAULT_HISTORY):
+    """Add past runs to the history, replacing any earlier records of them."""
+
+    history = load_history(path)
+    for output_folder in output_folders:
+        summary = summarize_run(output_folder, aws)
+        history = [h for h in history if h["output_folder"] != output_folder]
+        history.append(summary)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(history, indent=2))
+    return history
+
+
+def estimate_cost(history, flavor, sleep=None, sessions=None):
+    """
+    Estimate the cost per item (in task-seconds) and the fixed cost per task
+    from past runs of a flavor.
+
+    If there are past runs with the same sleep (or number of browser
+    sessions), only those are used.
+    """
+
+    runs = [h for h in history if h["flavor"] == flavor and h["items"] > 0]
+    if sleep is not None and any(h["sleep"] == sleep for h in runs):
+        runs = [h for h in runs if h["sleep"] == sleep]
+    if sessions is not None and any(h.get("sessions", 1) == sessions for h in runs):
+        runs = [h for h in runs if h.get("sessions", 1) == sessions]
+    if not runs:
+        raise ValueError(f"No past runs of flavor '{flavor}' in the history")
+
+    # Weight each run by its number of items (or tasks)
+    per_item = sum(h["scrape_seconds"] for h in runs) / sum(h["items"] for h in runs)
+    overhead = sum(h["overhead_seconds"] * h["ntasks"] for h in runs) / sum(
+        h["ntasks"] for h in runs
+    )
+    return per_item, overhead
+
+
+def plan(
+    flavor,
+    nitems,
+    deadline,
+    history,
+    sleep=None,
+    sessions=None,
+    vcpus=1,
+    max_tasks=MAX_TASKS,
+):
+    """
+    Plan a run: the number of tasks needed to scrape the items by a deadline.
+
+    Parameters
+    ----------
+    flavor :
+        The kind of data to scrape
+    nitems :
+        The number of items to scrape
+    deadline :
+        The target wall-clock time for the run (in hours)
+    history :
+        The past runs
+    sleep : optional
+        The sleep between scraping calls for the new run
+    sessions : optional
+        The number of browser sessions per task for the new run
+    vcpus : optional
+        The number of vCPUs per task
+    max_tasks : optional
+        The most tasks to use
+
+    Returns
+    -------
+    plan : dict
+        The recommended number of tasks, the expected wall-clock time (in
+        hours), and the total vCPU-hours
+    """
+
+    per_item, overhead = estimate_cost(history, flavor, sleep=sleep, sessions=sessions)
+
+    # Tasks are needed for the scraping that fits after the fixed costs
+    budget = deadline * 3600 - overhead
+    if budget > 0:
+        ntasks = math.ceil(nitems * per_item / budget)
+    else:
+        ntasks = max_tasks
+    ntasks = min(max(ntasks, 1), max_tasks, max(nitems, 1))
+
+    # Items are split evenly between tasks
+    wall = overhead + math.ceil(nitems / ntasks) * per_item
+    return {
+        "flavor": flavor,
+        "items": nitems,
+        "ntasks": ntasks,
+        "seconds_per_item": per_item,
+        "overhead_seconds": overhead,
+        "hours": wall / 3600,
+        "vcpu_hours": ntasks * vcpus * wall / 3600,
+        "meets_deadline": wall <= deadline * 3600,
+    }
+
+
+def count_items(flavor, input_filename, aws, sample=None):
+    """Count the unique items to scrape in an input file."""
+
+    data = io.load_input_data(flavor=flavor, input_filename=input_filename, aws=aws)
+    nitems = io.get_keys(data, flavor).nunique()
+    return min(nitems, sample) if sample is not None else nitems
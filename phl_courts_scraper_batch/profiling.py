@@ -0,0 +1,212 @@
+import cProfile
+import functools
+import inspect
+import pstats
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import simplejson as json
+
+from . import io
+
+# The profiler of the run in progress, if it is being profiled
+_active = None
+
+
+class Profiler:
+    """
+    A CPU profile (cProfile) and the peak memory (tracemalloc) of a run.
+
+    While the profiler runs, each `io` function is also timed and its peak
+    memory recorded, so the cost of loading and saving data can be told
+    apart from scraping. Only the thread that starts the profiler is
+    profiled; profiling slows the run down.
+    """
+
+    def __init__(self):
+        self.cpu = cProfile.Profile()
+        self.functions = {}
+        self.peak = 0
+        self.running = False
+        self._stack = []
+        self._originals = {}
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Start profiling, and instrument the `io` functions."""
+
+        self._thread = threading.get_ident()
+        tracemalloc.start()
+        for name, func in vars(io).items():
+            if (
+                inspect.isfunction(func)
+                and func.__module__ == io.__name__
+                and not name.startswith("_")
+                and not inspect.isgeneratorfunction(func)
+            ):
+                self._originals[name] = func
+                setattr(io, name, self._instrument(name, func))
+        self.running = True
+        self.cpu.enable()
+
+    def stop(self):
+        """Stop profiling, and restore the `io` functions."""
+
+        if not self.running:
+            return
+        self.cpu.disable()
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        for name, func in self._originals.items():
+            setattr(io, name, func)
+        self.running = False
+
+    def _instrument(self, name, func):
+        """Wrap an `io` function to record its time and peak memory."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if threading.get_ident() != self._thread:
+                return func(*args, **kwargs)
+
+            # Measure from a fresh peak, keeping the peak so far
+            current, peak = tracemalloc.get_traced_memory()
+            self._fold_peak(peak)
+            tracemalloc.reset_peak()
+            self._stack.append([current, current])
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                frame = self._stack.pop()
+                frame[1] = max(frame[1], tracemalloc.get_traced_memory()[1])
+                self._fold_peak(frame[1])
+
+                stats = self.functions.setdefault(
+                    name, {"calls": 0, "seconds": 0.0, "peak_bytes": 0}
+                )
+                stats["calls"] += 1
+                stats["seconds"] += seconds
+                stats["peak_bytes"] = max(stats["peak_bytes"], frame[1] - frame[0])
+
+        return wrapper
+
+    def _fold_peak(self, peak):
+        """Add a peak to the run and to the `io` functions in progress."""
+        self.peak = max(self.peak, peak)
+        for frame in self._stack:
+            frame[1] = max(frame[1], peak)
+
+    def memory(self):
+        """The peak memory of the run, and of each `io` function."""
+        return {"peak_bytes": self.peak, "functions": self.functions}
+
+    def save(self, folder, label, aws):
+        """
+        Save the CPU profile and memory report to a folder.
+
+        These are saved as 'profile_{label}.prof' (for pstats or snakeviz)
+        and 'memory_{label}.json', or without the label if it is None.
+        """
+
+        self.stop()
+        suffix = "" if label is None else f"_{label}"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = f"{tmpdir}/profile.prof"
+            self.cpu.dump_stats(path)
+            remote_path = f"{folder}/profile{suffix}.prof"
+            fs = io.get_filesystem(remote_path, aws)
+            if fs is aws.local:
+                fs.makedirs(folder, exist_ok=True)
+            fs.put(path, remote_path)
+
+        io.save_output_data(f"{folder}/memory{suffix}.json", self.memory(), aws=aws)
+
+
+def profiled(func):
+    """
+    Profile a function when it is called with `profile=True`.
+
+    The function can save the profile with `save_active()` once it knows
+    where; the profiler is stopped when the function returns or raises.
+    """
+
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _active
+
+        # Runs nested in a profiled run are covered by its profile
+        profile = signature.bind(*args, **kwargs).arguments.get("profile")
+        if not profile or _active is not None:
+            return func(*args, **kwargs)
+
+        _active = Profiler()
+        try:
+            with _active:
+                return func(*args, **kwargs)
+        finally:
+            _active = None
+
+    return wrapper
+
+
+def save_active(folder, label, aws):
+    """Save the profile of the run in progress, if it is being profiled."""
+    if _active is not None:
+        _active.save(folder, label, aws)
+
+
+def merge_profiles(output_folder, aws):
+    """
+    Merge the profiles saved by each chunk of a run (and its combine step).
+
+    Returns the merged CPU profile as `pstats.Stats`, and a memory report
+    with the largest peak of the run and of each `io` function, and the
+    peak of each chunk.
+    """
+
+    fs = io.get_filesystem(output_folder, aws)
+    fs.invalidate_cache()
+    folders = [output_folder, f"{output_folder}/chunks"]
+    profiles = [f for folder in folders for f in fs.glob(f"{folder}/profile*.prof")]
+    reports = [f for folder in folders for f in fs.glob(f"{folder}/memory*.json")]
+    if not profiles:
+        raise ValueError(f"No saved profiles found in '{output_folder}'")
+
+    # The CPU profiles
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i, f in enumerate(profiles):
+            paths.append(f"{tmpdir}/{i}.prof")
+            fs.get(f, paths[-1])
+        stats = pstats.Stats(*paths)
+
+    # The memory reports
+    memory = {"peak_bytes": 0, "functions": {}, "chunks": {}}
+    for f in reports:
+        report = json.loads(fs.cat(f))
+        name = f.split("/")[-1][len("memory") : -len(".json")].lstrip("_") or "all"
+        memory["chunks"][name] = report["peak_bytes"]
+        memory["peak_bytes"] = max(memory["peak_bytes"], report["peak_bytes"])
+        for func, d in report["functions"].items():
+            merged = memory["functions"].setdefault(
+                func, {"calls": 0, "seconds": 0.0, "peak_bytes": 0}
+            )
+            merged["calls"] += d["calls"]
+            merged["seconds"] += d["seconds"]
+            merged["peak_bytes"] = max(merged["peak_bytes"], d["peak_bytes"])
+
+    return stats, memory
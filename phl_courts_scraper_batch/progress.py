@@ -0,0 +1,266 @@
+import math
+import time
+
+import simplejson as json
+from loguru import logger
+
+from . import io
+from .work_queue import get_lease_backend
+
+# Heartbeats older than this are from tasks that are stuck or gone (in seconds)
+STALE_AFTER = 900
+
+# Running tasks expected to take longer than this are split (in seconds)
+STRAGGLER_MIN_ETA = 600
+
+# The most helper tasks to hand off the tail of a straggler's chunk to
+MAX_SPLITS = 4
+
+# How long a straggler waits for a helper to acknowledge the items handed off
+# to it before scraping them itself (in seconds)
+ACK_TIMEOUT = 900
+
+
+def get_remaining(heartbeat):
+    """The number of items a task has left, if known."""
+
+    if heartbeat.get("total") is None:
+        return None
+    return max(
+        heartbeat["total"]
+        - heartbeat["done"]
+        - heartbeat["failed"]
+        - heartbeat["handed_off"],
+        0,
+    )
+
+
+def get_eta(heartbeat):
+    """The expected time for a task to finish (in seconds), if known."""
+
+    remaining = get_remaining(heartbeat)
+    if heartbeat["status"] != "running":
+        return 0
+    if remaining is None or not heartbeat.get("rate"):
+        return None
+    return remaining / heartbeat["rate"]
+
+
+def is_stale(heartbeat, now=None, stale_after=STALE_AFTER):
+    """Whether a running task has not reported progress recently."""
+
+    now = time.time() if now is None else now
+    return (
+        heartbeat["status"] == "running" and now - heartbeat["updated_at"] > stale_after
+    )
+
+
+def summarize_heartbeats(heartbeats, now=None, stale_after=STALE_AFTER):
+    """
+    Aggregate the progress reported by the tasks of a run.
+
+    Returns the number of tasks in each state, the items done and left, the
+    fleet's throughput (items per second), and two ETAs (in seconds): when
+    the slowest task is expected to finish, and when all of the items left
+    would be done at the fleet's current rate.
+    """
+
+    now = time.time() if now is None else now
+    live = [
+        h
+        for h in heartbeats
+        if h["status"] == "running" and not is_stale(h, now, stale_after)
+    ]
+
+    statuses = {}
+    for h in heartbeats:
+        status = "stale" if is_stale(h, now, stale_after) else h["status"]
+        statuses[status] = statuses.get(status, 0) + 1
+
+    remaining = [get_remaining(h) for h in heartbeats if h["status"] == "running"]
+    remaining = None if None in remaining else sum(remaining)
+    rate = sum(h["rate"] or 0 for h in live)
+    etas = [get_eta(h) for h in live]
+
+    return {
+        "tasks": statuses,
+        "done": sum(h["done"] for h in heartbeats),
+        "failed": sum(h["failed"] for h in heartbeats),
+        "remaining": remaining,
+        "items_per_second": rate,
+        "eta": None if None in etas else max(etas, default=0),
+        "fleet_eta": remaining / rate if remaining is not None and rate else None,
+    }
+
+
+def find_stragglers(
+    heartbeats, now=None, min_eta=STRAGGLER_MIN_ETA, stale_after=STALE_AFTER
+):
+    """
+    Find the tasks holding up a run, and how many helpers to split each between.
+
+    Once at least half of the tasks have finished, a live task whose ETA is
+    over `min_eta` is a straggler. Only tasks scraping a fixed chunk that
+    have not been split already (and are not helpers themselves) are split.
+    """
+
+    now = time.time() if now is None else now
+    static = [h for h in heartbeats if h.get("total") is not None]
+    finished = [h for h in static if h["status"] == "finished"]
+    if not static or len(finished) < len(static) / 2:
+        return []
+
+    stragglers = []
+    for h in static:
+        if (
+            h["status"] != "running"
+            or is_stale(h, now, stale_after)
+            or h.get("split_of") is not None
+            or h["handed_off"]
+        ):
+            continue
+
+        eta = get_eta(h)
+        if eta is not None and eta > min_eta:
+            nsplits = min(MAX_SPLITS, max(math.ceil(eta / min_eta) - 1, 1))
+            stragglers.append((h, nsplits))
+
+    return stragglers
+
+
+def load_split(flavor, output_folder, label, aws):
+    """Load the request for a task to split its chunk, or None if there isn't one."""
+
+    path = io.get_split_path(flavor, output_folder, label)
+    fs = io.get_filesystem(path, aws)
+    try:
+        return json.loads(fs.cat(path))
+    except FileNotFoundError:
+        return None
+
+
+def clear_split(flavor, output_folder, label, aws):
+    """Remove any request for a task to split its chunk left by an earlier run."""
+
+    path = io.get_split_path(flavor, output_folder, label)
+    fs = io.get_filesystem(path, aws)
+    try:
+        fs.rm(path)
+    except FileNotFoundError:
+        pass
+
+    acks_folder = io.get_acks_folder(flavor, output_folder, label)
+    if fs.exists(acks_folder):
+        fs.rm(acks_folder, recursive=True)
+
+
+def load_ack(flavor, output_folder, label, helper, aws):
+    """Load whether a helper took the items handed off to it, or None if undecided."""
+
+    acks = get_lease_backend(io.get_acks_folder(flavor, output_folder, label), aws)
+    data, _ = acks.read(f"helper_{helper}")
+    return None if data is None else json.loads(data)["status"]
+
+
+def settle_hand_off(flavor, output_folder, label, helper, status, aws):
+    """
+    Settle who scrapes the items handed off to a helper, returning the outcome.
+
+    The helper records that it "acked" the items, and the task that handed
+    them off that it "reclaimed" them once the helper is too late. Whichever
+    is recorded first stands, so the items are scraped by exactly one.
+    """
+
+    acks = get_lease_backend(io.get_acks_folder(flavor, output_folder, label), aws)
+    data = json.dumps({"status": status, "settled_at": time.time()})
+    if acks.create(f"helper_{helper}", data) is None:
+        status = load_ack(flavor, output_folder, label, helper, aws)
+    return status
+
+
+def reclaim_hand_offs(flavor, output_folder, label, aws, poll=10, timeout=ACK_TIMEOUT):
+    """
+    Wait for helpers to acknowledge the items a task handed off to them.
+
+    Returns the items of the helpers that did not acknowledge them within
+    `timeout` seconds of the hand-off, which the task must scrape itself.
+    """
+
+    split = load_split(flavor, output_folder, label, aws)
+    if split is None or "assigned" not in split:
+        return []
+
+    pending = {helper: keys for helper, keys in split["assigned"].items() if keys}
+    deadline = split.get("assigned_at", 0) + timeout
+    reclaimed = []
+    while True:
+        for helper in list(pending):
+            status = load_ack(flavor, output_folder, label, helper, aws)
+            if status is None and time.time() >= deadline:
+                status = settle_hand_off(
+                    flavor, output_folder, label, helper, "reclaimed", aws
+                )
+            if status == "reclaimed":
+                logger.warning(f"Process #{helper} did not take its items in time")
+                reclaimed += pending.pop(helper)
+            elif status == "acked":
+                pending.pop(helper)
+
+        if not pending:
+            return reclaimed
+        time.sleep(max(min(poll, deadline - time.time()), 0))
+
+
+def request_split(flavor, output_folder, label, helpers, aws):
+    """
+    Ask a task to hand off the tail of its chunk to helper tasks.
+
+    The task picks the items to hand off when it next reports progress, so
+    no item is scraped by both.
+    """
+
+    path = io.get_split_path(flavor, output_folder, label)
+    io.save_output_data(path, {"helpers": helpers, "requested_at": time.time()}, aws)
+
+
+def wait_for_split(flavor, output_folder, label, helper, aws, poll=10, timeout=900):
+    """
+    Wait for a task to hand off items to a helper, returning the items.
+
+    If the task finishes (or stops reporting progress) before handing off
+    any items, or takes them back because this helper was too late to
+    acknowledge them, this returns an empty list.
+    """
+
+    heartbeat_path = io.get_heartbeat_path(flavor, output_folder, label)
+    fs = io.get_filesystem(heartbeat_path, aws)
+    stopped = False
+    while True:
+        split = load_split(flavor, output_folder, label, aws)
+        if split is not None and "assigned" in split:
+            assigned = split["assigned"].get(str(helper), [])
+            status = "acked"
+            if assigned:
+                status = settle_hand_off(
+                    flavor, output_folder, label, helper, "acked", aws
+                )
+            if status == "reclaimed":
+                logger.info(f"Process #{label} took back the items handed off")
+                return []
+            return assigned
+
+        # Check the split once more after the task stops, in case it handed
+        # off items just before
+        if stopped:
+            logger.info(f"Process #{label} stopped before handing off any items")
+            return []
+
+        try:
+            heartbeat = json.loads(fs.cat(heartbeat_path))
+        except FileNotFoundError:
+            heartbeat = None
+        stopped = heartbeat is not None and (
+            heartbeat["status"] != "running" or is_stale(heartbeat, stale_after=timeout)
+        )
+        if not stopped:
+            time.sleep(poll)
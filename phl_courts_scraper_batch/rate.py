@@ -0,0 +1,188 @@
+import time
+from collections import deque
+
+import simplejson as json
+from loguru import logger
+
+from . import io
+
+
+class SharedRateState:
+    """
+    The rate budget shared by all tasks, stored as a small JSON object.
+
+    Parameters
+    ----------
+    path :
+        The path to the JSON object (local or s3)
+    aws :
+        The AWS connection
+    """
+
+    def __init__(self, path, aws):
+        self.path = path
+        self.aws = aws
+
+    def read(self):
+        """Read the shared state, returning an empty dict if it is missing."""
+        fs = io.get_filesystem(self.path, self.aws)
+        try:
+            return json.loads(fs.cat(self.path))
+        except FileNotFoundError:
+            return {}
+
+    def write(self, state):
+        """Write the shared state."""
+        io.save_output_data(self.path, state, aws=self.aws)
+
+
+class RateController:
+    """
+    Adaptive rate control for scraping calls, with a circuit breaker.
+
+    Calls are paced by a token bucket whose rate is adjusted with AIMD:
+    the rate increases additively after each healthy call, and decreases
+    multiplicatively after an error or a call that is much slower than
+    usual. If the error rate over recent calls spikes, the circuit breaker
+    opens and calls are paused for a cooldown period.
+
+    Parameters
+    ----------
+    rate : optional
+        The initial rate (calls per second)
+    min_rate : optional
+        The minimum rate (calls per second)
+    max_rate : optional
+        The maximum rate (calls per second)
+    increase : optional
+        How much to increase the rate after a healthy call
+    decrease : optional
+        The factor to decrease the rate by after an unhealthy call
+    latency_factor : optional
+        Calls slower than this multiple of the average latency are unhealthy
+    window : optional
+        The number of recent calls used to measure the error rate
+    error_threshold : optional
+        The error rate that opens the circuit breaker
+    cooldown : optional
+        How long to pause when the circuit breaker opens (in seconds)
+    state : optional
+        If provided, the rate budget and circuit breaker are shared by all
+        tasks through this state
+    nprocs : optional
+        The number of tasks sharing the state
+    sync_interval : optional
+        How often to sync with the shared state (in seconds)
+    """
+
+    def __init__(
+        self,
+        rate=0.5,
+        min_rate=0.02,
+        max_rate=1.0,
+        increase=0.02,
+        decrease=0.5,
+        latency_factor=2.0,
+        window=20,
+        error_threshold=0.5,
+        cooldown=300,
+        state=None,
+        nprocs=1,
+        sync_interval=60,
+    ):
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.state = state
+        self.nprocs = nprocs
+        self.sync_interval = sync_interval
+
+        self.outcomes = deque(maxlen=window)
+        self.latency = None
+        self.paused_until = 0
+        self.next_call = time.monotonic()
+        self.last_sync = None
+        self.decreased = False
+
+    def wait(self):
+        """Wait until the next call is allowed."""
+
+        # Sync with the other tasks
+        if self.state is not None and (
+            self.last_sync is None or time.time() - self.last_sync > self.sync_interval
+        ):
+            self._sync()
+
+        # Wait for the circuit breaker to close
+        pause = self.paused_until - time.time()
+        if pause > 0:
+            logger.warning(f"Circuit breaker open; pausing for {pause:.0f} seconds")
+            time.sleep(pause)
+
+        # Wait for a token
+        now = time.monotonic()
+        if self.next_call > now:
+            time.sleep(self.next_call - now)
+        self.next_call = max(now, self.next_call) + 1 / self.rate
+
+    def record(self, latency, error=False):
+        """Record the outcome of a call and adjust the rate."""
+
+        # Unhealthy calls are errors or calls much slower than average
+        slow = self.latency is not None and latency > self.latency_factor * self.latency
+        if not error:
+            self.latency = (
+                latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+            )
+
+        # AIMD
+        if error or slow:
+            self.rate = max(self.rate * self.decrease, self.min_rate)
+            self.decreased = True
+        else:
+            self.rate = min(self.rate + self.increase, self.max_rate)
+
+        # Open the circuit breaker if errors spike
+        self.outcomes.append(error)
+        if (
+            len(self.outcomes) == self.outcomes.maxlen
+            and sum(self.outcomes) / len(self.outcomes) >= self.error_threshold
+        ):
+            logger.warning(
+                f"Error rate over the last {len(self.outcomes)} calls is too high; "
+                "opening the circuit breaker"
+            )
+            self.paused_until = time.time() + self.cooldown
+            self.rate = self.min_rate
+            self.outcomes.clear()
+            if self.state is not None:
+                self._sync()
+
+    def _sync(self):
+        """Share this task's rate adjustments and pauses with the other tasks."""
+
+        shared = self.state.read()
+        fleet_rate = shared.get("rate", self.rate * self.nprocs)
+
+        # Decreases are applied to the whole fleet; otherwise increase it
+        if self.decreased:
+            fleet_rate *= self.decrease
+        elif self.last_sync is not None:
+            fleet_rate += self.increase
+        fleet_rate = min(
+            max(fleet_rate, self.min_rate * self.nprocs), self.max_rate * self.nprocs
+        )
+
+        paused_until = max(shared.get("paused_until", 0), self.paused_until)
+        self.state.write({"rate": fleet_rate, "paused_until": paused_until})
+
+        # This task gets its share of the fleet's budget
+        self.rate = fleet_rate / self.nprocs
+        self.paused_until = paused_until
+        self.decreased = False
+        self.last_sync = time.time()
@@ -1,18 +1,262 @@
 import inspect
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import ExitStack
+from pathlib import Path
+from queue import SimpleQueue
 
-import numpy as np
+import pandas as pd
 from loguru import logger
 from phl_courts_scraper.court_summary import CourtSummaryParser
 
 # from phl_courts_scraper.docket_sheet import DocketSheetParser
 from phl_courts_scraper.portal import UJSPortalScraper
+from selenium.common.exceptions import WebDriverException
 
-from . import io
+from . import io, profiling, progress
 from .aws import AWS
+from .cache import get_result_cache
+from .download import DownloadWatcher, downloaded_pdf
+from .metrics import Metrics
+from .rate import RateController, SharedRateState
+from .work_queue import WorkQueue, get_lease_backend
+
+# The base domain for court summary URLs
+PORTAL_URL = "https://ujsportal.pacourts.us"
+
+# The court summary parser in each parser worker process
+_parser = None
+
+# How many times to restart a crashed browser while downloading one item
+BROWSER_RESTARTS = 3
+
+# The exit code of a task that was stopped with SIGTERM
+PREEMPTED_EXIT_CODE = 128 + signal.SIGTERM
+
+
+class Preempted(SystemExit):
+    """Raised when the task is asked to stop, e.g., by a Spot interruption."""
+
+
+class _KeyQueue:
+    """The keys a task has left to scrape, in order; the tail can be handed off."""
+
+    def __init__(self, keys):
+        self.keys = deque(keys)
+        self.total = len(self.keys)
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        while self.keys:
+            yield self.keys.popleft()
+
+    def split(self, n):
+        """Remove the tail of the keys in `n` equal parts, keeping one part."""
+        share = len(self.keys) // (n + 1)
+        tail = [self.keys.pop() for _ in range(n * share)][::-1]
+        return [tail[i * share : (i + 1) * share] for i in range(n)]
+
+    def discard(self, keys):
+        """Remove keys that were handed off earlier."""
+        self.keys = deque(k for k in self.keys if str(k) not in keys)
+
+
+def _with_downloaded_pdf(
+    scraper, key, watcher, handle, interval=1, time_limit=20, metrics=None
+):
+    """
+    Download the court summary for a key, returning `handle(pdf_path)`.
+
+    The browser is started if needed, downloading to the watcher's folder.
+    If it crashes, it is restarted after a backoff and the download is tried
+    again (up to `BROWSER_RESTARTS` times), so one crash does not fail every
+    remaining item in the task.
+    """
+
+    # Time each phase
+    if metrics is None:
+        metrics = Metrics()
+
+    for attempt in range(BROWSER_RESTARTS + 1):
+        try:
+            # Initialize the browser, downloading to our folder
+            if not hasattr(scraper, "driver"):
+                with metrics.timer("browser_startup"):
+                    scraper._init(str(watcher.folder))
+
+            with downloaded_pdf(
+                scraper.driver,
+                PORTAL_URL + key,
+                watcher,
+                interval=interval,
+                time_limit=time_limit,
+                metrics=metrics,
+            ) as pdf_path:
+                return handle(pdf_path)
+        except WebDriverException as e:
+            # Drop the broken browser, so it is started again
+            if hasattr(scraper, "driver"):
+                try:
+                    scraper.driver.quit()
+                except Exception:
+                    pass
+                del scraper.driver
+            if attempt == BROWSER_RESTARTS:
+                raise
+
+            wait = min(
+                scraper.min_sleep + 2**attempt + random.random(), scraper.max_sleep
+            )
+            logger.warning(f"Restarting the browser in {wait:.0f} seconds: {e}")
+            metrics.increment("browser_restarts")
+            time.sleep(wait)
+
+
+def _scrape_item(
+    scraper,
+    flavor,
+    key,
+    watcher=None,
+    sleep=7,
+    interval=1,
+    time_limit=20,
+    metrics=None,
+):
+    """
+    Scrape a single key, returning the result.
+
+    Court summaries are downloaded to the folder of the download watcher.
+    """
+
+    # Time each phase
+    if metrics is None:
+        metrics = Metrics()
+
+    # Extract info from the UJS portal
+    if flavor == "portal":
+        with metrics.timer("search"):
+            results = scraper.scrape_portal_data([key])
+        return results[0] if len(results) else None
+
+    # Extract info from PDFs
+    elif flavor == "court_summary":
+
+        # Download and parse the report
+        def parse(pdf_path):
+            with metrics.timer("parse"):
+                return scraper(pdf_path)
+
+        report = _with_downloaded_pdf(
+            scraper,
+            key,
+            watcher,
+            parse,
+            interval=interval,
+            time_limit=time_limit,
+            metrics=metrics,
+        )
+
+        # Sleep
+        with metrics.timer("sleep"):
+            time.sleep(sleep)
+
+        return report.to_dict()
+
+    else:
+        raise ValueError("'flavor' must be one of 'portal', 'court_summary'")
+
+
+def _download_item(
+    scraper,
+    key,
+    watcher,
+    staging_dir,
+    sleep=7,
+    interval=1,
+    time_limit=20,
+    metrics=None,
+):
+    """
+    Download the court summary for a key, returning its path.
+
+    The PDF is moved out of the download folder to the staging folder, where
+    it waits to be parsed.
+    """
+
+    # Time each phase
+    if metrics is None:
+        metrics = Metrics()
+
+    # Download the report
+    def stage(pdf_path):
+        path = Path(staging_dir) / f"{uuid.uuid4().hex}.pdf"
+        shutil.move(pdf_path, path)
+        return path
+
+    path = _with_downloaded_pdf(
+        scraper,
+        key,
+        watcher,
+        stage,
+        interval=interval,
+        time_limit=time_limit,
+        metrics=metrics,
+    )
+
+    # Sleep
+    with metrics.timer("sleep"):
+        time.sleep(sleep)
+
+    return str(path)
+
+
+def _init_parser(log_freq=50, errors="ignore"):
+    """Initialize the court summary parser in a parser worker process."""
+    global _parser
+    _parser = CourtSummaryParser(sleep=0, log_freq=log_freq, errors=errors)
+
+
+def _parse_pdf(pdf_path):
+    """Parse a court summary in a parser worker, returning the result and time."""
+
+    start = time.perf_counter()
+    try:
+        report = _parser(pdf_path)
+    finally:
+        os.remove(pdf_path)
+    return report.to_dict(), time.perf_counter() - start
+
+
+def _run_inline(fn, *args, **kwargs):
+    """Call a function now, returning its outcome as a finished future."""
+
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
 
 def _scrape(
-    data,
+    keys,
     flavor,
     search_by=None,
     sleep: int = 7,
@@ -22,65 +266,266 @@ def _scrape(
     interval: int = 1,
     time_limit: int = 20,
     debug=False,
+    cache=None,
+    refresh=False,
+    rate=None,
+    metrics=None,
+    parse_workers=0,
+    sessions=1,
 ):
-    """The actual scraping function."""
+    """
+    The actual scraping function.
 
-    # Extract info from the UJS portal
-    if flavor == "portal":
+    This yields a record with the key and result for each scraped key, or
+    with the key and error if scraping failed and errors are ignored. The
+    keys can be any iterable, including a generator; a key of None means
+    there is nothing to scrape yet, so the items in progress are finished.
 
-        # Initialize the scraper and run the analysis
-        if debug:
-            logger.debug(
-                f"Initializing portal scraper: search_by={search_by}, sleep={sleep}, log_freq={log_freq}, errors={errors}"
+    If a result cache is provided, cached results are used rather than
+    scraping again (unless `refresh` is True), and new results are cached.
+
+    If a rate controller is provided, it paces the scraping calls instead
+    of a fixed sleep.
+
+    The duration of each phase of scraping is recorded to `metrics`.
+
+    For court summaries, if `parse_workers` is positive, PDFs are parsed by
+    a pool of worker processes while the browser downloads the next ones.
+    At most two PDFs per worker wait to be parsed; downloading pauses when
+    the parsers fall behind, so disk and memory use stay bounded.
+
+    If `sessions` is more than 1, that many browser sessions scrape keys at
+    once on worker threads, each downloading to its own folder. Keys are
+    handed out (and the cache and rate controller are used) from the calling
+    thread, so records are yielded as sessions finish, not in key order.
+    """
+    if metrics is None:
+        metrics = Metrics()
+
+    # The rate controller replaces the fixed sleep
+    if rate is not None:
+        sleep = 0
+
+    if flavor not in ["portal", "court_summary"]:
+        raise ValueError("'flavor' must be one of 'portal', 'court_summary'")
+    if sessions < 1:
+        raise ValueError("'sessions' must be at least 1")
+
+    def new_scraper():
+        """Initialize a scraper, for one browser session."""
+        if flavor == "portal":
+            if debug:
+                logger.debug(
+                    f"Initializing portal scraper: search_by={search_by}, sleep={sleep}, log_freq={log_freq}, errors={errors}"
+                )
+            return UJSPortalScraper(
+                search_by=search_by,
+                sleep=sleep,
+                log_freq=log_freq,
+                errors="raise",
+                browser=browser,
+            )
+        else:
+            return CourtSummaryParser(
+                sleep=sleep,
+                log_freq=log_freq,
+                errors=errors,
+                browser=browser,
             )
-        scraper = UJSPortalScraper(
-            search_by=search_by,
-            sleep=sleep,
-            log_freq=log_freq,
-            errors="raise",
-            browser=browser,
-        )
 
-        if debug:
-            logger.debug(f"Scraping portal data for {len(data)} rows")
-        results = scraper.scrape_portal_data(data.values)
-        if debug:
-            logger.debug("...done")
+    # The number of keys, if known
+    N = len(keys) if hasattr(keys, "__len__") else "?"
+    if debug:
+        logger.debug(f"Scraping {flavor} data for {N} rows")
 
-    # Extract info from PDFs
-    elif flavor == "court_summary":
+    def failed(key, e):
+        """Handle an exception raised while scraping a key."""
+        metrics.increment("errors")
+        if errors == "raise":
+            logger.exception(f"Exception raised for key '{key}'")
+            raise e
+        logger.info(f"Ignoring exception for key '{key}': {str(e)}")
+        return {"key": key, "error": type(e).__name__, "message": str(e)}
 
-        # Prepend the base domain
-        urls = "https://ujsportal.pacourts.us" + data["court_summary_url"]
+    def succeeded(key, result):
+        """Cache the result for a key."""
+        if cache is not None:
+            with metrics.timer("cache_store"):
+                cache.set(key, result)
+        return {"key": key, "result": result}
 
-        # Initialize the scraper
-        scraper = CourtSummaryParser(
-            sleep=sleep,
-            log_freq=log_freq,
-            errors=errors,
-            browser=browser,
+    def parsed(key, start, future):
+        """Wait for a downloaded PDF to be parsed."""
+        try:
+            with metrics.timer("parse_wait"):
+                result, seconds = future.result()
+        except Exception as e:
+            metrics.observe("item", time.perf_counter() - start)
+            return failed(key, e)
+        metrics.observe("parse", seconds)
+        metrics.observe("item", time.perf_counter() - start)
+        return succeeded(key, result)
+
+    # Parse court summaries in parallel with the downloads
+    pool = None
+    pending = deque()
+    if flavor == "court_summary" and parse_workers > 0:
+        pool = ProcessPoolExecutor(
+            max_workers=parse_workers,
+            initializer=_init_parser,
+            initargs=(log_freq, errors),
         )
 
-        # Run the analysis
-        results = scraper.scrape_remote_urls(
-            urls, interval=interval, time_limit=time_limit
+    # Run the browser sessions on threads; a single session runs inline
+    executor = None
+    if sessions > 1:
+        executor = ThreadPoolExecutor(
+            max_workers=sessions, thread_name_prefix="session"
         )
 
-        # Add original info
-        # BROKEN
-        # if flavor == "bail":
-        #     out = data.to_dict(orient="records")
-        #     for i, row in enumerate(out):
-        #         url = urls[i]
-        #         row["bail"] = results[url]
-        #     results = out
+    # The browser sessions that are free, and the keys being scraped
+    idle = SimpleQueue()
+    inflight = {}
 
-    else:
-        raise ValueError("'flavor' must be one of 'portal', 'court_summary'")
+    def fetch(key, item_metrics, staging_dir):
+        """Scrape (or download) a key with a free browser session."""
+        scraper, watcher = idle.get()
+        try:
+            if pool is None:
+                return _scrape_item(
+                    scraper,
+                    flavor,
+                    key,
+                    watcher=watcher,
+                    sleep=sleep,
+                    interval=interval,
+                    time_limit=time_limit,
+                    metrics=item_metrics,
+                )
+            return _download_item(
+                scraper,
+                key,
+                watcher,
+                staging_dir,
+                sleep=sleep,
+                interval=interval,
+                time_limit=time_limit,
+                metrics=item_metrics,
+            )
+        finally:
+            idle.put((scraper, watcher))
+
+    def collect(block=True):
+        """Yield the records for keys that have finished scraping."""
+        finished, _ = wait(
+            inflight, timeout=None if block else 0, return_when=FIRST_COMPLETED
+        )
+        for future in [f for f in inflight if f in finished]:
+            key, start, item_metrics = inflight.pop(future)
+            metrics.merge(item_metrics)
+            try:
+                result = future.result()
+            except Exception as e:
+                metrics.observe("item", time.perf_counter() - start)
+                if rate is not None:
+                    rate.record(time.perf_counter() - start, error=True)
+                yield failed(key, e)
+                continue
+            if rate is not None:
+                rate.record(time.perf_counter() - start)
+
+            # Queue the PDF for parsing, and collect any parsed results;
+            # wait for the oldest one if the queue is full
+            if pool is not None:
+                pending.append((key, start, pool.submit(_parse_pdf, result)))
+                while pending and (
+                    len(pending) >= 2 * parse_workers or pending[0][2].done()
+                ):
+                    yield parsed(*pending.popleft())
+                continue
+
+            metrics.observe("item", time.perf_counter() - start)
+            yield succeeded(key, result)
+
+    # Loop over each key
+    scrapers = []
+    with tempfile.TemporaryDirectory() as download_dir, ExitStack() as stack:
+        staging_dir = Path(download_dir) / "parsing"
+        staging_dir.mkdir()
+        try:
+            # Each session downloads to its own folder
+            for n in range(sessions):
+                folder = Path(download_dir) / f"session-{n}"
+                folder.mkdir()
+                scrapers.append(new_scraper())
+                idle.put((scrapers[-1], stack.enter_context(DownloadWatcher(folder))))
+
+            i = -1
+            for key in keys:
+
+                # Nothing to scrape yet; finish the items in progress
+                if key is None:
+                    if inflight:
+                        yield from collect()
+                    elif pending:
+                        yield parsed(*pending.popleft())
+                    continue
+
+                # Log
+                i += 1
+                if i % log_freq == 0:
+                    logger.info(f"Scraping {i+1} of {N}: '{key}'")
+
+                # Check the cache first
+                if cache is not None and not refresh:
+                    with metrics.timer("cache_lookup"):
+                        hit, result = cache.get(key)
+                    if hit:
+                        metrics.increment("cache_hits")
+                        yield {"key": key, "result": result}
+                        continue
+
+                # Wait for a free session
+                while len(inflight) >= sessions:
+                    yield from collect()
 
-    return results
+                # Wait for our turn
+                if rate is not None:
+                    with metrics.timer("rate_wait"):
+                        rate.wait()
 
+                # Scrape
+                start = time.perf_counter()
+                item_metrics = Metrics()
+                args = (fetch, key, item_metrics, staging_dir)
+                if executor is None:
+                    future = _run_inline(*args)
+                else:
+                    future = executor.submit(*args)
+                inflight[future] = (key, start, item_metrics)
+                yield from collect(block=False)
 
+            # Collect the remaining results
+            while inflight:
+                yield from collect()
+            while pending:
+                yield parsed(*pending.popleft())
+        finally:
+            # Stop the sessions and the parsers
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+            # Close the browsers
+            for scraper in scrapers:
+                if hasattr(scraper, "driver"):
+                    scraper.driver.quit()
+            if executor is not None:
+                executor.shutdown()
+
+
+@profiling.profiled
 def scrape(
     flavor: str,
     input_filename: str,
@@ -98,10 +543,39 @@ def scrape(
     interval: int = 1,
     time_limit: int = 20,
     debug: bool = False,
+    resume: bool = False,
+    flush_freq: int = 50,
+    dynamic: bool = False,
+    batch_size: int = 25,
+    lease_timeout: int = 900,
+    queue_id: str = None,
+    cache: str = None,
+    cache_ttl: float = 7,
+    refresh: bool = False,
+    adaptive: bool = False,
+    max_rate: float = 1.0,
+    fleet: bool = False,
+    retries: int = 1,
+    retry_wait: int = 30,
+    emf: bool = False,
+    parse_workers: int = 0,
+    shards_folder: str = None,
+    sessions: int = 1,
+    split_of: int = None,
+    profile: bool = False,
 ):
     """
     Scrape court-related data from the specified source.
 
+    Results are flushed to append-only JSONL part files every `flush_freq`
+    items, and combined into the chunk's output file once scraping finishes.
+    The output has one result for each row of the chunk's saved input, in
+    the same order, with a null result for rows whose item failed. With a
+    shared work queue (`dynamic`), each batch is saved this way (under the
+    batch's id) before it is marked complete, so no completed batch is lost
+    if the task stops.
+    Progress is reported to a heartbeat file every `log_freq` items.
+
     Parameters
     ----------
     flavor :
@@ -113,13 +587,14 @@ def scrape(
     nprocs : optional
         The total number of processors running the scraper
     pid : optional
-        The id for this processor
+        The id for this processor; if `dynamic` is `True`, a negative id
+        means a unique id is assigned by the work queue
     dry_run : optional
         Do not save any results if `True`
     sample : optional
         Use a random sub-sample of the input data
     log_freq : optional
-        Log updates for every N requests
+        Log updates (and report progress) for every N requests
     seed : optional
         Set the random seed
     errors : optional
@@ -127,10 +602,69 @@ def scrape(
     sleep: optional
         How long to wait between scraping calls
     interval : optional
-        How long to wait when downloading PDFs before checking for success
+        The longest time to wait between checks for a finished PDF download;
+        on Linux, downloads are detected as soon as they finish
     time_limit : optional
         Total amount of time to wait when downloading PDFs
+    resume : optional
+        Skip keys that have already been saved to the output folder
+    flush_freq : optional
+        Save the results to the output folder every N items
+    dynamic : optional
+        Claim batches of work from a queue shared by all processes, rather
+        than scraping a fixed chunk of the data
+    batch_size : optional
+        The number of items in each batch of work when `dynamic` is `True`
+    lease_timeout : optional
+        How long a claimed batch of work is leased for (in seconds); leases
+        that expire (e.g., because a process died) are claimed again
+    queue_id : optional
+        The id of the shared work queue; processes working on the same run
+        should use the same id
+    cache : optional
+        The location of a cache of results shared across runs: either a
+        local SQLite file or an s3 folder
+    cache_ttl : optional
+        How long cached results are valid for (in days)
+    refresh : optional
+        Scrape every item again, rather than using cached results
+    adaptive : optional
+        Adapt the rate of scraping calls to the measured latency and errors,
+        starting from one call every `sleep` seconds, and pause when errors
+        spike
+    max_rate : optional
+        The maximum rate of scraping calls per process when `adaptive` is
+        `True` (calls per second)
+    fleet : optional
+        Share the rate budget and pauses across all processes when
+        `adaptive` is `True`
+    retries : optional
+        How many times to retry failed items at the end of the chunk
+    retry_wait : optional
+        How long to wait before the first retry (in seconds); this doubles
+        for each retry
+    emf : optional
+        Also log the run's metrics in CloudWatch embedded metric format
+    parse_workers : optional
+        The number of processes parsing court summaries while the browser
+        downloads the next ones; if 0, each PDF is parsed right after it is
+        downloaded
+    shards_folder : optional
+        The folder with the input data split into one shard per process
+        (see `io.save_input_shards`); each process only loads its own shard
+    sessions : optional
+        The number of browser sessions scraping at once in this process;
+        each one sleeps between its own calls
+    split_of : optional
+        Help the process with this id finish its chunk, scraping the items it
+        hands off (see `progress.request_split`); `pid` must be a new id
+    profile : optional
+        Save a CPU profile of the run and its peak memory (broken down by the
+        `io` functions) next to the chunk's config; this slows the run down
     """
+    # Time each phase of the run
+    metrics = Metrics(dimensions={"flavor": flavor})
+
     # Initialize the AWS connection
     if debug:
         logger.debug("Initializing AWS connection")
@@ -138,45 +672,464 @@ def scrape(
     if debug:
         logger.debug("...done")
 
+    # Use this task's shard of the input data, if it was split up front;
+    # helpers use the shard of the task they are helping
+    input_path = input_filename
+    sharded = shards_folder is not None and not dynamic and nprocs > 1
+    if sharded:
+        shard = pid if split_of is None else split_of
+        input_path = io.get_shard_path(shards_folder, shard, input_filename)
+        if not aws.exists(input_path):
+            logger.info(f"No input data for process #{shard}")
+            return
+
     # Load input data
     if debug:
         logger.debug("Loading input data")
-    data = io.load_input_data(flavor=flavor, input_filename=input_filename, aws=aws)
+    with metrics.timer("load_input"):
+        data = io.load_input_data(flavor=flavor, input_filename=input_path, aws=aws)
     if debug:
         logger.debug("...done")
 
-    # Sample it if requested
-    if sample is not None:
+    # Sample it if requested; shards are sampled when they are saved
+    if sample is not None and not sharded:
         data = data.sample(sample, random_state=seed)
 
-    # Split data
-    assert pid < nprocs
-    if nprocs > 1:
-        data_chunk = np.array_split(data, nprocs)[pid]
-        chunk = pid
+    # Only scrape each unique key once; results are mapped back onto every
+    # row with the same key when saving
+    all_keys = io.get_keys(data, flavor)
+    unique_data = data[~all_keys.duplicated().values]
+    if len(unique_data) < len(data):
+        logger.info(
+            f"Removed {len(data) - len(unique_data)} duplicate rows from the input data"
+        )
+
+    # The folder for incremental results
+    parts_folder = io.get_parts_folder(flavor, output_folder)
+
+    # Keys that are already done
+    completed = set()
+    if resume:
+        completed = io.load_completed_keys(parts_folder, aws)
+        logger.info(f"Resuming: {len(completed)} items already done")
+
+    # The shared work queue
+    if dynamic:
+        batches = [
+            unique_data.iloc[i : i + batch_size]
+            for i in range(0, len(unique_data), batch_size)
+        ]
+        # Local runs share the default queue unless given an id; AWS runs
+        # always get a new one
+        default_queue = queue_id is None
+        queue_id = queue_id or "default"
+        queue_folder = io.get_queue_folder(
+            flavor, output_folder, queue_id if not dry_run else f"{queue_id}-dry-run"
+        )
+        queue = WorkQueue(
+            get_lease_backend(queue_folder, aws),
+            len(batches),
+            lease_timeout=lease_timeout,
+        )
+
+        # Identical tasks get a unique id from the queue
+        if pid < 0:
+            pid = queue.register()
+            logger.info(f"Registered as process #{pid}")
+    elif split_of is None:
+        assert 0 <= pid < nprocs
+
+    # Results are buffered and flushed to the output folder as we go
+    run_id = time.strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    chunk = pid if nprocs > 1 else None
+    label = "all" if chunk is None else chunk
+    metrics.dimensions["chunk"] = label
+    buffer = []
+    nparts = 0
+
+    # Stop on SIGTERM (e.g., a Spot interruption, which gives two minutes of
+    # notice), but never in the middle of writing a part file
+    flushing = False
+    stop_requested = False
+
+    def on_sigterm(signum, frame):
+        nonlocal stop_requested
+        logger.warning("Received SIGTERM; saving completed results and stopping")
+        if flushing:
+            stop_requested = True
+        else:
+            raise Preempted(PREEMPTED_EXIT_CODE)
+
+    def flush():
+        nonlocal nparts, flushing
+        flushing = True
+        try:
+            if buffer and not dry_run:
+                partfile = f"{parts_folder}/{run_id}-{label}-{nparts:05d}.jsonl"
+                with metrics.timer("write_parts"):
+                    io.save_output_data(partfile, buffer, aws=aws)
+                nparts += 1
+            buffer.clear()
+        finally:
+            flushing = False
+        if stop_requested:
+            raise Preempted(PREEMPTED_EXIT_CODE)
+
+    # Claim batches of work from a shared queue until it is empty
+    if dynamic:
+        claimed = []
+        finishing = {}
+
+        # The results of the batches that are not saved yet (or that have
+        # failures, in case a retry succeeds)
+        batch_results = {}
+        resave = set()
+
+        def save_batch(batch):
+            """Save the results and input of a batch, under the batch's id."""
+            batch_keys = set(io.get_keys(batches[batch], flavor))
+            results = {k: batch_results[k] for k in batch_keys if k in batch_results}
+
+            # Items done before a resume are read back from the part files
+            missing = (batch_keys & completed) - set(results)
+            if missing:
+                for record in io.iter_output_records(parts_folder, aws, reverse=True):
+                    if record["key"] in missing:
+                        results[record["key"]] = record["result"]
+                        missing.discard(record["key"])
+                        if not missing:
+                            break
+
+            # One result for each input row of the batch, in order, like a
+            # chunk; rows whose item failed get a null result
+            rows = data[all_keys.isin(batch_keys).values]
+            outfile, infile = io.get_batch_output_paths(flavor, output_folder, batch)
+            with metrics.timer("save_output"):
+                io.save_output_stream(
+                    outfile, (results.get(k) for k in io.get_keys(rows, flavor)), aws
+                )
+            io.save_output_data(infile, rows, aws=aws)
+
+            if batch_keys & set(failures):
+                resave.add(batch)
+            else:
+                resave.discard(batch)
+                for key in batch_keys:
+                    batch_results.pop(key, None)
+
+        def complete_batches():
+            """Mark batches complete once all of their items are back."""
+            ready = [
+                batch
+                for batch, batch_keys in finishing.items()
+                if all(k in done or k in failures for k in batch_keys)
+            ]
+            if ready:
+                # Save the results before marking the batches complete, so a
+                # batch that is done is in the output even if this task stops
+                flush()
+                for batch in ready:
+                    batch_keys = finishing.pop(batch)
+
+                    # A batch taken over by another task (e.g., after this
+                    # one lost its lease) is saved by that task instead
+                    if not queue.holds(batch):
+                        for key in batch_keys:
+                            batch_results.pop(key, None)
+                            failures.pop(key, None)
+                        continue
+
+                    if not dry_run:
+                        save_batch(batch)
+                    queue.complete(batch)
+
+        def iter_keys():
+            while True:
+                # Don't wait on other tasks while our own batches are
+                # finishing, since they can't finish until we collect them
+                batch = queue.claim(wait=not finishing)
+                if batch is None:
+                    # A new run on the default queue of an earlier run would
+                    # find every batch done and quietly scrape nothing
+                    if not claimed and default_queue and not resume:
+                        logger.warning(
+                            f"Every batch in work queue '{queue_id}' is already done"
+                        )
+                        raise ValueError(
+                            "The default work queue was used by an earlier run; "
+                            "pass a new 'queue_id' (or use 'resume')"
+                        )
+                    if not finishing:
+                        return
+                    yield None
+                    continue
+
+                logger.info(f"Claimed batch #{batch} of {len(batches)}")
+                claimed.append(batch)
+                batch_keys = [
+                    key
+                    for key in io.get_keys(batches[batch], flavor)
+                    if key not in completed
+                ]
+                for key in batch_keys:
+                    queue.renew(batch)
+                    if batch not in queue.leases:
+                        break
+                    yield key
+
+                # Items may still be in progress (e.g., in other browser
+                # sessions), so the batch is completed once they are back
+                finishing[batch] = batch_keys
+                complete_batches()
+
+        keys = iter_keys()
+        key_queue = None
+
+    # Split data using a stable hash of the keys
     else:
-        data_chunk = data
-        chunk = None
+        if split_of is not None:
+            # Scrape the items that a straggler hands off to this task
+            assigned = progress.wait_for_split(
+                flavor, output_folder, split_of, pid, aws, timeout=lease_timeout
+            )
+            logger.info(f"Process #{split_of} handed off {len(assigned)} items")
+            data_chunk = unique_data[
+                io.get_keys(unique_data, flavor).astype(str).isin(assigned).values
+            ]
+        elif nprocs > 1:
+            partitions = io.get_keys(unique_data, flavor).map(
+                lambda key: io.get_partition(key, nprocs)
+            )
+            data_chunk = unique_data[(partitions == pid).values]
+        else:
+            data_chunk = unique_data
 
-    # No data, then return
-    if not len(data_chunk):
-        return
+        # No data, then return
+        if not len(data_chunk):
+            return
+
+        # Skip keys that are already done
+        keys = io.get_keys(data_chunk, flavor)
+        keys = keys[~keys.isin(completed)]
+        key_queue = _KeyQueue(keys)
+
+    # The cache of results from past runs
+    result_cache = None
+    if cache is not None:
+        result_cache = get_result_cache(
+            cache, flavor, aws, search_by=search_by, ttl=cache_ttl * 86400
+        )
+
+    # Adaptive rate control
+    rate = None
+    if adaptive:
+        state = None
+        if fleet:
+            state = SharedRateState(io.get_rate_state_path(flavor, output_folder), aws)
+        rate = RateController(
+            rate=1 / sleep if sleep > 0 else max_rate,
+            max_rate=max_rate,
+            state=state,
+            nprocs=nprocs,
+        )
+
+    # Run the scraper, keeping track of done and failed items
+    done = set()
+    failures = {}
+
+    # Report progress every `log_freq` items; a task scraping a fixed chunk
+    # also hands off the tail of it to helper tasks if the supervisor asks
+    heartbeat_path = io.get_heartbeat_path(flavor, output_folder, label)
+    split_path = io.get_split_path(flavor, output_folder, label)
+    started_at = time.time()
+    processed = 0
+    last_key = None
+    handed_off = set()
+    splittable = key_queue is not None and split_of is None and nprocs > 1
+
+    # Only a resumed task keeps the items it handed off before it stopped;
+    # a fresh run would otherwise hand off items to helpers that never run
+    if splittable and not resume and not dry_run:
+        progress.clear_split(flavor, output_folder, label, aws)
+
+    def hand_off():
+        nonlocal splittable
+        request = progress.load_split(flavor, output_folder, label, aws)
+        if request is None:
+            return
+
+        # Items handed off before this task was resumed stay handed off
+        if "assigned" in request:
+            assigned = request["assigned"]
+            handed_off.update(k for keys in assigned.values() for k in keys)
+            key_queue.discard(handed_off)
+        else:
+            helpers = request["helpers"]
+            assigned = {
+                str(helper): [str(k) for k in keys]
+                for helper, keys in zip(helpers, key_queue.split(len(helpers)))
+            }
+            handed_off.update(k for keys in assigned.values() for k in keys)
+            io.save_output_data(
+                split_path,
+                {**request, "assigned": assigned, "assigned_at": time.time()},
+                aws=aws,
+            )
+            logger.info(f"Handed off {len(handed_off)} items to processes {helpers}")
+        splittable = False
+
+    def heartbeat(status="running"):
+        if splittable and status == "running":
+            hand_off()
+        if dry_run:
+            return
+
+        elapsed = time.time() - started_at
+        io.save_output_data(
+            heartbeat_path,
+            {
+                "flavor": flavor,
+                "chunk": label,
+                "run_id": run_id,
+                "split_of": split_of,
+                "status": status,
+                "total": None if key_queue is None else len(key_queue),
+                "done": len(done),
+                "failed": len(failures),
+                "handed_off": len(handed_off),
+                "rate": processed / elapsed if elapsed > 0 else None,
+                "last_key": None if last_key is None else str(last_key),
+                "started_at": started_at,
+                "updated_at": time.time(),
+            },
+            aws=aws,
+        )
+
+    def run(keys):
+        nonlocal processed, last_key
+        for record in _scrape(
+            keys,
+            flavor,
+            search_by=search_by,
+            browser=browser,
+            sleep=sleep,
+            log_freq=log_freq,
+            errors=errors,
+            interval=interval,
+            time_limit=time_limit,
+            debug=debug,
+            cache=result_cache,
+            refresh=refresh,
+            rate=rate,
+            metrics=metrics,
+            parse_workers=parse_workers,
+            sessions=sessions,
+        ):
+            if "error" in record:
+                failures[record["key"]] = record
+            else:
+                # Items are counted once they succeed (or finally fail)
+                metrics.increment("items")
+                failures.pop(record["key"], None)
+                done.add(record["key"])
+                buffer.append(record)
+                if dynamic:
+                    batch_results[record["key"]] = record["result"]
+                if len(buffer) >= flush_freq:
+                    flush()
+            if dynamic and finishing:
+                complete_batches()
+
+            processed += 1
+            last_key = record["key"]
+            if processed % log_freq == 0:
+                heartbeat()
+
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGTERM, on_sigterm)
 
-    # Run the scraper
     if debug:
         logger.debug("Starting to scrape the data")
-    results = _scrape(
-        data_chunk,
-        flavor,
-        search_by=search_by,
-        browser=browser,
-        sleep=sleep,
-        log_freq=log_freq,
-        errors=errors,
-        interval=interval,
-        time_limit=time_limit,
-        debug=debug,
-    )
+    try:
+        heartbeat()
+        run(keys if key_queue is None else key_queue)
+
+        # Release any helpers still waiting for items
+        if splittable:
+            hand_off()
+
+        # Take back the items of helpers that did not acknowledge them in
+        # time (e.g., because they never started), so none are left out
+        if handed_off and not dry_run:
+            reclaimed = set(
+                progress.reclaim_hand_offs(
+                    flavor, output_folder, label, aws, timeout=lease_timeout
+                )
+            )
+            if reclaimed:
+                logger.info(f"Scraping {len(reclaimed)} items taken back from helpers")
+                handed_off.difference_update(reclaimed)
+                run([k for k in keys if str(k) in reclaimed and k not in done])
+
+        # Retry failed items with exponential backoff
+        for attempt in range(retries):
+            if not failures:
+                break
+            wait = retry_wait * 2**attempt
+            logger.info(
+                f"Retrying {len(failures)} failed items in {wait} seconds "
+                f"(attempt {attempt+1} of {retries})"
+            )
+            time.sleep(wait)
+            metrics.increment("retries", len(failures))
+            run(list(failures))
+
+        # Items that failed every attempt are only counted once
+        metrics.increment("items", len(failures))
+
+        # Save the batches with items that failed again, with any retries
+        # that succeeded
+        if dynamic and retries and not dry_run:
+            flush()
+            for batch in sorted(resave):
+                save_batch(batch)
+    except Preempted:
+        # The completed results are flushed below, so a resumed task only
+        # scrapes the items that are left
+        if dynamic:
+            keys = [k for b in queue.leases for k in io.get_keys(batches[b], flavor)]
+        remaining = [
+            k
+            for k in keys
+            if k not in done and k not in completed and str(k) not in handed_off
+        ]
+        logger.warning(f"Stopped early with {len(remaining)} items left")
+
+        # Save the batches that are done and give back the rest, so they can
+        # be claimed as soon as the task is resubmitted
+        if dynamic:
+            stop_requested = False
+            flush()
+            complete_batches()
+            for batch in list(queue.leases):
+                queue.release(batch)
+        heartbeat("preempted")
+        raise
+    except Exception:
+        heartbeat("failed")
+        raise
+    finally:
+        flush()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, previous_handler)
+
+    if failures:
+        logger.warning(f"{len(failures)} items failed")
+
+    # Each batch claimed from a shared queue was saved as it was completed
+    if dynamic and not claimed:
+        heartbeat("finished")
+        return
     if debug:
         logger.debug("...done")
 
@@ -193,8 +1146,46 @@ def scrape(
         if debug:
             logger.debug(f"Saving results to {outfile}")
 
-        # Save the results
-        io.save_output_data(outfile, results, aws=aws)
+        # The batches of a shared queue are saved as they are completed; a
+        # single process combines them once the queue is empty
+        if dynamic:
+            if chunk is None:
+                aws.combine_parallel_results(flavor, f"{output_folder}/chunks")
+        else:
+            # All of the input rows for the keys in this chunk, with duplicates
+            # (except any handed off to helpers)
+            chunk_keys = set(io.get_keys(data_chunk, flavor)) - handed_off
+            data_chunk = data[all_keys.isin(chunk_keys).values]
+
+            # The latest result for each key, indexed on disk so the chunk's
+            # results are not all held in memory. Only this task's parts are
+            # read (from earlier runs too, if resuming), and the rest only for
+            # items another task did before a resume
+            with tempfile.TemporaryDirectory() as tmpdir:
+                conn = sqlite3.connect(f"{tmpdir}/results.sqlite")
+                try:
+                    io.index_output_records(
+                        conn,
+                        parts_folder,
+                        aws,
+                        chunk_keys,
+                        label=label,
+                        run_id=None if resume else run_id,
+                    )
+                    indexed = {key for key, in conn.execute("SELECT key FROM results")}
+                    if any(str(key) not in indexed for key in completed & chunk_keys):
+                        io.index_output_records(conn, parts_folder, aws, chunk_keys)
+
+                    # Save the result for each input row, in the same order as
+                    # the chunk's input; rows whose item failed get a null result
+                    def iter_chunk_results():
+                        for key in io.get_keys(data_chunk, flavor):
+                            yield io.lookup_result(conn, key)
+
+                    with metrics.timer("save_output"):
+                        io.save_output_stream(outfile, iter_chunk_results(), aws=aws)
+                finally:
+                    conn.close()
 
         # Get the input config
         local_variables = locals()
@@ -203,17 +1194,44 @@ def scrape(
         sig = inspect.signature(globals()[fname])
         config = {p: local_variables[p] for p in sig.parameters}
 
-        # Save the config and input
+        # Save the config, input, and failures
         if chunk is not None:
             io.save_output_data(f"{output_folder}/config_{chunk}.json", config, aws=aws)
             io.save_output_data(
-                f"{output_folder}/{flavor}_input_{chunk}.csv", data_chunk, aws=aws
+                f"{output_folder}/{flavor}_failures_{chunk}.json",
+                list(failures.values()),
+                aws=aws,
+            )
+            if not dynamic:
+                io.save_output_data(
+                    f"{output_folder}/{flavor}_input_{chunk}.csv", data_chunk, aws=aws
+                )
+            io.save_output_data(
+                f"{output_folder}/metrics_{chunk}.json", metrics.to_dict(), aws=aws
             )
         else:
             io.save_output_data(f"{output_folder}/config.json", config, aws=aws)
             io.save_output_data(
-                f"{output_folder}/{flavor}_input.csv", data_chunk, aws=aws
+                f"{output_folder}/{flavor}_failures.json",
+                list(failures.values()),
+                aws=aws,
+            )
+            if not dynamic:
+                io.save_output_data(
+                    f"{output_folder}/{flavor}_input.csv", data_chunk, aws=aws
+                )
+            io.save_output_data(
+                f"{output_folder}/metrics.json", metrics.to_dict(), aws=aws
             )
 
+        # Save the profile last, so it covers the rest of the run
+        profiling.save_active(output_folder, chunk, aws=aws)
+
         if debug:
             logger.debug("...done")
+
+    heartbeat("finished")
+
+    # Log the metrics for CloudWatch
+    if emf:
+        print(metrics.to_emf(), flush=True)
@@ -0,0 +1,263 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import simplejson as json
+from loguru import logger
+
+from . import CMD, io
+
+# The fields that can be looked up, and the names they go by in the
+# scraped results (portal search results and court summary dockets)
+LOOKUP_FIELDS = {
+    "docket_number": ["docket_number"],
+    "incident_number": ["incident_number", "police_incident", "dc_number"],
+    "participant": ["participant", "primary_participant", "defendant", "name"],
+    "filing_date": ["filing_date", "file_date"],
+    "key": [],
+}
+
+# The most values to look up in one query
+LOOKUP_BATCH_SIZE = 500
+
+# The local copies of result stores on s3, which are reused for lookups
+# until the store changes
+STORE_CACHE = Path.home() / f".{CMD}" / "stores"
+
+
+def _iter_dockets(result):
+    """Yield each docket in a scraped result, with the fields of its parent."""
+
+    if isinstance(result, list):
+        for r in result:
+            yield from _iter_dockets(r)
+    elif isinstance(result, dict):
+        # Court summaries hold a list of dockets for a defendant
+        if isinstance(result.get("dockets"), list):
+            parent = {k: v for k, v in result.items() if k != "dockets"}
+            for docket in result["dockets"]:
+                if isinstance(docket, dict) and docket.get("docket_number"):
+                    yield {**parent, **docket}
+        elif result.get("docket_number"):
+            yield result
+
+
+def _get_field(docket, field):
+    """Get the value of a lookup field from a docket, if it has one."""
+
+    for name in LOOKUP_FIELDS[field]:
+        value = docket.get(name)
+        if value not in [None, ""]:
+            return str(value)
+    return None
+
+
+class ResultStore:
+    """
+    An indexed SQLite store of scraped dockets, to look up a few at a time.
+
+    Each docket is stored once, keyed by its docket number, with secondary
+    indexes on the incident number, participant, filing date, and the
+    scraped key (e.g., the search value). Dockets are upserted, so new runs
+    merge into the store.
+
+    Parameters
+    ----------
+    path :
+        The path to the SQLite file
+    """
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dockets ("
+            "docket_number TEXT PRIMARY KEY, flavor TEXT, key TEXT, "
+            "incident_number TEXT, participant TEXT, filing_date TEXT, "
+            "record TEXT, updated_at REAL)"
+        )
+        for field in ["key", "incident_number", "participant", "filing_date"]:
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS dockets_{field} ON dockets ({field})"
+            )
+
+        # The part files that have already been indexed
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS indexed_parts (path TEXT PRIMARY KEY)"
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def upsert(self, flavor, records):
+        """
+        Add or update the dockets in scraped {"key", "result"} records.
+
+        Returns the number of dockets upserted.
+        """
+
+        rows = [
+            (
+                docket["docket_number"],
+                flavor,
+                str(record["key"]),
+                _get_field(docket, "incident_number"),
+                _get_field(docket, "participant"),
+                _get_field(docket, "filing_date"),
+                json.dumps(docket, ignore_nan=True),
+                time.time(),
+            )
+            for record in records
+            for docket in _iter_dockets(record["result"])
+        ]
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO dockets VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self.conn.commit()
+        return len(rows)
+
+    def index_parts(self, flavor, parts_folder, aws):
+        """
+        Upsert the results in the part files that have not been indexed yet.
+
+        Part files are indexed from oldest to newest, so dockets that were
+        scraped again use the latest result. Returns the number of dockets
+        upserted.
+        """
+
+        fs = io.get_filesystem(parts_folder, aws)
+        fs.invalidate_cache()
+        indexed = {
+            row[0] for row in self.conn.execute("SELECT path FROM indexed_parts")
+        }
+
+        total = 0
+        for f in sorted(fs.glob(f"{parts_folder}/*.jsonl")):
+            name = f.split("/")[-1]
+            if name in indexed:
+                continue
+            with fs.open(f, "r") as ff:
+                records = [json.loads(line) for line in ff if line.strip()]
+            total += self.upsert(flavor, records)
+            self.conn.execute("INSERT INTO indexed_parts VALUES (?)", (name,))
+            self.conn.commit()
+
+        return total
+
+    def lookup(self, values, by="docket_number"):
+        """Look up the dockets with any of the values of a field."""
+
+        if by not in LOOKUP_FIELDS:
+            raise ValueError(f"'by' must be one of {', '.join(LOOKUP_FIELDS)}")
+
+        # Query in batches, to stay under SQLite's limit on parameters
+        values = [str(v) for v in values]
+        rows = []
+        for i in range(0, len(values), LOOKUP_BATCH_SIZE):
+            batch = values[i : i + LOOKUP_BATCH_SIZE]
+            rows += self.conn.execute(
+                f"SELECT docket_number, record FROM dockets WHERE {by} IN "
+                f"({', '.join('?' for _ in batch)})",
+                batch,
+            ).fetchall()
+        return [json.loads(record) for _, record in sorted(rows)]
+
+
+def _get_local_copy(path, aws):
+    """
+    Get a local copy of a result store on s3, or None if it doesn't exist.
+
+    The copy is downloaded again only if the store's ETag has changed since
+    it was last downloaded.
+    """
+
+    try:
+        aws.remote.invalidate_cache(path)
+        etag = aws.remote.info(path)["ETag"]
+    except FileNotFoundError:
+        return None
+
+    name = hashlib.sha256(path.encode("utf-8")).hexdigest()[:16]
+    local_path = STORE_CACHE / f"{name}.sqlite"
+    etag_path = STORE_CACHE / f"{name}.etag"
+    if local_path.exists() and etag_path.exists() and etag_path.read_text() == etag:
+        return str(local_path)
+
+    # Download to a temporary file first, so a copy is never half-written
+    logger.info(f"Downloading the result store at {path}")
+    STORE_CACHE.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{local_path}.{os.getpid()}.tmp"
+    aws.remote.get(path, tmp_path)
+    os.replace(tmp_path, local_path)
+    etag_path.write_text(etag)
+    return str(local_path)
+
+
+@contextmanager
+def open_store(path, aws, write=False):
+    """
+    Open the result store at a local path or on s3.
+
+    A store on s3 is downloaded to a temporary file, and uploaded again
+    after it is written to. Stores that are only read from (for lookups)
+    are cached in '~/.phl-courts-scraper-batch/stores', and only downloaded
+    again once they change.
+    """
+
+    if not path.startswith("s3://"):
+        store = ResultStore(path)
+        try:
+            yield store
+        finally:
+            store.close()
+        return
+
+    local_path = None if write else _get_local_copy(path, aws)
+    if local_path is not None:
+        store = ResultStore(local_path)
+        try:
+            yield store
+        finally:
+            store.close()
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        local_path = f"{tmpdir}/store.sqlite"
+        if aws.remote.exists(path):
+            aws.remote.get(path, local_path)
+
+        store = ResultStore(local_path)
+        try:
+            yield store
+        finally:
+            store.close()
+
+        if write:
+            aws.remote.put(local_path, path)
+
+
+def index_results(flavor, output_folder, store_path, aws):
+    """
+    Merge the results saved to an output folder into a result store.
+
+    Returns the number of dockets upserted.
+    """
+
+    parts_folder = io.get_parts_folder(flavor, output_folder)
+    with open_store(store_path, aws, write=True) as store:
+        total = store.index_parts(flavor, parts_folder, aws)
+
+    logger.info(f"Indexed {total} dockets in {store_path}")
+    return total
+
+
+def lookup_results(store_path, values, aws, by="docket_number"):
+    """Look up dockets in a result store by a field."""
+
+    with open_store(store_path, aws) as store:
+        return store.lookup(values, by=by)
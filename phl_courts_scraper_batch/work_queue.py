@@ -0,0 +1,323 @@
+import fcntl
+import os
+import random
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import simplejson as json
+from botocore.exceptions import ClientError
+from loguru import logger
+
+from .aws import parse_aws_path
+
+# Error codes returned by s3 when a conditional write fails
+CONFLICT_CODES = ["PreconditionFailed", "ConditionalRequestConflict"]
+
+
+class LocalLeaseBackend:
+    """Lease objects stored in a folder on the local file system."""
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _lock(self):
+        """Lock the folder while replacing a lease."""
+        with open(self.folder / ".lock", "w") as ff:
+            fcntl.flock(ff, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(ff, fcntl.LOCK_UN)
+
+    def _write_tmp(self, data):
+        """Write data to a temporary file in the folder."""
+        tmp = self.folder / f".{uuid.uuid4().hex}.tmp"
+        tmp.write_text(data)
+        return tmp
+
+    def list(self):
+        """List the names of the objects."""
+        return [p.name for p in self.folder.iterdir() if not p.name.startswith(".")]
+
+    def create(self, name, data):
+        """Create an object if it does not exist, returning its token or None."""
+        tmp = self._write_tmp(data)
+        try:
+            os.link(tmp, self.folder / name)
+        except FileExistsError:
+            return None
+        finally:
+            tmp.unlink()
+        return data
+
+    def read(self, name):
+        """Read an object, returning its data and token (or None if missing)."""
+        try:
+            data = (self.folder / name).read_text()
+        except FileNotFoundError:
+            return None, None
+        return data, data
+
+    def replace(self, name, data, token):
+        """Replace an object if it is unchanged, returning its new token or None."""
+        with self._lock():
+            current, _ = self.read(name)
+            if current != token:
+                return None
+            os.replace(self._write_tmp(data), self.folder / name)
+        return data
+
+    def delete(self, name, token):
+        """Delete an object if it is unchanged, returning whether it was."""
+        with self._lock():
+            current, _ = self.read(name)
+            if current != token:
+                return False
+            (self.folder / name).unlink(missing_ok=True)
+        return True
+
+
+class S3LeaseBackend:
+    """Lease objects stored on s3, claimed with conditional writes."""
+
+    def __init__(self, folder, client):
+        self.bucket, self.prefix = parse_aws_path(folder)
+        self.client = client
+
+    def list(self):
+        """List the names of the objects."""
+        names = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}/"):
+            names += [obj["Key"].split("/")[-1] for obj in page.get("Contents", [])]
+        return names
+
+    def _put(self, name, data, **kwargs):
+        """Put an object, returning its ETag or None if a condition failed."""
+        try:
+            r = self.client.put_object(
+                Bucket=self.bucket,
+                Key=f"{self.prefix}/{name}",
+                Body=data.encode("utf-8"),
+                **kwargs,
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in CONFLICT_CODES:
+                return None
+            raise
+        return r["ETag"]
+
+    def create(self, name, data):
+        """Create an object if it does not exist, returning its token or None."""
+        return self._put(name, data, IfNoneMatch="*")
+
+    def read(self, name):
+        """Read an object, returning its data and token (or None if missing)."""
+        try:
+            r = self.client.get_object(Bucket=self.bucket, Key=f"{self.prefix}/{name}")
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+                return None, None
+            raise
+        return r["Body"].read().decode("utf-8"), r["ETag"]
+
+    def replace(self, name, data, token):
+        """Replace an object if it is unchanged, returning its new token or None."""
+        return self._put(name, data, IfMatch=token)
+
+    def delete(self, name, token):
+        """Delete an object if it is unchanged, returning whether it was."""
+        try:
+            self.client.delete_object(
+                Bucket=self.bucket, Key=f"{self.prefix}/{name}", IfMatch=token
+            )
+        except ClientError as e:
+            # Buckets without conditional deletes keep the object
+            if e.response["Error"]["Code"] in CONFLICT_CODES + ["NotImplemented"]:
+                return False
+            raise
+        return True
+
+
+def get_lease_backend(folder, aws):
+    """Get the lease backend for the input folder."""
+
+    if folder.startswith("s3://"):
+        return S3LeaseBackend(folder, aws.s3)
+    else:
+        return LocalLeaseBackend(folder)
+
+
+class WorkQueue:
+    """
+    A pull-based queue of batches of work, shared by all tasks.
+
+    Tasks claim a batch by creating a lease object for it, and mark it
+    complete by writing a done marker. Leases that are not renewed before
+    they expire (e.g., because the task died) can be claimed again.
+
+    Parameters
+    ----------
+    backend :
+        Where the lease objects are stored
+    nbatches :
+        The total number of batches of work
+    lease_timeout : optional
+        How long a lease lasts before it expires (in seconds)
+    poll : optional
+        How long to wait before checking the queue again when every
+        remaining batch is leased by another task (in seconds)
+    """
+
+    def __init__(self, backend, nbatches, lease_timeout=900, poll=30):
+        self.backend = backend
+        self.nbatches = nbatches
+        self.lease_timeout = lease_timeout
+        self.poll = poll
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.leases = {}
+
+    @staticmethod
+    def _lease_name(batch):
+        return f"batch_{batch:06d}.lease"
+
+    @staticmethod
+    def _done_name(batch):
+        return f"batch_{batch:06d}.done"
+
+    def _new_lease(self):
+        """Get the contents of a new lease and its expiration time."""
+        expires = time.time() + self.lease_timeout
+        return json.dumps({"owner": self.owner, "expires": expires}), expires
+
+    def _acquire(self, batch, token=None):
+        """Create (or take over) the lease for a batch."""
+
+        data, expires = self._new_lease()
+        if token is None:
+            token = self.backend.create(self._lease_name(batch), data)
+        else:
+            token = self.backend.replace(self._lease_name(batch), data, token)
+
+        if token is None:
+            return False
+        self.leases[batch] = (token, expires)
+        return True
+
+    def register(self):
+        """Register this task with the queue, returning a unique task id."""
+
+        names = set(self.backend.list())
+        n = 0
+        while True:
+            name = f"task_{n:04d}.id"
+            if name not in names and self.backend.create(name, self.owner) is not None:
+                return n
+            n += 1
+
+    def claim(self, wait=True):
+        """
+        Claim the next available batch, or return None once all are done.
+
+        If `wait` is False, this also returns None rather than waiting when
+        every remaining batch is leased by a live task.
+        """
+
+        while True:
+
+            # Get the remaining batches
+            names = set(self.backend.list())
+            remaining = [
+                b for b in range(self.nbatches) if self._done_name(b) not in names
+            ]
+            if not remaining:
+                return None
+
+            # Start at a random batch to limit contention between tasks
+            start = random.randrange(len(remaining))
+            remaining = remaining[start:] + remaining[:start]
+
+            # Try batches that are not leased first
+            for b in remaining:
+                if self._lease_name(b) not in names and self._acquire(b):
+                    return b
+
+            # Then take over any expired leases
+            for b in remaining:
+                if self._lease_name(b) not in names:
+                    continue
+                data, token = self.backend.read(self._lease_name(b))
+                if data is None or json.loads(data)["expires"] > time.time():
+                    continue
+                if self._acquire(b, token=token):
+                    logger.info(f"Claimed expired lease for batch #{b}")
+                    return b
+
+            # Everything left is leased by a live task; wait for it to
+            # finish (or for its lease to expire)
+            if not wait:
+                return None
+            time.sleep(self.poll)
+
+    def renew(self, batch):
+        """Renew the lease for a batch if more than half of it has elapsed."""
+
+        if batch not in self.leases:
+            return
+        token, expires = self.leases[batch]
+        if expires - time.time() > self.lease_timeout / 2:
+            return
+        if not self._acquire(batch, token=token):
+            logger.warning(f"Lease for batch #{batch} was claimed by another task")
+            self.leases.pop(batch)
+
+    def release(self, batch):
+        """
+        Give up the lease on a batch without completing it.
+
+        Another task (e.g., a resubmitted one) can then claim the batch right
+        away, rather than once the lease expires.
+        """
+
+        if batch in self.leases:
+            token, _ = self.leases.pop(batch)
+            self.backend.delete(self._lease_name(batch), token)
+
+    def holds(self, batch):
+        """
+        Whether this task still holds the lease for a batch.
+
+        A lease that expired (e.g., during a long pause) may have been taken
+        over by another task, which then owns the batch and its results.
+        """
+
+        if batch not in self.leases:
+            return False
+        token, _ = self.leases[batch]
+        if self.backend.read(self._lease_name(batch))[1] != token:
+            logger.warning(f"Lease for batch #{batch} was claimed by another task")
+            self.leases.pop(batch)
+            return False
+        return True
+
+    def complete(self, batch):
+        """
+        Mark a batch as complete and release its lease, returning whether it was.
+
+        A task that no longer holds the lease (see `holds`) does not complete
+        the batch; it belongs to the task that took the lease over.
+        """
+
+        if not self.holds(batch):
+            return False
+
+        self.backend.create(self._done_name(batch), self.owner)
+        token, _ = self.leases.pop(batch)
+        if not self.backend.delete(self._lease_name(batch), token):
+            logger.info(f"Lease for batch #{batch} is held by another task")
+        return True
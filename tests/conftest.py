@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The tests run the scraper against the stand-ins of the benchmark harness
+sys.path.insert(0, str(Path(__file__).parents[1] / "benchmarks"))
+
+import throughput  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def portal():
+    """The base URL of a fake portal."""
+    return throughput.start_portal(latency=0.02, pdf_size=1_000)
+
+
+@pytest.fixture(scope="session")
+def s3():
+    """A local S3 server, with the benchmark bucket."""
+    pytest.importorskip("moto.server")
+    server = throughput.start_s3()
+    yield f"s3://{throughput.BUCKET}"
+    server.stop()
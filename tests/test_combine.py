@@ -0,0 +1,51 @@
+import simplejson as json
+
+from phl_courts_scraper_batch.aws import AWS
+
+NCHUNKS = 25
+
+
+def save_chunks(aws, output_folder):
+    """Save chunk files of varying sizes, returning the results in chunk order."""
+
+    results = []
+    for chunk in range(NCHUNKS):
+        # Larger chunks first, so later downloads tend to finish first
+        rows = [[{"docket_number": f"{chunk}-{i}"}] for i in range(NCHUNKS - chunk)]
+        results += rows
+        with aws.remote.open(f"{output_folder}/portal_results_{chunk}.json", "w") as ff:
+            ff.write(json.dumps(rows))
+        with aws.remote.open(f"{output_folder}/portal_input_{chunk}.csv", "w") as ff:
+            ff.write("".join(f"{chunk}-{i}\n" for i in range(len(rows))))
+    return results
+
+
+def test_combine_on_s3(s3):
+    """Chunks downloaded concurrently from s3 are combined in chunk order."""
+
+    aws = AWS()
+    output_folder = f"{s3}/combine/chunks"
+    results = save_chunks(aws, output_folder)
+
+    # Download fewer files at once than there are chunks
+    files = sorted(aws.remote.glob(f"{output_folder}/portal_results_*.json"))
+    contents = aws._iter_file_contents(files, aws.remote, max_concurrency=4)
+    assert [json.loads(c) for c in contents] == [
+        json.loads(aws.remote.cat(f)) for f in files
+    ]
+
+    for fmt in ["json", "jsonl"]:
+        outfile = aws.combine_parallel_results(
+            "portal", output_folder, fmt=fmt, max_concurrency=4
+        )
+        assert outfile == f"{s3}/combine/portal_results.{fmt}"
+
+        content = aws.remote.cat(outfile).decode("utf-8")
+        if fmt == "json":
+            combined = json.loads(content)
+        else:
+            combined = [json.loads(line) for line in content.splitlines()]
+        assert combined == results
+
+    inputs = aws.remote.cat(f"{s3}/combine/portal_input.csv").decode("utf-8")
+    assert inputs.splitlines() == [r[0]["docket_number"] for r in results]
@@ -0,0 +1,50 @@
+import simplejson as json
+import throughput
+
+from phl_courts_scraper_batch.scrape import scrape
+
+ROWS = 20
+
+
+class FlakyPortalScraper(throughput.FakePortalScraper):
+    """Fails the first search for some values, and every search for others."""
+
+    flaky = {f"CP-51-CR-{i:07d}-2020" for i in [2, 7, 11]}
+    broken = {"CP-51-CR-0000015-2020"}
+
+    def scrape_portal_data(self, values):
+        for value in values:
+            if value in self.broken:
+                raise RuntimeError("Not Found")
+            if value in self.flaky:
+                self.flaky.discard(value)
+                raise RuntimeError("Service Unavailable")
+        return super().scrape_portal_data(values)
+
+
+def test_retried_items_are_counted_once(tmp_path, portal, monkeypatch):
+    """Retries are counted separately from the items scraped."""
+
+    from phl_courts_scraper_batch import scrape as scrape_module
+
+    throughput.install(portal)
+    monkeypatch.setattr(scrape_module, "UJSPortalScraper", FlakyPortalScraper)
+    scrape(
+        flavor="portal",
+        input_filename=throughput.make_input("portal", ROWS, str(tmp_path)),
+        output_folder=str(tmp_path / "output"),
+        search_by="Docket Number",
+        sleep=0,
+        nprocs=1,
+        pid=0,
+        retries=2,
+        retry_wait=0,
+    )
+
+    with open(tmp_path / "output" / "metrics.json") as f:
+        counters = json.load(f)["counters"]
+    assert counters["items"] == ROWS
+
+    # The flaky items are retried once, and the broken one twice
+    assert counters["retries"] == 3 + 2
+    assert counters["errors"] == 3 + 3
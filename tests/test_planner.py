@@ -0,0 +1,67 @@
+from pathlib import Path
+
+import pytest
+
+from phl_courts_scraper_batch import planner
+
+HISTORY = Path(__file__).parent / "data" / "history.json"
+
+
+@pytest.fixture
+def history():
+    return planner.load_history(HISTORY)
+
+
+def test_load_missing_history(tmp_path):
+    assert planner.load_history(tmp_path / "history.json") == []
+
+
+def test_estimate_cost(history):
+    """Runs with the same sleep are weighted by their items (or tasks)."""
+
+    # (10000 + 20000) / (1000 + 3000) seconds per item, and the run with no
+    # items is left out of the overhead: (60 * 10 + 90 * 5) / 15
+    assert planner.estimate_cost(history, "portal", sleep=7) == (7.5, 70.0)
+    assert planner.estimate_cost(history, "portal", sleep=2) == (4.0, 50.0)
+
+    # A sleep with no past runs uses all of them
+    per_item, overhead = planner.estimate_cost(history, "portal", sleep=1)
+    assert per_item == pytest.approx(38000 / 6000)
+    assert overhead == pytest.approx((600 + 450 + 200) / 19)
+
+    with pytest.raises(ValueError):
+        planner.estimate_cost(history, "docket_sheet")
+
+
+def test_plan(history):
+    """The tasks needed to scrape the items by the deadline, after overhead."""
+
+    p = planner.plan("portal", 10_000, 2, history, sleep=7, vcpus=2)
+
+    # 75,000 task-seconds of scraping in the 7,130 seconds left after the
+    # overhead of each task takes 11 tasks of 910 items each
+    assert p["ntasks"] == 11
+    assert p["hours"] == pytest.approx((70 + 910 * 7.5) / 3600)
+    assert p["vcpu_hours"] == pytest.approx(11 * 2 * (70 + 910 * 7.5) / 3600)
+    assert p["meets_deadline"]
+
+    # A shorter sleep needs more tasks per hour of deadline
+    p = planner.plan("portal", 10_000, 1, history, sleep=2)
+    assert p["ntasks"] == 12
+    assert p["hours"] == pytest.approx((50 + 834 * 4) / 3600)
+    assert p["meets_deadline"]
+
+
+def test_plan_limits(history):
+    """Plans are capped at the most tasks, and flag deadlines they miss."""
+
+    p = planner.plan("portal", 1_000_000, 1, history, sleep=7, max_tasks=50)
+    assert p["ntasks"] == 50
+    assert p["hours"] == pytest.approx((70 + 20_000 * 7.5) / 3600)
+    assert not p["meets_deadline"]
+
+    # A deadline shorter than the overhead can't be met with any number of
+    # tasks, and there is no more than one task per item
+    p = planner.plan("portal", 20, 60 / 3600, history, sleep=7)
+    assert p["ntasks"] == 20
+    assert not p["meets_deadline"]
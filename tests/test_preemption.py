@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import signal
+import time
+from glob import glob
+
+import pytest
+import simplejson as json
+import throughput
+
+from phl_courts_scraper_batch.aws import AWS
+from phl_courts_scraper_batch.scrape import PREEMPTED_EXIT_CODE, scrape
+
+ROWS = 40
+
+
+def _scrape(base_url, kwargs):
+    from loguru import logger
+
+    logger.remove()
+    throughput.install(base_url)
+    scrape(**kwargs)
+
+
+def run(base_url, kwargs, stop_after=None):
+    """
+    Scrape in a child process, returning its exit code.
+
+    With `stop_after`, the process gets a SIGTERM once that many part files
+    are written, like a Spot interruption.
+    """
+
+    ctx = multiprocessing.get_context("fork")
+    p = ctx.Process(target=_scrape, args=(base_url, kwargs))
+    p.start()
+    if stop_after is not None:
+        deadline = time.time() + 60
+        while time.time() < deadline and p.is_alive():
+            parts = glob(f"{kwargs['output_folder']}/parts/portal/*.jsonl")
+            if len(parts) >= stop_after:
+                break
+            time.sleep(0.05)
+        os.kill(p.pid, signal.SIGTERM)
+    p.join(120)
+    return p.exitcode
+
+
+@pytest.mark.parametrize("dynamic", [False, True])
+def test_resume_after_sigterm(tmp_path, portal, dynamic):
+    """A task stopped with SIGTERM keeps its results, and a resume finishes."""
+
+    input_filename = throughput.make_input("portal", ROWS, str(tmp_path))
+    kwargs = {
+        "flavor": "portal",
+        "input_filename": input_filename,
+        "output_folder": str(tmp_path / "output"),
+        "search_by": "Docket Number",
+        "sleep": 0.02,
+        "flush_freq": 1,
+        "log_freq": ROWS,
+        "retries": 0,
+        "nprocs": 1,
+        "pid": 0,
+    }
+    if dynamic:
+        kwargs.update(dynamic=True, batch_size=5, nprocs=2, pid=-1, lease_timeout=60)
+
+    assert run(portal, kwargs, stop_after=10) == PREEMPTED_EXIT_CODE
+    if dynamic:
+        # The leases of unfinished batches are given back
+        leases = glob(f"{kwargs['output_folder']}/queue/portal/*/*.lease")
+        assert not leases
+
+    assert run(portal, {**kwargs, "resume": True}) == 0
+    if dynamic:
+        AWS().combine_parallel_results("portal", f"{kwargs['output_folder']}/chunks")
+    with open(f"{kwargs['output_folder']}/portal_results.json") as f:
+        results = json.load(f)
+
+    dockets = [f"CP-51-CR-{i:07d}-2020" for i in range(ROWS)]
+    assert [r["docket_number"] for r in results] == dockets
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from phl_courts_scraper_batch import io, progress
+from phl_courts_scraper_batch.aws import AWS
+
+ASSIGNED = {"2": ["a", "b"], "3": ["c"]}
+
+
+@pytest.fixture
+def output_folder(tmp_path):
+    return str(tmp_path)
+
+
+def hand_off(output_folder, assigned_at, status="running"):
+    """Save a split with items handed off to helpers, like a straggler."""
+
+    aws = AWS()
+    split_path = io.get_split_path("portal", output_folder, 0)
+    split = {"helpers": [2, 3], "assigned": ASSIGNED, "assigned_at": assigned_at}
+    io.save_output_data(split_path, split, aws=aws)
+
+    heartbeat_path = io.get_heartbeat_path("portal", output_folder, 0)
+    heartbeat = {"status": status, "updated_at": time.time()}
+    io.save_output_data(heartbeat_path, heartbeat, aws=aws)
+
+
+def test_acked_hand_offs_stay_with_helpers(output_folder):
+    """Helpers that acknowledge their items in time keep them."""
+
+    aws = AWS()
+    hand_off(output_folder, time.time())
+    for helper in [2, 3]:
+        items = progress.wait_for_split("portal", output_folder, 0, helper, aws)
+        assert items == ASSIGNED[str(helper)]
+
+    assert progress.reclaim_hand_offs("portal", output_folder, 0, aws) == []
+    assert progress.load_ack("portal", output_folder, 0, 3, aws) == "acked"
+
+
+def test_late_helpers_lose_their_items(output_folder):
+    """Items of a helper that is too late to acknowledge them are taken back."""
+
+    aws = AWS()
+    hand_off(output_folder, time.time() - progress.ACK_TIMEOUT)
+    assert progress.wait_for_split("portal", output_folder, 0, 2, aws) == ["a", "b"]
+
+    reclaimed = progress.reclaim_hand_offs("portal", output_folder, 0, aws)
+    assert reclaimed == ["c"]
+    assert progress.wait_for_split("portal", output_folder, 0, 3, aws) == []
+    assert progress.load_ack("portal", output_folder, 0, 3, aws) == "reclaimed"
+
+
+def test_reclaim_waits_for_acks(output_folder):
+    """A straggler waits until the deadline for its helpers to acknowledge."""
+
+    aws = AWS()
+    hand_off(output_folder, time.time())
+
+    start = time.time()
+    reclaimed = progress.reclaim_hand_offs(
+        "portal", output_folder, 0, aws, poll=0.1, timeout=0.5
+    )
+    assert sorted(reclaimed) == ["a", "b", "c"]
+    assert time.time() - start >= 0.4
+
+
+def test_fresh_runs_clear_acks(output_folder):
+    """The acknowledgements of an earlier run do not carry over."""
+
+    aws = AWS()
+    hand_off(output_folder, time.time())
+    progress.wait_for_split("portal", output_folder, 0, 2, aws)
+    progress.clear_split("portal", output_folder, 0, aws)
+    assert progress.load_ack("portal", output_folder, 0, 2, aws) is None
@@ -0,0 +1,99 @@
+import pandas as pd
+import simplejson as json
+import throughput
+from click.testing import CliRunner
+
+from phl_courts_scraper_batch import io
+from phl_courts_scraper_batch.__main__ import cli
+from phl_courts_scraper_batch.aws import AWS
+from phl_courts_scraper_batch.scrape import scrape
+
+ROWS = 30
+FAILED = {f"CP-51-CR-{i:07d}-2020" for i in [3, 14, 22]}
+
+
+class FailingPortalScraper(throughput.FakePortalScraper):
+    """Fails to search for some of the values."""
+
+    def scrape_portal_data(self, values):
+        if FAILED.intersection(values):
+            raise RuntimeError("Service Unavailable")
+        return super().scrape_portal_data(values)
+
+
+def test_retry_failed_items(tmp_path, portal, monkeypatch):
+    """Only the failed items are scraped again, and filled in to the output."""
+
+    from phl_courts_scraper_batch import scrape as scrape_module
+
+    throughput.install(portal)
+    output_folder = str(tmp_path / "output")
+    kwargs = {
+        "flavor": "portal",
+        "input_filename": throughput.make_input("portal", ROWS, str(tmp_path)),
+        "output_folder": output_folder,
+        "search_by": "Docket Number",
+        "sleep": 0,
+        "nprocs": 2,
+        "retries": 0,
+    }
+    with monkeypatch.context() as m:
+        m.setattr(scrape_module, "UJSPortalScraper", FailingPortalScraper)
+        for pid in range(2):
+            scrape(**kwargs, pid=pid)
+    AWS().combine_parallel_results("portal", f"{output_folder}/chunks")
+
+    results_file = f"{output_folder}/portal_results.json"
+    with open(results_file) as f:
+        assert sum(r is None for r in json.load(f)) == len(FAILED)
+
+    result = CliRunner().invoke(cli, ["retry", output_folder])
+    assert result.exit_code == 0, result.output
+
+    # The retry only had the failed items as its input
+    (input_file,) = (tmp_path / "output" / "retry" / "portal").glob("*.csv")
+    assert set(input_file.read_text().split()) == FAILED
+
+    with open(results_file) as f:
+        results = json.load(f)
+    with open(f"{output_folder}/portal_input.csv") as f:
+        inputs = f.read().split()
+    assert [r["docket_number"] for r in results] == inputs
+    assert io.load_failures("portal", output_folder, AWS()) == []
+
+
+def test_merge_retries_by_column(tmp_path):
+    """Retried results are matched to the rows of multi-column inputs."""
+
+    aws = AWS()
+    output_folder = str(tmp_path)
+    rows = pd.DataFrame(
+        {
+            "docket_number": ["A", "B", "C"],
+            "court_summary_url": ["/summary/A", "/summary/B", "/summary/C"],
+        }
+    )
+    io.save_output_data(f"{output_folder}/court_summary_input.csv", rows, aws)
+    io.save_output_data(
+        f"{output_folder}/court_summary_results.json", [{"n": 1}, None, None], aws
+    )
+    io.save_output_data(
+        f"{output_folder}/court_summary_failures.json",
+        [{"key": "/summary/B"}, {"key": "/summary/C"}],
+        aws,
+    )
+
+    _, retry_folder = io.get_retry_paths("court_summary", output_folder, "1")
+    io.save_output_data(
+        f"{io.get_parts_folder('court_summary', retry_folder)}/run-all-00000.jsonl",
+        [{"key": "/summary/B", "result": {"n": 2}}],
+        aws,
+    )
+
+    columns = list(rows.columns)
+    assert io.merge_retries("court_summary", output_folder, aws, columns) == 1
+    with open(f"{output_folder}/court_summary_results.json") as f:
+        assert json.load(f) == [{"n": 1}, {"n": 2}, None]
+    assert io.load_failures("court_summary", output_folder, aws) == [
+        {"key": "/summary/C"}
+    ]